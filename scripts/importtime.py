@@ -0,0 +1,142 @@
+#
+# Startup import check
+#
+# Checks that sub-commands do not load the OpenStack SDK before they
+# need it.  Offline sub-commands are run to completion and must never
+# import it, the others must not import it before connecting.  The
+# time spent importing modules is reported, as measured by
+# ``python -X importtime`` on top of ``python -c pass``, for
+# information only, as it depends on the machine.  Exits with an error
+# if any sub-command imports the SDK.
+#
+# Usage:
+#   python scripts/importtime.py [--runs N] [subcommand ...]
+#
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+mydir = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(mydir)
+srcdir = os.path.join(topdir, 'src')
+sample = os.path.join(topdir, 'demos', 'demo2.yaml')
+
+COMMANDS = {
+  'help': ([], True),
+  'parse': (['parse', '-p', '-y', sample], True),
+  'resolve': (['resolve', sample], True),
+  'new-store': (['new-store'], True),
+  'daemon': (['daemon'], False),
+  'vms': (['vms'], False),
+  'start': (['start', 'vm'], False),
+  'deploy': (['deploy', sample], False),
+  'nuke': (['nuke'], False),
+}
+''' Sub-commands to check, with sample arguments and whether they run offline '''
+
+SDK = [ 'openstack', 'otcextensions', 'keystoneauth1' ]
+''' Modules that only commands talking to the cloud may import '''
+
+STARTUP = '''
+import importlib, sys
+sys.path.insert(0, {srcdir!r})
+import myotc, cli
+args = cli.parser().parse_args({argv!r})
+if 'func' in args and hasattr(args.func, 'module'): importlib.import_module(args.func.module)
+'''
+''' Code importing what a sub-command needs before it runs '''
+
+RUN = '''
+import runpy, sys
+sys.path.insert(0, {srcdir!r})
+sys.argv = ['myotc', '--local'] + {argv!r}
+try:
+  runpy.run_path({script!r}, run_name = '__main__')
+except SystemExit:
+  pass
+'''
+''' Code running a sub-command to completion '''
+
+REPORT = '''
+import json, sys
+sys.stderr.write('loaded: ' + json.dumps([m for m in {sdk!r} if m in sys.modules]) + '\\n')
+'''
+
+def python(code, cwd):
+  ''' Run python code with ``-X importtime``
+
+  :param str code: code to run
+  :param str cwd: working directory
+  :returns tuple: ``(times, loaded)`` with the cumulative import time in microseconds of top-level imports, and the SDK modules loaded
+  '''
+  rc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code + REPORT.format(sdk = SDK)],
+                      capture_output = True, text = True, cwd = cwd, stdin = subprocess.DEVNULL)
+  times = {}
+  loaded = None
+  for line in rc.stderr.splitlines():
+    if line.startswith('loaded: '):
+      loaded = json.loads(line[8:])
+      continue
+    if not line.startswith('import time:'): continue
+    fields = line.split('|')
+    if not fields[1].strip().isdigit(): continue # Header
+    if fields[2].startswith('  '): continue # Nested import, counted by its parent
+    times[fields[2].strip()] = int(fields[1])
+  if loaded is None:
+    sys.stderr.write(rc.stderr)
+    sys.exit(1)
+  return times, loaded
+
+def measure(argv, offline, cwd):
+  ''' Check a sub-command
+
+  :param list argv: command line arguments
+  :param bool offline: run the sub-command to completion
+  :param str cwd: working directory
+  :returns tuple: ``(usec, loaded)`` with the import time in microseconds and the SDK modules loaded
+
+  Modules imported by the interpreter itself at startup are not counted.
+  '''
+  startup, loaded = python('pass', cwd)
+  if offline:
+    code = RUN.format(srcdir = srcdir, argv = argv, script = os.path.join(srcdir, 'myotc.py'))
+  else:
+    code = STARTUP.format(srcdir = srcdir, argv = argv)
+  times, loaded = python(code, cwd)
+  return sum([t for mod, t in times.items() if not mod in startup]), loaded
+
+def main():
+  cli = ArgumentParser(description = 'Startup import check')
+  cli.add_argument('--runs', help = 'Runs per sub-command, the fastest is reported', type = int, default = 3)
+  cli.add_argument('commands', help = 'Sub-commands to check', nargs = '*')
+  args = cli.parse_args()
+
+  # new-store and the pre-processor write files next to the working directory
+  tmpdir = tempfile.mkdtemp(prefix = 'importtime-')
+  workdir = os.path.join(tmpdir, 'work')
+  os.mkdir(workdir)
+  failed = []
+  try:
+    for cmd in args.commands or COMMANDS:
+      argv, offline = COMMANDS[cmd]
+      runs = [measure(argv, offline, workdir) for i in range(max(1,args.runs))]
+      usec = min([r[0] for r in runs])
+      loaded = sorted(set([m for r in runs for m in r[1]]))
+      if len(loaded): failed.append(cmd)
+      print('{cmd:12} {mode:8} {ms:>9.1f}ms {status}'.format(cmd = cmd,
+              mode = 'offline' if offline else 'startup',
+              ms = usec / 1000,
+              status = 'LOADS ' + ', '.join(loaded) if len(loaded) else 'OK'))
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors = True)
+
+  if len(failed):
+    sys.stderr.write('OpenStack SDK imported by: {}\n'.format(', '.join(failed)))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
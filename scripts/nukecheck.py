@@ -0,0 +1,99 @@
+#
+# Nuke check
+#
+# Deploys a demo against the local API simulator, adds volumes that
+# a nuke must delete without waiting for them, e.g. volumes in
+# ``error`` state, then nukes the demo with ``nuke`` and ``nuke-many``
+# and checks that nothing named after the demo is left.  Exits with
+# an error if a nuke fails or leaves resources behind.
+#
+# Usage:
+#   python scripts/nukecheck.py [demo]
+#
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+from simbench import DEMOS, SNIPPETS, reset, run
+import simulator
+import ypp
+import consts as K
+
+COMMANDS = {
+  'nuke': lambda sid, fname: ['nuke', '-x', fname],
+  'nuke-many': lambda sid, fname: ['nuke-many', '-x', sid],
+}
+''' Nuke sub-commands to check, with their arguments '''
+
+def left(cloud, sid):
+  ''' Resources of an environment still in the simulated cloud
+
+  :param simulator.Cloud cloud: simulated cloud
+  :param str sid: system ID of the environment
+  :returns list: ``kind name (status)`` strings
+  '''
+  res = []
+  for kind, table in sorted(cloud.tables.items()):
+    for r in table.values():
+      name = r.get(K.NAME) or ''
+      if name.startswith(sid + '-') or name.startswith(sid + '.'):
+        res.append('{} {} ({})'.format(kind, name, r.get(K.status)))
+  return res
+
+def check(demo, cmd):
+  ''' Deploy a demo and nuke it
+
+  :param str demo: demo name
+  :param str cmd: nuke sub-command, see ``COMMANDS``
+  :returns list: resources left behind, see ``left``
+  '''
+  fname = os.path.join(DEMOS, demo + '.yaml')
+  defines = ['CLOUD=' + K.SIMULATOR, 'SID=' + demo, 'SIM_LATENCY=0', 'SIM_SETTLE=0.2', 'SIM_SEED=1']
+  opts = ['-I', SNIPPETS] + ['-D' + d for d in defines]
+  reset()
+  with contextlib.redirect_stdout(io.StringIO()):
+    ypp.process(fname, [SNIPPETS], defines)
+  cloud = simulator.get()
+  run(opts + ['deploy', '-x', fname])
+
+  # Volumes that are not attached to anything are deleted directly
+  cloud.insert(K.volume, name = demo + '-broken', size = 10, status = 'error', attachments = [])
+  cloud.insert(K.volume, name = demo + '-spare', size = 10, status = 'available', attachments = [])
+
+  try:
+    run(opts + COMMANDS[cmd](demo, fname))
+  except SystemExit as e:
+    if e.code: return ['{} exited with {}'.format(cmd, e.code)] + left(cloud, demo)
+  return left(cloud, demo)
+
+def main():
+  cli = ArgumentParser(description = 'Nuke check against the API simulator')
+  cli.add_argument('demo', help = 'Demo to deploy and nuke', nargs = '?', default = 'demo2')
+  args = cli.parse_args()
+
+  # Cached image lists and generated secrets are written to the current directory
+  workdir = tempfile.mkdtemp(prefix = 'nukecheck-')
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  os.environ[K.MYOTC_TOKEN_CACHE] = ''
+  failed = []
+  try:
+    for cmd in COMMANDS:
+      res = check(args.demo, cmd)
+      print('{cmd:12} {status}'.format(cmd = cmd, status = 'OK' if len(res) == 0 else 'FAILED'))
+      for r in res: print('  ' + r)
+      if len(res): failed.append(cmd)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors = True)
+
+  if len(failed):
+    sys.stderr.write('Resources left behind by: {}\n'.format(', '.join(failed)))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,163 @@
+#
+# Deployment benchmark
+#
+# Deploys the bundled demos against the local API simulator, deploys
+# them again (which should change nothing) and nukes them, and reports
+# the wall time and number of API requests of each step.  Each demo is
+# run in projects already holding a number of unrelated deployments,
+# to show how the commands scale with the size of the project.
+#
+# Usage:
+#   python scripts/simbench.py [options] [demo ...]
+#
+# --scales lists the project sizes, e.g. ``--scales 0,50``.
+# --latency, --settle, --lag, --page-size and --fail-rate set the
+# simulator behaviour, see src/simulator.py.  --calls also prints the
+# requests made by each step per service and method.  --json saves the
+# results.
+#
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+mydir = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(mydir)
+srcdir = os.path.join(topdir, 'src')
+sys.path.insert(0, srcdir)
+
+import cli
+import myotc
+import simulator
+import waiter
+import catalog
+import ypp
+import consts as K
+
+DEMOS = os.path.join(topdir, 'demos')
+SNIPPETS = os.path.join(topdir, 'snippets')
+
+STEPS = [
+  ('deploy', ['deploy', '-x']),
+  ('redeploy', ['deploy', '-x']),
+  ('nuke', ['nuke', '-x']),
+]
+''' Steps run for each demo, with their sub-command '''
+
+def reset():
+  ''' Start from a clean state, as a new invocation would '''
+  ypp.yaml_pp_vars.clear()
+  ypp.yaml_pp_vars.update(os.environ)
+  del ypp.yaml_include_path[:]
+  myotc.settings.connection = None
+  myotc.settings.connections.clear()
+  simulator.clouds.clear()
+  waiter.waiters.clear()
+  waiter.routers.clear()
+  catalog.catalogs.clear()
+
+def run(argv):
+  ''' Run a command line in-process
+
+  :param list argv: command line arguments
+  :returns float: wall time in seconds
+  '''
+  out = io.StringIO()
+  start = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+      args = cli.parser().parse_args(argv)
+      args.func(args)
+      myotc.msg_flush()
+  except BaseException:
+    sys.stderr.write(out.getvalue())
+    raise
+  return time.perf_counter() - start
+
+def bench(demo, scale, defines):
+  ''' Benchmark a demo
+
+  :param str demo: demo name
+  :param int scale: number of unrelated deployments in the project
+  :param list defines: pre-processor definitions
+  :returns list: results of each step
+  '''
+  fname = os.path.join(DEMOS, demo + '.yaml')
+  opts = ['-I', SNIPPETS] + ['-D' + d for d in ['CLOUD=' + K.SIMULATOR, 'SID=' + demo] + defines]
+  reset()
+  with contextlib.redirect_stdout(io.StringIO()):
+    ypp.process(fname, [SNIPPETS], ['CLOUD=' + K.SIMULATOR, 'SID=' + demo] + defines)
+  cloud = simulator.get()
+  simulator.populate(cloud, scale)
+
+  results = []
+  for step, cmd in STEPS:
+    myotc.settings.connection = None
+    cloud.reset_calls()
+    elapsed = run(opts + cmd + [fname])
+    results.append({
+      'demo': demo,
+      'scale': scale,
+      'step': step,
+      'time': elapsed,
+      'calls': cloud.total_calls(),
+      'detail': { '{} {}'.format(*k): v for k, v in sorted(cloud.calls.items()) },
+    })
+  return results
+
+def main():
+  cli = ArgumentParser(description = 'Deploy/nuke benchmark against the API simulator')
+  cli.add_argument('--scales', help = 'Comma separated number of unrelated deployments in the project', default = '0,20,100')
+  cli.add_argument('--latency', help = 'Seconds added to every request', default = '0.05')
+  cli.add_argument('--settle', help = 'Seconds for resources to reach their final status', default = '2')
+  cli.add_argument('--lag', help = 'Seconds before new resources are listed', default = '0')
+  cli.add_argument('--page-size', help = 'Items per page of list calls', default = '100')
+  cli.add_argument('--fail-rate', help = 'Fraction of requests that fail', default = '0')
+  cli.add_argument('-D', '--define', help = 'Add constant', action = 'append', default = [])
+  cli.add_argument('--calls', help = 'Print requests by service and method', action = 'store_true')
+  cli.add_argument('--json', help = 'Save the results to a JSON file')
+  cli.add_argument('demos', help = 'Demos to run, defaults to all', nargs = '*')
+  args = cli.parse_args()
+
+  demos = args.demos or sorted([f[:-5] for f in os.listdir(DEMOS) if f.endswith('.yaml')])
+  defines = [
+    'SIM_LATENCY=' + args.latency,
+    'SIM_SETTLE=' + args.settle,
+    'SIM_LAG=' + args.lag,
+    'SIM_PAGE_SIZE=' + args.page_size,
+    'SIM_FAIL_RATE=' + args.fail_rate,
+    'SIM_SEED=1',
+  ] + args.define
+
+  # Cached image lists and generated secrets are written to the current directory
+  workdir = tempfile.mkdtemp(prefix = 'simbench-')
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  os.environ[K.MYOTC_TOKEN_CACHE] = ''
+  results = []
+  try:
+    print('{:10} {:>6} {:10} {:>9} {:>7}'.format('demo', 'scale', 'step', 'time', 'calls'))
+    for demo in demos:
+      for scale in [int(s) for s in args.scales.split(',')]:
+        for r in bench(demo, scale, defines):
+          results.append(r)
+          print('{demo:10} {scale:6} {step:10} {time:8.2f}s {calls:7}'.format(**r))
+          if args.calls:
+            for k, v in r['detail'].items():
+              print('  {:40} {:>7}'.format(k, v))
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors = True)
+
+  if args.json:
+    with open(args.json, 'w') as fp:
+      json.dump(results, fp, indent = 2)
+      fp.write('\n')
+
+if __name__ == '__main__':
+  main()
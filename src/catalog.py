@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+Image and flavor resolution
+
+Most VMs in a deployment share a handful of images and flavors.  A
+``Catalog`` indexes the image and flavor lists by name and id, so
+each VM is resolved locally instead of with its own ``find_image``
+and ``find_flavor`` calls.  The lists are cached for a day, like the
+ones of the ``imgs`` and ``flavors`` commands, but in files named after
+the cloud and project they were listed from, e.g.
+``imglst-otc-myproject.yaml``, so a working directory used with
+several clouds never resolves names to the ids of another one.
+'''
+import os
+import re
+import threading
+import time
+import shows
+import myotc
+import consts as K
+
+MAX_AGE = 86400
+''' Time in seconds before the catalogs are loaded again '''
+
+class Catalog:
+  ''' Image and flavor index
+
+  :param openstack.connection c: OpenStack connection
+  :param None|tuple scope: (optional) ``(cloud, project)`` of the connection, the lists are not cached in files if None
+
+  Lists are loaded on first use, and again once they are older than
+  ``MAX_AGE``.  Names not found in the cached lists are looked up live,
+  as the cache may be out of date.
+  '''
+  def __init__(self, c, scope = None):
+    self.conn = c
+    self.scope = scope
+    self.lock = threading.Lock()
+    self.index = {}
+    self.loaded = {}
+
+  def _loaded(self, kind):
+    ''' Make sure a catalog has been loaded
+
+    :param str kind: ``image`` or ``flavor``
+    :returns dict: entries indexed by name and id
+    '''
+    if not kind in self.index or time.time() - self.loaded[kind] > MAX_AGE:
+      if kind == K.image:
+        cache_file, lister = K.imglst_yaml, lambda: self.conn.image.images()
+      else:
+        cache_file, lister = K.flavorlst_yaml, lambda: self.conn.compute.flavors(True)
+      if self.scope is None:
+        data = [i for i in lister() if K.NAME in i]
+      else:
+        cache_file = scoped(cache_file, self.scope)
+        data = shows.check_cache(cache_file)
+        if data is None:
+          data = shows.save_cache(cache_file, lister())
+      idx = {}
+      for i in data:
+        if K.sID in i: idx[i[K.sID]] = i
+      for i in data:
+        if not i[K.NAME] in idx: idx[i[K.NAME]] = i
+      self.index[kind] = idx
+      self.loaded[kind] = time.time()
+    return self.index[kind]
+
+  def _find(self, kind, name_or_id, finder):
+    with self.lock:
+      idx = self._loaded(kind)
+      if name_or_id in idx: return idx[name_or_id]
+    res = finder(name_or_id)
+    if not res is None:
+      with self.lock:
+        idx[name_or_id] = res
+    return res
+
+  def image(self, name_or_id):
+    ''' Find an image
+
+    :param str name_or_id: image name or id
+    :returns None|dict: image if found
+    '''
+    return self._find(K.image, name_or_id, self.conn.compute.find_image)
+
+  def flavor(self, name_or_id):
+    ''' Find a flavor
+
+    :param str name_or_id: flavor name or id
+    :returns None|dict: flavor if found
+    '''
+    return self._find(K.flavor, name_or_id, self.conn.compute.find_flavor)
+
+def scoped(cache_file, scope):
+  ''' Cache file for a cloud and project
+
+  :param str cache_file: cache file of the ``imgs`` or ``flavors`` command
+  :param tuple scope: ``(cloud, project)``
+  :returns str: ``cache_file`` with the cloud and project added to its name
+  '''
+  base, ext = os.path.splitext(cache_file)
+  tags = [re.sub(r'[^A-Za-z0-9_.]+', '_', str(p)) for p in scope if p]
+  return '-'.join([base] + tags) + ext
+
+def scope(c):
+  ''' Cloud and project of a connection
+
+  :param openstack.connection c: OpenStack connection
+  :returns None|tuple: ``(cloud, project)`` as used by ``myotc.connect``, None if it did not open ``c``
+  '''
+  for key, conn in list(myotc.settings.connections.values()):
+    if conn is c: return key
+  return None
+
+catalogs = {}
+''' Shared catalogs indexed by connection '''
+catalogs_lock = threading.Lock()
+
+def get(c):
+  ''' Get the shared catalog for a connection
+
+  :param openstack.connection c: OpenStack connection
+  :returns Catalog: shared catalog
+  '''
+  with catalogs_lock:
+    if not id(c) in catalogs: catalogs[id(c)] = Catalog(c, scope(c))
+    return catalogs[id(c)]
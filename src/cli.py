@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 ''' Command Line Interface definition '''
+import importlib
 import ypp
-import shows
-import cmds
 import proxycfg
+import daemon
 from argparse import ArgumentParser, Action
 import consts as K
 from version import VERSION
@@ -14,6 +14,23 @@ from version import VERSION
 #
 ###################################################################
 
+def lazy(module, name, local = False):
+  ''' Refer to a command function without importing its module
+
+  :param str module: module implementing the command
+  :param str name: command function name
+  :param bool local: (optional) never forward the command to the daemon, see ``daemon.local``
+  :returns callable: function importing the module and calling the command
+
+  Command modules pull in the OpenStack SDK, so they are only
+  imported once the command to run is known.
+  '''
+  def cmd(args):
+    return getattr(importlib.import_module(module), name)(args)
+  cmd.__name__ = name
+  cmd.module = module
+  if local: cmd.local = True
+  return cmd
 
 def parser():
   ''' Command line argument parser '''
@@ -24,6 +41,9 @@ def parser():
   cli.add_argument('-V','--version', action='version', version='%(prog)s '+VERSION)
   cli.add_argument('-I','--include', help='Add Include path', action='append')
   cli.add_argument('-D','--define', help='Add constant', action='append')
+  cli.add_argument('--profile-api', help='Report time spent in API calls on exit', action='store_true')
+  cli.add_argument('--profile-json', help='Save API call profile to FILE (implies --profile-api)', metavar='FILE')
+  cli.add_argument('--local', help='Do not forward commands to a running daemon', action='store_true')
   if proxycfg.has_winreg:
     cli.add_argument('-A','--autocfg',help='Use WinReg to configure proxy', action='store_true')
   cli.set_defaults(autocfg = False)
@@ -34,30 +54,67 @@ def parser():
     showcfg_cli = subs.add_parser('show-proxy-autocfg',help='Show proxy autocfg data')
     showcfg_cli.set_defaults(func = proxycfg.show_autocfg)
 
+  daemon_cli = subs.add_parser('daemon', help='Run a background daemon keeping connections warm')
+  daemon_cli.add_argument('--stop', help='Stop the running daemon', action='store_true')
+  daemon_cli.set_defaults(func = daemon.daemon_cmd)
+
   deploy_cli = subs.add_parser('deploy', help='Deploy a cloud environment')
   deploy_cli.add_argument('-x','--execute', help='Execute (defaults to dry-run).  Only applies when modifying existing resources',action='store_true')
-  deploy_cli.add_argument('file', help='YAML containing cloud description')
-  deploy_cli.set_defaults(func = cmds.deploy_cmd)
+  deploy_cli.add_argument('-j','--jobs', help='Number of VMs to deploy concurrently', type=int, default=4)
+  deploy_cli.add_argument('--plan', help='Save changes to PLANFILE instead of applying them', metavar='PLANFILE')
+  deploy_cli.add_argument('--apply', help='Apply changes saved in PLANFILE', metavar='PLANFILE')
+  deploy_cli.add_argument('--resume', help='Resume an interrupted deployment', action='store_true')
+  deploy_cli.add_argument('file', help='YAML containing cloud description', nargs='?')
+  deploy_cli.set_defaults(func = lazy('cmds', 'deploy_cmd'))
+
+  deploy_many_cli = subs.add_parser('deploy-many', help='Deploy several cloud environments in parallel')
+  deploy_many_cli.add_argument('-x','--execute', help='Execute (defaults to dry-run).  Only applies when modifying existing resources',action='store_true')
+  deploy_many_cli.add_argument('-j','--jobs', help='Number of VMs to deploy concurrently in each environment', type=int, default=4)
+  deploy_many_cli.add_argument('-P','--procs', help='Number of environments to deploy concurrently', type=int, default=4)
+  deploy_many_cli.add_argument('-S','--sid', help='Deploy for SID (may be repeated)', action='append')
+  deploy_many_cli.add_argument('--logdir', help='Directory for per-SID log files', default='logs')
+  deploy_many_cli.add_argument('--resume', help='Resume interrupted deployments', action='store_true')
+  deploy_many_cli.add_argument('files', help='YAML files containing cloud descriptions', nargs='+')
+  deploy_many_cli.set_defaults(func = lazy('cmds', 'deploy_many_cmd', local = True))
 
   nuke_cli = subs.add_parser('nuke', help='Completely nuke a cloud environment')
   nuke_cli.add_argument('-x','--execute', help='Execute (defaults to dry-run)',action='store_true')
+  nuke_cli.add_argument('-i','--interactive', help='Show what would be deleted and ask before deleting it',action='store_true')
+  nuke_cli.add_argument('-j','--jobs', help='Number of resources to delete concurrently', type=int, default=8)
   nuke_cli.add_argument('file', help='YAML containing cloud description',nargs='?')
-  nuke_cli.set_defaults(func = cmds.nuke_cmd)
+  nuke_cli.set_defaults(func = lazy('cmds', 'nuke_cmd'))
+
+  nuke_many_cli = subs.add_parser('nuke-many', help='Nuke several cloud environments in parallel')
+  nuke_many_cli.add_argument('-x','--execute', help='Execute (defaults to dry-run)',action='store_true')
+  nuke_many_cli.add_argument('-i','--interactive', help='Show what would be deleted and ask before deleting it',action='store_true')
+  nuke_many_cli.add_argument('-j','--jobs', help='Number of resources to delete concurrently in each environment', type=int, default=8)
+  nuke_many_cli.add_argument('-P','--procs', help='Number of environments to nuke concurrently', type=int, default=4)
+  nuke_many_cli.add_argument('--older-than', help='Only nuke environments whose newest VM is older than DAYS', type=float, metavar='DAYS')
+  nuke_many_cli.add_argument('sids', help='SIDs to nuke, or shell-style patterns such as "train-*"', nargs='+')
+  nuke_many_cli.set_defaults(func = lazy('cmds', 'nuke_many_cmd'))
+
+  orphans_cli = subs.add_parser('orphans', help='Find resources left behind by interrupted deployments and nukes')
+  orphans_cli.add_argument('-x','--execute', help='Delete the orphans found',action='store_true')
+  orphans_cli.add_argument('-i','--interactive', help='Show the orphans found and ask before deleting them',action='store_true')
+  orphans_cli.add_argument('--all', help='Allow deleting the orphans of every known SID when no SIDs are given',action='store_true')
+  orphans_cli.add_argument('-j','--jobs', help='Number of resources to delete concurrently', type=int, default=8)
+  orphans_cli.add_argument('sids', help='Only report orphans of these SIDs, may be shell-style patterns', nargs='*')
+  orphans_cli.set_defaults(func = lazy('cmds', 'orphans_cmd'))
 
   start_cli = subs.add_parser('start', help='Start VM')
   start_cli.add_argument('-c','--file', help='Read VMs from YAML file')
   start_cli.add_argument('name', help='VM name to start',nargs='*')
-  start_cli.set_defaults(func = cmds.state_cmd, forced = False, mode = K.start)
+  start_cli.set_defaults(func = lazy('cmds', 'state_cmd'), forced = False, mode = K.start)
 
   stop_cli = subs.add_parser('stop', help='Stop VM')
   stop_cli.add_argument('-c','--file', help='Read VMs from YAML file')
   stop_cli.add_argument('name', help='VM name to stop',nargs='*')
-  stop_cli.set_defaults(func = cmds.state_cmd, forced = False, mode = K.stop)
+  stop_cli.set_defaults(func = lazy('cmds', 'state_cmd'), forced = False, mode = K.stop)
 
   reboot_cli = subs.add_parser('reboot', help='Re-boot VM')
   reboot_cli.add_argument('-f','--forced', help='Hard Reboot', action='store_true')
   reboot_cli.add_argument('name', help='VM name to reboot',nargs='+')
-  reboot_cli.set_defaults(func = cmds.state_cmd, forced = False, mode = K.reboot, file = None)
+  reboot_cli.set_defaults(func = lazy('cmds', 'state_cmd'), forced = False, mode = K.reboot, file = None)
 
   vmlist_cli = subs.add_parser('vms', help='List VMs')
   vmlist_cli.add_argument('-s','--sid', help='Specify the SID to list')
@@ -65,13 +122,13 @@ def parser():
   vmlist_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   vmlist_cli.add_argument('-c','--file', help='Read VMs from YAML file')
   vmlist_cli.add_argument('spec', help='VM name or wildcard', nargs='*')
-  vmlist_cli.set_defaults(func = shows.vmlist_cmd)
+  vmlist_cli.set_defaults(func = lazy('shows', 'vmlist_cmd'))
 
   images_cli = subs.add_parser('images', help='List images')
   images_cli.add_argument('-F','--format', help='Format to print')
   images_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   images_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  images_cli.set_defaults(func = shows.imgs_cmd)
+  images_cli.set_defaults(func = lazy('shows', 'imgs_cmd'))
 
   flavors_cli = subs.add_parser('flavors', help='List flavors')
   flavors_cli.add_argument('-F','--format', help='Format to print')
@@ -83,47 +140,47 @@ def parser():
   flavors_cli.add_argument('--min-mem',help='Minimum memory value',type=int)
   flavors_cli.add_argument('--max-mem',help='Maximum memory value',type=int)
   flavors_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  flavors_cli.set_defaults(func = shows.flavors_cmd)
+  flavors_cli.set_defaults(func = lazy('shows', 'flavors_cmd'))
 
   vpcs_cli = subs.add_parser('vpcs', help='List VPCs')
   vpcs_cli.add_argument('-F','--format', help='Format to print')
   vpcs_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   vpcs_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  vpcs_cli.set_defaults(func = shows.lists_cmd, mode=K.vpc)
+  vpcs_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.vpc)
 
   keys_cli = subs.add_parser('keys', help='List Keys')
   keys_cli.add_argument('-F','--format', help='Format to print')
   keys_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   keys_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  keys_cli.set_defaults(func = shows.lists_cmd, mode=K.key)
+  keys_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.key)
 
   nets_cli = subs.add_parser('nets', help='List nets/subnets')
   nets_cli.add_argument('-F','--format', help='Format to print')
   nets_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   nets_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  nets_cli.set_defaults(func = shows.lists_cmd, mode=K.net)
+  nets_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.net)
 
   zones_cli = subs.add_parser('dns-zones', help='List DNS zones')
   zones_cli.add_argument('-F','--format', help='Format to print')
   zones_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   zones_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  zones_cli.set_defaults(func = shows.lists_cmd, mode=K.zone)
+  zones_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.zone)
 
   sgs_cli = subs.add_parser('sgs', help='List Security Groups')
   sgs_cli.add_argument('-F','--format', help='Format to print')
   sgs_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   sgs_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  sgs_cli.set_defaults(func = shows.lists_cmd, mode=K.sgs)
+  sgs_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.sgs)
 
   vols_cli = subs.add_parser('vols', help='List Volumes')
   vols_cli.add_argument('-F','--format', help='Format to print')
   vols_cli.add_argument('-l','--details', help='Show detailed list',action='store_true')
   vols_cli.add_argument('spec', help='name or wildcard', nargs='*')
-  vols_cli.set_defaults(func = shows.lists_cmd, mode=K.vols)
+  vols_cli.set_defaults(func = lazy('shows', 'lists_cmd'), mode=K.vols)
 
   ping_cli = subs.add_parser('ping', help='Check connectivity')
   ping_cli.add_argument('-p','--output', help='Print output',action='store_true')
-  ping_cli.set_defaults(func = cmds.ping_cmd)
+  ping_cli.set_defaults(func = lazy('cmds', 'ping_cmd'))
 
   parse_cli = subs.add_parser('parse', help='Parse a YAML file (syntax checking)')
   parse_cli.add_argument('-p','--preproc', help='Use pre-processor',action='store_true')
@@ -134,17 +191,17 @@ def parser():
   resolv_cli = subs.add_parser('resolve', help='Resolve dependancies')
   resolv_cli.add_argument('-r','--reverse', help='Reverse dependancy list',action='store_true')
   resolv_cli.add_argument('file', help='YAML containing cloud description')
-  resolv_cli.set_defaults(func = cmds.resolv_cmd)
+  resolv_cli.set_defaults(func = lazy('cmds', 'resolv_cmd'))
 
   conout_cli = subs.add_parser('conout', help='Get console output')
   conout_cli.add_argument('-y','--yaml', help='Output YAML',action='store_true')
   conout_cli.add_argument('-l','--limit', help='Limit output to number of lines',default=50)
   conout_cli.add_argument('-L','--no-limit', help='Return all available lines', action='store_const', dest='limit', const=None)
   conout_cli.add_argument('name', help='VM name to show',nargs='+')
-  conout_cli.set_defaults(func = cmds.conout_cmd)
+  conout_cli.set_defaults(func = lazy('cmds', 'conout_cmd'))
 
   newvault_cli = subs.add_parser('new-store', help='Create a new/empty secrets store')
-  newvault_cli.set_defaults(func = cmds.new_vault)
+  newvault_cli.set_defaults(func = lazy('cmds', 'new_vault'))
 
   return cli
 
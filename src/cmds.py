@@ -4,28 +4,37 @@ import sys
 import fnmatch
 import ypp
 import nukes
+import orphans
 import deploy
+import inventory
+import waiter
+import dnsbatch
+import plans
+import catalog
+import journal
+import daemon
 import myotc
 import consts as K
 import os
+import time
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-def sort_vms(vmlist):
-  '''Sort VMs according to dependancies
+def vm_waves(vmlist):
+  '''Group VMs in dependancy waves
 
   :param dict vmlist: dict of dict containing VM definitions
-  :returns list: list containing vmids in the right ordered
-  :todo: untested
+  :returns list: list of lists containing vmids.
 
   It will look in the VM defitions for the ``reqs`` key, containing
-  a list of vmid's that the VM depends on.
+  a list of vmid's that the VM depends on.  Each wave only contains
+  VMs whose requirements are all in earlier waves, so the VMs in
+  a wave can be deployed concurrently.
 
+  VMs with unresolvable dependancies are added as a last wave.
   '''
-  vmorder = []
-  vmd = {}
-  vmq = {}
-
   for vmid in vmlist:
-    vmq[vmid] = vmid
     if 'reqs' in vmlist[vmid]:
       missing = {}
       for rq in vmlist[vmid]['reqs']:
@@ -35,36 +44,129 @@ def sort_vms(vmlist):
         for i in missing:
           print('vm {vmid} requires unknown vm: {i}'.format(vmid=vmid,i=i))
 
-  lres = -1
-  while lres != 0:
-    lres = 0
-    cnt = 0
-    for vmid in vmq:
-      if vmid in vmd:
-        cnt += 1
-        continue
+  waves = []
+  vmd = {}
+  while len(vmd) < len(vmlist):
+    wave = []
+    for vmid in vmlist:
+      if vmid in vmd: continue
       if 'reqs' in vmlist[vmid]:
         ok = True
         for req in vmlist[vmid]['reqs']:
-          if not req in vmq: continue # unknown dependancy
+          if not req in vmlist: continue # unknown dependancy
           if not req in vmd:
             ok = False
             break
         if not ok: continue
-      vmorder.append(vmid)
+      wave.append(vmid)
+    if len(wave) == 0: break
+    for vmid in wave:
       vmd[vmid] = vmid
-      lres += 1
-      cnt += 1
+    waves.append(wave)
 
-  if lres == 0 and cnt < len(vmq):
+  if len(vmd) < len(vmlist):
     print('Unable to resolve dependancies for:')
-    for i in vmq:
+    wave = []
+    for i in vmlist:
       if i in vmd: continue
       print('  - {} ({})'.format(i,str(vmlist[i]['reqs'])))
-      vmorder.append(i)
+      wave.append(i)
+    waves.append(wave)
+
+  return waves
+
+def sort_vms(vmlist):
+  '''Sort VMs according to dependancies
 
+  :param dict vmlist: dict of dict containing VM definitions
+  :returns list: list containing vmids in the right ordered
+
+  See ``vm_waves`` for details.
+  '''
+  vmorder = []
+  for wave in vm_waves(vmlist):
+    vmorder.extend(wave)
   return vmorder
 
+def deploy_net(net_id, opts, attrs):
+  '''Deploy a single network from a worker thread
+
+  :param int|str net_id: network id or name
+  :param dict opts: session options
+  :param dict attrs: network definition
+  :returns None|instance: Returns None on error, Net instance on success
+  '''
+  try:
+    plans.context(opts, 0, 'net-{}'.format(net_id))
+    return deploy.new_net(net_id, opts, **attrs)
+  finally:
+    myotc.msg_flush()
+
+def deploy_nets(netlist, opts, jobs = 1):
+  '''Deploy networks concurrently
+
+  :param dict netlist: dict of dict containing network definitions
+  :param dict opts: session options
+  :param int jobs: (optional) maximum number of networks to deploy concurrently
+  :returns dict: Net instances indexed by net id
+
+  Subnets of the same VPC share the wait for its router, so they
+  can be attached to it concurrently.
+  '''
+  with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+    tasks = { net_id: pool.submit(deploy_net, net_id, opts, netlist[net_id]) for net_id in netlist }
+    return { net_id: tasks[net_id].result() for net_id in tasks }
+
+def deploy_vm(vmid, opts, vm, wave = None):
+  '''Deploy a single VM from a worker thread
+
+  :param int|str vmid: VM id or name
+  :param dict opts: session options
+  :param dict vm: VM definition
+  :param int wave: (optional) dependancy wave, used when planning
+  :returns None|instance: Returns None on error, VM instance on success
+  '''
+  try:
+    plans.context(opts, wave, str(vmid))
+    return deploy.new_srv(vmid, opts, **vm)
+  finally:
+    myotc.msg_flush()
+
+def deploy_vms(vmqueue, opts, jobs = 1):
+  '''Deploy VMs in dependancy waves
+
+  :param dict vmqueue: dict of dict containing VM definitions
+  :param dict opts: session options
+  :param int jobs: (optional) maximum number of VMs to deploy concurrently
+  :returns dict: VM instances indexed by vmid.  Failed VMs are mapped to None.
+
+  A VM is only deployed after all the VMs it ``reqs`` have been
+  deployed succesfully.
+  '''
+  res = {}
+  with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+    for i, wave in enumerate(vm_waves(vmqueue)):
+      tasks = {}
+      for vmid in wave:
+        failed = []
+        if 'reqs' in vmqueue[vmid]:
+          for req in vmqueue[vmid]['reqs']:
+            if req in res and res[req] is None: failed.append(req)
+        if len(failed):
+          myotc.out('Skipping vm {vmid}, requirements failed: {reqs}'.format(vmid=vmid, reqs=str(failed)))
+          res[vmid] = None
+          continue
+        tasks[pool.submit(deploy_vm, vmid, opts, vmqueue[vmid], i+1)] = vmid
+
+      for task in as_completed(tasks):
+        vmid = tasks[task]
+        try:
+          res[vmid] = task.result()
+        except Exception as e:
+          myotc.msg('vm {vmid} failed: {err}\n'.format(vmid=vmid, err=str(e)))
+          res[vmid] = None
+  return res
+
 
 def resolv_yaml(yc):
   '''Resolve YAML file VM dependancies
@@ -103,6 +205,13 @@ def deploy_cmd(args):
 
   :param namespace args: values from CLI parser
   '''
+  if not args.apply is None:
+    apply_cmd(args)
+    return
+  if args.file is None:
+    myotc.msg('Must specify a YAML file\n')
+    sys.exit(1)
+
   dryrun = not args.execute
   yc = ypp.process(args.file, args.include, args.define)
 
@@ -115,16 +224,43 @@ def deploy_cmd(args):
     sys.exit(1)
 
   c = myotc.connect(args)
+  myotc.msg('Loading inventory...')
+  inv = inventory.Inventory(c)
+  inv.load()
+  myotc.msg('DONE\n')
   opts = {
     K.CONN: c,
     K.SID: sid,
     K.DRYRUN: dryrun,
+    K.INVENTORY: inv,
+    K.DNS_BATCH: dnsbatch.DnsBatch(c),
+    K.CATALOG: catalog.get(c),
     K.PRIVATE_DNS_ZONE: ypp.vars(K.PRIVATE_DNS_ZONE, K.DEFAULT_PRIVATE_DNS_ZONE),
     K.PUBLIC_DNS_ZONE:  ypp.vars(K.PUBLIC_DNS_ZONE),
     K.CIDR_BLOCK: ypp.vars(K.CIDR_BLOCK, K.DEFAULT_CIDR_BLOCK),
     K.DEFAULT_FLAVOR: ypp.vars(K.DEFAULT_FLAVOR, K.DEFAULT_FLAVOR_VAL),
     K.DEFAULT_IMAGE: ypp.vars(K.DEFAULT_IMAGE, K.DEFAULT_IMAGE_VAL),
   }
+  if not args.plan is None:
+    # Record every change, including those that dry-run would skip
+    opts[K.DRYRUN] = False
+    opts[K.PLAN] = plans.Plan(sid, plans.fingerprint(inv, sid),
+                              yaml_sha = plans.source_hash(args.define),
+                              cloud = ypp.vars(K.CLOUD, K.DEFAULT_CLOUD),
+                              project = ypp.vars(K.PROJECT))
+  else:
+    jfile = K.journal_fmt.format(sid = sid)
+    if args.resume and not os.path.isfile(jfile):
+      print('No journal found for {}, starting from scratch'.format(sid))
+    jnl = journal.Journal(jfile, args.resume, plans.source_hash(args.define))
+    if jnl.changed:
+      print('YAML changed since the journal of {} was written, starting from scratch'.format(sid))
+    elif args.resume:
+      dropped = jnl.verify(inv)
+      print('Resuming {sid}: {count} steps done, {dropped} to redo'.format(
+              sid = sid, count = len(jnl.entries), dropped = dropped))
+    opts[K.JOURNAL] = jnl
+
   snat = True if not K.snat in yc else yc[K.snat]
   deploy.new_vpc(opts, snat=snat)
 
@@ -135,8 +271,9 @@ def deploy_cmd(args):
 
   vmqueue = {}
 
+  nets = deploy_nets(yc[K.nets], opts, args.jobs)
   for net_id in yc[K.nets]:
-    net = deploy.new_net(net_id,opts,**yc[K.nets][net_id])
+    net = nets[net_id]
 
     # create vms in net...
     if K.vms in yc[K.nets][net_id]:
@@ -147,18 +284,222 @@ def deploy_cmd(args):
 
   if K.vms in yc:
     for vmid in yc[K.vms]:
-      vm = dict(yc[K.nets][net_id][K.vms][vmid])
+      vm = dict(yc[K.vms][vmid])
       vmqueue[vmid] = vm
 
-  vmorder = sort_vms(vmqueue)
-  for vmid in vmorder:
-    deploy.new_srv(vmid, opts, **vmqueue[vmid])
+  vms = deploy_vms(vmqueue, opts, args.jobs)
+  plans.context(opts)
+  deploy.apply_dns(opts)
+
+  if K.JOURNAL in opts and not None in vms.values():
+    opts[K.JOURNAL].finish()
+
+  if not args.plan is None:
+    plan = opts[K.PLAN]
+    plan.report()
+    plan.save(args.plan)
+    print('Plan saved to {}'.format(args.plan))
+
+  return not None in vms.values()
+
+def deploy_many_init(shared):
+  '''Initialize a deploy-many worker process
+
+  :param dict shared: authentication data from the parent process
+  '''
+  # Connections inherited from the parent process must not be used
+  myotc.settings.connection = None
+  myotc.settings.connections = {}
+  myotc.settings.shared_auth = shared
+
+def deploy_one(job):
+  '''Deploy a single environment in a worker process
+
+  :param dict job: file, SID, log file and deploy options
+  :returns dict: job results
+
+  Output is written to the job's log file.
+  '''
+  res = { 'file': job['file'], 'sid': job['sid'], 'log': job['log'], 'ok': False, 'error': None }
+  defines = list(job['define'] or [])
+  if not job['sid'] is None: defines.append('{}={}'.format(K.SID, job['sid']))
+  args = argparse.Namespace(
+    file = job['file'], include = job['include'], define = defines,
+    execute = job['execute'], jobs = job['jobs'], resume = job['resume'],
+    plan = None, apply = None,
+  )
+  # Each job may use a different cloud
+  myotc.settings.connection = None
+
+  start = time.time()
+  stdout, stderr = sys.stdout, sys.stderr
+  with open(job['log'], 'w') as fp:
+    sys.stdout = sys.stderr = fp
+    try:
+      res['ok'] = deploy_cmd(args) != False
+    except SystemExit as e:
+      res['error'] = 'exit code {}'.format(e.code)
+    except Exception as e:
+      res['error'] = str(e)
+      traceback.print_exc()
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+  res['time'] = time.time() - start
+  sid = ypp.vars(K.SID)
+  if not res['sid'] is None and res['sid'] != sid:
+    res['ok'] = False
+    res['error'] = '{} overrides SID with {}, use #default instead of #define'.format(job['file'], sid)
+  res['sid'] = sid
+  return res
+
+def log_names(files):
+  '''Short names telling files apart
+
+  :param list files: file names
+  :returns dict: name for each file
+
+  Names are the file name without its extension, preceded by as many
+  parent directories as needed to make them unique, e.g. ``a_site``
+  and ``b_site`` for ``a/site.yaml`` and ``b/site.yaml``.
+  '''
+  paths = {}
+  for fname in files:
+    paths[fname] = [p for p in os.path.splitext(os.path.abspath(fname))[0].split(os.sep) if p]
+  distinct = len(set([tuple(p) for p in paths.values()]))
+  depth = 1
+  while True:
+    names = { fname: '_'.join(p[-depth:]) for fname, p in paths.items() }
+    if len(set(names.values())) == distinct or depth >= max([len(p) for p in paths.values()]): return names
+    depth += 1
+
+@daemon.local
+def deploy_many_cmd(args):
+  '''deploy-many command: deploy several environments in parallel
+
+  :param namespace args: values from CLI parser
+
+  Every YAML file is deployed once for each SID given with ``--sid``
+  or ``-DSID=``, or once with the SID it defines.  Deployments run in
+  a process pool and share the token and service catalog obtained by
+  this process.  Each deployment has its own log file, named after its
+  SID and YAML file, see ``log_names``.
+  '''
+  sids = list(args.sid or [])
+  defines = []
+  for d in (args.define or []):
+    if d.startswith(K.SID + '='):
+      sids.append(d[len(K.SID)+1:])
+    else:
+      defines.append(d)
+  if len(sids) == 0: sids = [ None ]
+  os.makedirs(args.logdir, exist_ok = True)
+  names = log_names(args.files)
+  labels = set()
+  jobs = []
+  for fname in args.files:
+    for sid in sids:
+      label = sid if not sid is None else names[fname]
+      if len(args.files) > 1 and not sid is None:
+        label = '{}-{}'.format(names[fname], sid)
+      base, n = label, 1
+      while label in labels:
+        n += 1
+        label = '{}-{}'.format(base, n)
+      labels.add(label)
+      jobs.append({
+        'file': fname, 'sid': sid, 'log': os.path.join(args.logdir, label + '.log'),
+        'include': args.include, 'define': defines, 'execute': args.execute,
+        'jobs': args.jobs, 'resume': args.resume,
+      })
+
+  myotc.msg('Authenticating...')
+  shared = myotc.auth_data(myotc.connect(args))
+  myotc.settings.connection = None
+  myotc.msg('DONE\n')
+
+  results = []
+  with ProcessPoolExecutor(max_workers = max(1,args.procs),
+                           initializer = deploy_many_init, initargs = (shared,)) as pool:
+    tasks = { pool.submit(deploy_one, job): job for job in jobs }
+    for task in as_completed(tasks):
+      try:
+        r = task.result()
+      except Exception as e:
+        job = tasks[task]
+        r = { 'file': job['file'], 'sid': job['sid'], 'log': job['log'], 'ok': False, 'error': str(e), 'time': 0 }
+      myotc.msg('{sid}: {status} ({time:.0f}s)\n'.format(sid = r['sid'] or r['file'],
+                    status = 'OK' if r['ok'] else 'FAILED', time = r['time']))
+      results.append(r)
+
+  fmt = '{sid:20} {file:30} {status:8} {time:>8} {log}'
+  print(fmt.format(sid = 'sid', file = 'file', status = 'status', time = 'time', log = 'log'))
+  for r in sorted(results, key = lambda r: str(r['sid'])):
+    print(fmt.format(sid = str(r['sid']), file = r['file'],
+                      status = 'OK' if r['ok'] else 'FAILED',
+                      time = '{:.1f}'.format(r['time']), log = r['log']))
+    if not r['error'] is None: print('  {}'.format(r['error']))
+  failed = len([r for r in results if not r['ok']])
+  print('{} deployed, {} failed'.format(len(results) - failed, failed))
+  if failed: sys.exit(1)
+
+def apply_cmd(args):
+  '''Apply a saved deployment plan
+
+  :param namespace args: values from CLI parser
+
+  The plan is applied to the cloud and project it was made for.  It
+  is refused if another cloud or project is given, if the resources
+  belonging to the SID changed since the plan was made, or if the
+  YAML file given does not match the one used for planning.
+  '''
+  plan = plans.load(args.apply)
+  sid = plan['sid']
+
+  if not args.file is None:
+    yc = ypp.process(args.file, args.include, args.define)
+    if ypp.vars(K.SID) != sid:
+      myotc.msg('Plan was made for SID {} not {}\n'.format(sid, ypp.vars(K.SID)))
+      sys.exit(1)
+    if plans.source_hash(args.define) != plan['yaml_sha']:
+      myotc.msg('YAML file changed since plan was made\n')
+      sys.exit(1)
+  else:
+    ypp.yaml_init(args.include, args.define)
+
+  for var, key in ((K.CLOUD, 'cloud'), (K.PROJECT, 'project')):
+    want = plan.get(key)
+    have = ypp.vars(var)
+    if have is None:
+      if not want is None: ypp.yaml_pp_vars[var] = want
+    elif have != want:
+      myotc.msg('Plan was made for {} {} not {}\n'.format(key, want or '(default)', have))
+      sys.exit(1)
+
+  c = myotc.connect(args)
+
+  myotc.msg('Checking plan...')
+  inv = inventory.Inventory(c)
+  inv.load()
+  if plans.fingerprint(inv, sid) != plan['fingerprint']:
+    myotc.msg('STALE\nResources changed since plan was made, please re-plan\n')
+    sys.exit(1)
+  myotc.msg('DONE\n')
+
+  if not plans.apply(c, plan, args.jobs):
+    sys.exit(1)
 
 def nuke_cmd(args):
   '''nuke command: destroy a deployed environment
 
   :param namespace args: values from CLI parser
+
+  The resources to delete are found once.  With ``--interactive``
+  they are shown and the same resources are deleted once confirmed.
   '''
+  if args.interactive and not sys.stdin.isatty():
+    myotc.msg('Cannot ask for confirmation without a terminal, use -x instead\n')
+    sys.exit(2)
+
   if not args.file is None:
     ypp.process(args.file, args.include, args.define)
   else:
@@ -170,10 +511,144 @@ def nuke_cmd(args):
     sys.exit(1)
 
   c = myotc.connect(args)
-
-  nukes.nuke(c, sid, args.execute,
+  myotc.msg('Loading inventory...')
+  inv = nukes.snapshot(c, sid)
+  myotc.msg('DONE\n')
+  tiers = nukes.targets(c, sid,
         ypp.vars(K.PRIVATE_DNS_ZONE, K.DEFAULT_PRIVATE_DNS_ZONE),
-        ypp.vars(K.PUBLIC_DNS_ZONE))
+        ypp.vars(K.PUBLIC_DNS_ZONE), inv)
+
+  if nukes.count(tiers) == 0:
+    myotc.msg('Nothing to delete for {}\n'.format(sid))
+    return
+  if args.interactive:
+    nukes.show(tiers)
+    if not myotc.confirm('Delete these {n} resources of {sid}?'.format(n = nukes.count(tiers), sid = sid)):
+      myotc.msg('Cancelled\n')
+      return
+  elif not args.execute:
+    nukes.show(tiers)
+    return
+
+  if not nukes.execute(tiers, args.jobs):
+    sys.exit(1)
+
+def nuke_many_cmd(args):
+  '''nuke-many command: destroy several deployed environments
+
+  :param namespace args: values from CLI parser
+
+  The project is listed once and its resources are split by the SID
+  prefixing their names.  Environments may be given as shell-style
+  patterns, matched against the SIDs tagged on servers or found in
+  VPC and private zone names.  The environments are deleted
+  concurrently, after a single combined report in dry-run and
+  ``--interactive`` modes.
+  '''
+  if args.interactive and not sys.stdin.isatty():
+    myotc.msg('Cannot ask for confirmation without a terminal, use -x instead\n')
+    sys.exit(2)
+
+  ypp.yaml_init(args.include,args.define)
+  def_priv_zone = ypp.vars(K.PRIVATE_DNS_ZONE, K.DEFAULT_PRIVATE_DNS_ZONE)
+  def_public_zone = ypp.vars(K.PUBLIC_DNS_ZONE)
+
+  c = myotc.connect(args)
+  myotc.msg('Loading inventory...')
+  inv = inventory.Inventory(c)
+  inv.load(nukes.KINDS)
+  sids = nukes.select(inv, args.sids, def_priv_zone)
+  parts = nukes.split(inv, sids)
+  records = nukes.split_records(c, inv, sids, def_public_zone)
+  myotc.msg('DONE\n')
+
+  if not args.older_than is None:
+    cutoff = time.time() - args.older_than * 86400
+    for sid in list(sids):
+      newest = nukes.newest(parts[sid])
+      if newest is None:
+        myotc.msg('Skipping {}: no servers to tell its age\n'.format(sid))
+      elif newest > cutoff:
+        myotc.msg('Skipping {}: created less than {:g} days ago\n'.format(sid, args.older_than))
+      else:
+        continue
+      sids.remove(sid)
+
+  if def_public_zone is None:
+    print('Not modifying Public DNS records (Missing PUBLIC_DNS_ZONE definition)')
+  envs = {}
+  for sid in sids:
+    tiers = nukes.targets(c, sid, def_priv_zone, def_public_zone, parts[sid], records[sid])
+    if nukes.count(tiers) == 0:
+      myotc.msg('Nothing to delete for {}\n'.format(sid))
+      continue
+    envs[sid] = tiers
+
+  if len(envs) == 0:
+    myotc.msg('Nothing to delete\n')
+    return
+  total = sum([nukes.count(tiers) for tiers in envs.values()])
+  if args.interactive or not args.execute:
+    for sid, tiers in envs.items():
+      print('# {sid}: {n} resources'.format(sid = sid, n = nukes.count(tiers)))
+      nukes.show(tiers)
+    print('# {n} resources in {e} environments'.format(n = total, e = len(envs)))
+    if not args.interactive: return
+    if not myotc.confirm('Delete these {n} resources of {e} environments?'.format(n = total, e = len(envs))):
+      myotc.msg('Cancelled\n')
+      return
+
+  results = nukes.execute_many(envs, args.jobs, args.procs)
+  for sid in envs:
+    print('{sid:20} {status}'.format(sid = sid, status = 'OK' if results[sid] else 'FAILED'))
+  failed = len([sid for sid in results if not results[sid]])
+  print('{} nuked, {} failed'.format(len(results) - failed, failed))
+  if failed: sys.exit(1)
+
+def orphans_cmd(args):
+  '''orphans command: find resources left behind by environments
+
+  :param namespace args: values from CLI parser
+
+  Each resource type is listed once and orphans are reported by
+  environment.  With ``-x`` or ``--interactive`` the orphans of the
+  SIDs given, or of all known SIDs with ``--all``, are deleted by the
+  nuke engine.  Orphans without a SID are never deleted.
+  '''
+  if (args.execute or args.interactive) and len(args.sids) == 0 and not args.all:
+    myotc.msg('Give the SIDs to delete orphans of, or use --all\n')
+    sys.exit(2)
+  if args.interactive and not sys.stdin.isatty():
+    myotc.msg('Cannot ask for confirmation without a terminal, use -x instead\n')
+    sys.exit(2)
+
+  ypp.yaml_init(args.include,args.define)
+  c = myotc.connect(args)
+  myotc.msg('Loading inventory...')
+  inv, ports, records = orphans.snapshot(c)
+  known = [p for p in args.sids if not any([ch in p for ch in '*?['])]
+  found = orphans.scan(c, inv, ports, records,
+                       ypp.vars(K.PRIVATE_DNS_ZONE, K.DEFAULT_PRIVATE_DNS_ZONE), known)
+  myotc.msg('DONE\n')
+  if len(args.sids):
+    found = [o for o in found if any([fnmatch.fnmatchcase(o[K.SID], p) for p in args.sids])]
+
+  if len(found) == 0:
+    myotc.msg('No orphans found\n')
+    return
+  orphans.show(found)
+  if not args.execute and not args.interactive: return
+  count = len([o for o in found if orphans.deletable(o)])
+  if count == 0:
+    myotc.msg('Nothing to delete\n')
+    return
+  if args.interactive:
+    if not myotc.confirm('Delete these {n} orphans?'.format(n = count)):
+      myotc.msg('Cancelled\n')
+      return
+
+  if not nukes.execute(orphans.tiers(found), args.jobs):
+    sys.exit(1)
 
 def ping_cmd(args):
   '''Check if things are configured properly
@@ -223,25 +698,31 @@ def state_cmd(args):
 
   :param namespace args: values from CLI parser
   '''
+  servers = None
+  ordered = False
   if 'cfgopts' in args:
     c = args.cfgopts[K.CONN]
     vmorder = [ args.cfgopts[K.NAME] ]
   else:
     c = myotc.connect(args)
+    servers = {}
+    for i in c.compute.servers():
+      if not K.NAME in i: continue
+      servers[i[K.NAME]] = i
     if 'file' in args and args.file:
       yc = ypp.process(args.file, args.include, args.define)
       vmorder = resolv_yaml(yc)
       if args.mode == K.stop: vmorder.reverse()
+      ordered = True
     else:
-      vmorder = []
-      for i in c.compute.servers():
-        if not K.NAME in i: continue
-        vmorder.append(i[K.NAME])
+      vmorder = list(servers)
 
       if len(args.name) == 0:
         print('Must provide a list of VMs')
         sys.exit(2)
 
+  w = waiter.get(c)
+  pending = []
   for vmname in vmorder:
     if 'name' in args and len(args.name):
       match = False
@@ -251,44 +732,64 @@ def state_cmd(args):
           break
       if not match: continue
 
-    srv = c.compute.find_server(vmname)
+    if servers is None:
+      srv = c.compute.find_server(vmname)
+      if not srv is None: srv = c.compute.get_server(srv)
+    else:
+      srv = servers.get(vmname)
     if srv is None:
       print('VM {vmname} not defined'.format(vmname=vmname))
       continue
-    srv = c.compute.get_server(srv)
     if not K.status in srv:
       print('Unable to determine VM status for {vmname}'.format(vmname=vmname))
       continue
     if args.mode == K.start:
       if srv[K.status] != K.ACTIVE:
-        myotc.msg('Starting vm {name}...'.format(name=vmname))
+        myotc.msg('Starting vm {name}...\n'.format(name=vmname))
         c.compute.start_server(srv)
-        srv = c.compute.wait_for_server(srv)
-        myotc.msg('DONE\n')
+        pending.append((vmname, w.server(srv)))
       else:
         myotc.msg('vm {} is already started\n'.format(vmname))
     elif args.mode == K.stop:
       if srv[K.status] != K.SHUTOFF:
-        myotc.msg('Stopping vm {name}...'.format(name=vmname))
+        myotc.msg('Stopping vm {name}...\n'.format(name=vmname))
         c.compute.stop_server(srv)
-        srv = c.compute.wait_for_server(srv,status=K.SHUTOFF)
-        myotc.msg('DONE\n')
+        pending.append((vmname, w.server(srv, status=K.SHUTOFF)))
       else:
         myotc.msg('vm {} is already stopped\n'.format(vmname))
     elif args.mode == K.reboot:
       if srv[K.status] == K.ACTIVE:
         if args.forced:
-          myotc.msg('HARD booting vm {name}...'.format(name=vmname))
+          myotc.msg('HARD booting vm {name}...\n'.format(name=vmname))
           c.compute.reboot_server(srv,K.HARD)
         else:
-          myotc.msg('SOFT booting vm {name}...'.format(name=vmname))
+          myotc.msg('SOFT booting vm {name}...\n'.format(name=vmname))
           c.compute.reboot_server(srv,K.SOFT)
-          srv = c.compute.wait_for_server(srv,status=K.REBOOT,wait=500)
-          srv = c.compute.wait_for_server(srv,status=K.ACTIVE)
-        myotc.msg('DONE\n')
+          pending.append((vmname, w.server(srv, status=K.REBOOT, wait=500)))
       else:
         myotc.msg('vm {} is not in an active state\n'.format(vmname))
 
+    # VMs from a YAML file are handled one at a time in dependancy order
+    if ordered: wait_state(c, args.mode, pending)
+
+  wait_state(c, args.mode, pending)
+
+def wait_state(c, mode, pending):
+  '''Wait for VM state changes to complete
+
+  :param openstack.connection c: OpenStack connection
+  :param str mode: one of ``start``, ``stop`` or ``reboot``
+  :param list pending: list of tuples ``(vmname, future)``.  It is emptied on return.
+  '''
+  import openstack
+  for vmname, fut in pending:
+    try:
+      srv = fut.result()
+      if mode == K.reboot: waiter.wait_for_server(c, srv, K.ACTIVE)
+      myotc.msg('vm {name} DONE\n'.format(name=vmname))
+    except openstack.exceptions.SDKException as e:
+      myotc.msg('vm {name} FAILED: {err}\n'.format(name=vmname, err=str(e)))
+  del pending[:]
 
 
 def new_vault(args):
@@ -12,12 +12,18 @@ should be translatable to localized strings.
 
 CLOUD = 'CLOUD'
 DEFAULT_CLOUD = 'otc'
+SIMULATOR = 'simulator'
 NAME = 'name'
 PROJECT = 'PROJECT'
 
 SID = 'SID'
 CONN = 'CONN'
 DRYRUN = 'DRYRUN'
+INVENTORY = 'INVENTORY'
+DNS_BATCH = 'DNS_BATCH'
+PLAN = 'PLAN'
+CATALOG = 'CATALOG'
+JOURNAL = 'JOURNAL'
 
 stop = 'stop'
 start = 'start'
@@ -57,6 +63,7 @@ original_name = 'original_name'
 created_at = 'created_at'
 launched_at = 'launched_at'
 updated_at = 'updated_at'
+tags = 'tags'
 vpc = 'vpc'
 key = 'key'
 public_key = 'public_key'
@@ -83,6 +90,7 @@ device = 'device'
 location = 'location'
 imglst_yaml = 'imglst.yaml'
 flavorlst_yaml = 'flavorlst.yaml'
+journal_fmt = 'deploy-{sid}.journal'
 security_group_rules = 'security_group_rules'
 rules = 'rules'
 image = 'image'
@@ -97,10 +105,19 @@ records = 'records'
 port_id = 'port_id'
 
 snat = 'snat'
+server = 'server'
+network = 'network'
+subnet = 'subnet'
+router = 'router'
+sg = 'sg'
+volume = 'volume'
+fip = 'fip'
 forced_net = 'forced_net'
 router_id = 'router_id'
 
 MYOTC_OPTS = 'MYOTC_OPTS'
+MYOTC_SOCKET = 'MYOTC_SOCKET'
+MYOTC_TOKEN_CACHE = 'MYOTC_TOKEN_CACHE'
 
 
 sn_size = 'sn_size'
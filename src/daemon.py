@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+'''
+Background daemon
+
+Starting ``myotc`` means importing the OpenStack SDK, reading
+``clouds.yaml``, authenticating and discovering service endpoints
+before anything useful is done.  The daemon does that once: it keeps
+its connections (one per cloud and project) with their tokens and
+discovered endpoints, and the image and flavor catalog of each
+connection, see ``catalog.get``.  Resource listings are not cached,
+other clients may change the project at any time, so every command
+still lists the resources it needs.
+
+The daemon listens on a Unix socket.  When it is running, the command
+line forwards the command to it and relays its output, otherwise the
+command is executed in-process as usual.  Commands are executed one at
+a time.
+
+The socket is created in ``XDG_RUNTIME_DIR``, or in a directory only
+the user can access under the temporary directory.  Clients only
+connect to a socket owned by the user, in a directory no one else can
+write to, and only forward the pre-processor variables the commands
+read from the environment, see ``ENV_NAMES``.  Other variables must be
+given with ``-D``.
+'''
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+import consts as K
+
+has_unix = hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+''' True if Unix sockets are supported '''
+
+ENV_NAMES = [ K.CLOUD, K.PROJECT, K.SID, K.PUBLIC_DNS_ZONE, K.PRIVATE_DNS_ZONE, K.CIDR_BLOCK, K.DEFAULT_IMAGE, K.DEFAULT_FLAVOR ]
+''' Environment variables forwarded to the daemon '''
+
+ENV_PREFIXES = ( 'API_', 'SIM_' )
+''' Prefixes of environment variables forwarded to the daemon, see ``ratelimit`` and ``simulator`` '''
+
+def socket_path():
+  ''' Path of the daemon socket
+
+  :returns str: socket path, from ``MYOTC_SOCKET`` if defined
+  '''
+  path = os.getenv(K.MYOTC_SOCKET)
+  if path: return path
+  rundir = os.getenv('XDG_RUNTIME_DIR')
+  if rundir and os.path.isdir(rundir): return os.path.join(rundir, 'myotc.sock')
+  return os.path.join(tempfile.gettempdir(), 'myotc-{}'.format(os.getuid()), 'myotc.sock')
+
+def owned(path, kind):
+  ''' Check that a file belongs to the current user
+
+  :param str path: file to check, symbolic links are not followed
+  :param callable kind: file type test, e.g. ``stat.S_ISSOCK``
+  :returns bool: True if ``path`` is of that type, owned by the current user and not writable by others
+  '''
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return False
+  return kind(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+def trusted(path):
+  ''' Check that a daemon socket was created by the current user
+
+  :param str path: socket path
+  :returns bool: True if the socket and its directory belong to the current user
+  '''
+  return owned(os.path.dirname(os.path.abspath(path)), stat.S_ISDIR) and owned(path, stat.S_ISSOCK)
+
+def open_socket():
+  ''' Connect to a running daemon
+
+  :returns None|socket: connected socket, or None if the daemon is not running
+  '''
+  if not has_unix: return None
+  path = socket_path()
+  if not os.path.lexists(path): return None
+  if not trusted(path):
+    sys.stderr.write('Ignoring daemon socket {}: not private to this user\n'.format(path))
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except OSError:
+    sock.close()
+    return None
+  return sock
+
+def client_env():
+  ''' Environment variables read by the commands
+
+  :returns dict: variables to forward, see ``ENV_NAMES`` and ``ENV_PREFIXES``
+  '''
+  return { k: v for k, v in os.environ.items() if k in ENV_NAMES or k.startswith(ENV_PREFIXES) }
+
+def forward(argv):
+  ''' Run a command in the daemon
+
+  :param list argv: command line arguments
+  :returns None|int: exit code, or None if the daemon is not running
+  '''
+  sock = open_socket()
+  if sock is None: return None
+  with sock:
+    req = { 'argv': argv, 'cwd': os.getcwd(), 'env': client_env() }
+    sock.sendall((json.dumps(req) + '\n').encode('utf-8'))
+    for line in sock.makefile('r', encoding = 'utf-8'):
+      res = json.loads(line)
+      if 'exit' in res: return res['exit']
+      out = sys.stdout if res['fd'] == 1 else sys.stderr
+      out.write(res['data'])
+      out.flush()
+  sys.stderr.write('Lost connection to daemon\n')
+  return 1
+
+class Stream:
+  ''' File-like object sending output back to the client
+
+  :param file wfile: socket file
+  :param int fd: 1 for stdout, 2 for stderr
+  :param threading.Lock lock: lock shared by the streams of a client
+  '''
+  def __init__(self, wfile, fd, lock):
+    self.wfile = wfile
+    self.fd = fd
+    self.lock = lock
+
+  def write(self, data):
+    if data == '': return 0
+    with self.lock:
+      self.wfile.write((json.dumps({ 'fd': self.fd, 'data': data }) + '\n').encode('utf-8'))
+      self.wfile.flush()
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+def run(argv, cwd, env):
+  ''' Execute a command line in the daemon
+
+  :param list argv: command line arguments
+  :param str cwd: client working directory
+  :param dict env: client environment
+  :returns int: exit code
+  '''
+  import cli
+  import ypp
+  import myotc
+
+  # Start every command from a clean pre-processor state...
+  ypp.yaml_pp_vars.clear()
+  ypp.yaml_pp_vars.update(env)
+  del ypp.yaml_include_path[:]
+  # ... but keep the connections opened so far
+  myotc.settings.connection = None
+
+  saved = os.getcwd()
+  os.chdir(cwd)
+  try:
+    args = cli.parser().parse_args(argv)
+    if not 'func' in args:
+      cli.parser().print_help()
+      return 0
+    args.func(args)
+  except SystemExit as e:
+    if e.code is None: return 0
+    return e.code if isinstance(e.code, int) else 1
+  except Exception:
+    traceback.print_exc()
+    return 1
+  finally:
+    myotc.msg_flush()
+    os.chdir(saved)
+  return 0
+
+class Handler(socketserver.StreamRequestHandler):
+  ''' Handle a client request '''
+  def handle(self):
+    req = json.loads(self.rfile.readline())
+    if req.get('stop'):
+      self.wfile.write((json.dumps({ 'exit': 0 }) + '\n').encode('utf-8'))
+      threading.Thread(target = self.server.shutdown).start()
+      return
+
+    lock = threading.Lock()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = Stream(self.wfile, 1, lock)
+    sys.stderr = Stream(self.wfile, 2, lock)
+    try:
+      code = run(req['argv'], req['cwd'], req['env'])
+    finally:
+      sys.stdout, sys.stderr = stdout, stderr
+    self.wfile.write((json.dumps({ 'exit': code }) + '\n').encode('utf-8'))
+
+def forwardable(args):
+  ''' Check if a command can be forwarded to the daemon
+
+  :param namespace args: values from CLI parser
+  :returns bool: True if the command may run in the daemon
+  '''
+  if args.local or args.debug or args.autocfg: return False
+  if args.profile_api or args.profile_json: return False
+  # Confirmation prompts need the client terminal
+  if getattr(args, 'interactive', False): return False
+  return not getattr(args.func, 'local', False)
+
+def local(fn):
+  ''' Mark a command as never forwarded to the daemon
+
+  :param callable fn: command function
+  :returns callable: ``fn``
+  '''
+  fn.local = True
+  return fn
+
+@local
+def daemon_cmd(args):
+  '''daemon command: run or stop the background daemon
+
+  :param namespace args: values from CLI parser
+  '''
+  if not has_unix:
+    sys.stderr.write('Unix sockets are not supported on this platform\n')
+    sys.exit(1)
+  path = socket_path()
+  sockdir = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(sockdir): os.makedirs(sockdir, mode = 0o700)
+  if not owned(sockdir, stat.S_ISDIR):
+    sys.stderr.write('{} must belong to this user and not be writable by others\n'.format(sockdir))
+    sys.exit(1)
+
+  sock = open_socket()
+  if args.stop:
+    if sock is None:
+      sys.stderr.write('Daemon is not running\n')
+      sys.exit(1)
+    with sock:
+      sock.sendall((json.dumps({ 'stop': True }) + '\n').encode('utf-8'))
+      sock.recv(1024)
+    return
+  if not sock is None:
+    sock.close()
+    sys.stderr.write('Daemon already running on {}\n'.format(path))
+    sys.exit(1)
+  if os.path.lexists(path): os.unlink(path) # Stale socket
+
+  umask = os.umask(0o077)
+  try:
+    server = socketserver.UnixStreamServer(path, Handler)
+  finally:
+    os.umask(umask)
+  sys.stderr.write('Listening on {}\n'.format(path))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    if os.path.exists(path): os.unlink(path)
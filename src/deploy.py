@@ -8,32 +8,51 @@ import base64
 import consts as K
 import myotc
 import ipv4addr
-import time
+import waiter
+import plans
+import specdiff
 
 
 SG_KEYS = ('remote_ip_prefix', 'protocol', 'port_range_min', 'port_range_max' )
-SG_COPYKEYS = ('remote_ip_prefix', 'protocol', 'port_range_min', 'port_range_max', 'ethertype', 'remote_ip_prefix' )
+SG_RULE_KEYS = ('direction', 'ethertype', 'protocol', 'port_range_min', 'port_range_max', 'remote_ip_prefix' )
 
-def find_volume(c, vname):
+def find_volume(opts, vname, fetch = False):
   ''' Find volume
 
-  :param openstack.connection c: OpenStack connection
-  :param str vname: Resource name
+  :param dict opts: session options
+  :param str vname: Resource name or id
+  :param bool fetch: (optional) if True, get volumes missing from the index by id
   :returns None|openstack.volume: None if error else volume instance
-  '''
 
-  for v in c.block_store.volumes():
-    if 'name' in v:
-      if v['name'] == vname: return v
-    if 'id' in v:
-      if v['id'] == vname: return v
+  Volumes are looked up in the session inventory, which is indexed
+  by name and by id.  Volumes created outside of this module (e.g.
+  boot volumes) can be retrieved with ``fetch``.
+  '''
+  inv = opts[K.INVENTORY]
+  v = inv.find(K.volume, vname)
+  if v is None and fetch:
+    v = opts[K.CONN].block_store.get_volume(vname)
+    if not v is None: inv.add(K.volume, v)
+  return v
+
+def volume_device(vol, server_id):
+  ''' Find the device a volume is attached as
+
+  :param openstack.volume vol: volume instance
+  :param str server_id: id of the server the volume is attached to
+  :returns None|str: device name
+  '''
+  if not K.attachments in vol or not isinstance(vol[K.attachments],list): return None
+  for att in vol[K.attachments]:
+    if att.get(K.server_id) == server_id: return att.get(K.device)
   return None
 
-def new_vol(vol_name, opts, **kw):
+def new_vol(vol_name, opts, wait = True, **kw):
   ''' Deploy new volume
 
   :param str vol_name: name of volume
   :param dict opts: session options
+  :param bool wait: (optional) if False, do not wait for a new volume to become available
   :param kwargs kw: dict for incoming keywoard arguments, containing VM attributes
   :returns None|instance: Returns None on error, volume instance on success
 
@@ -42,47 +61,131 @@ def new_vol(vol_name, opts, **kw):
   c = opts[K.CONN]
   sid = opts[K.SID]
   dryrun = opts[K.DRYRUN]
+  inv = opts[K.INVENTORY]
 
-  cvol = find_volume(c, vol_name)
+  cvol = find_volume(opts, vol_name)
   if cvol is None:
     # Make sure size is there...
     if not 'size' in kw:
-      print('Unable to create volume {}. "size" not specified'.format(vol_name))
+      myotc.out('Unable to create volume {}. "size" not specified'.format(vol_name))
       return None
 
-    myotc.msg('Creating volume {}...'.format(vol_name))
-    cvol = c.block_store.create_volume(name=vol_name, **kw)
-    c.block_store.wait_for_status(cvol,
-                                  status='available',
-                                  failures=['error'],
-                                  interval=5,
-
-                                  wait=120)
-    myotc.msg('DONE\n')
+    cvol = plans.act(opts, 'create_volume', name=vol_name, wait=wait, **kw)
   else:
     if cvol['size'] != kw['size']:
       # Volume has been resized...
       if int(kw['size']) < int(cvol['size']):
-        print('Not possible to reduce size of volume {}'.format(vol_name))
+        myotc.out('Not possible to reduce size of volume {}'.format(vol_name))
         return cvol
-      myotc.msg('Resizing volume {}...'.format(vol_name))
-      cvol.extend(c.block_store, int(kw['size']))
-      myotc.msg('DONE\n')
+      cvol = plans.act(opts, 'extend_volume', id=cvol['id'], name=vol_name, size=int(kw['size']))
+  return cvol
+
+@plans.op('create_volume', K.volume)
+def create_volume(c, name, wait = True, **kw):
+  ''' Create a volume and wait for it to become available
+
+  :param openstack.connection c: OpenStack connection
+  :param str name: volume name
+  :param bool wait: (optional) if False, return without waiting
+  :param kwargs kw: volume attributes
+  :returns openstack.volume: new volume
+  '''
+  myotc.msg('Creating volume {}...'.format(name))
+  cvol = c.block_store.create_volume(name=name, **kw)
+  if wait: cvol = waiter.wait_for_volume(c, cvol, 'available')
+  myotc.msg('DONE\n')
+  return cvol
+
+@plans.op('extend_volume', K.volume)
+def extend_volume(c, id, name, size):
+  ''' Extend a volume
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: volume id
+  :param str name: volume name, used for messages
+  :param int size: new size
+  :returns openstack.volume: updated volume
+  '''
+  myotc.msg('Resizing volume {} to {}...'.format(name, size))
+  c.block_store.extend_volume(id, size)
+  cvol = c.block_store.get_volume(id)
+  myotc.msg('DONE\n')
   return cvol
 
-def flatten_rules(rule_lst):
-  ''' Convert list of Security Group rules to a string
+def rule_key(rule):
+  ''' Canonical representation of a Security Group rule
+
+  :param dict rule: Security group rule
+  :returns str: ``specdiff.spec_hash`` of the ``SG_RULE_KEYS`` fields of ``rule``
+
+  Rules that are equivalent for Neutron yield the same key, so
+  rule sets can be compared using set operations.
+  '''
+  key = {}
+  for k in SG_RULE_KEYS:
+    v = rule[k] if k in rule else None
+    if k in ('port_range_min', 'port_range_max'):
+      if not v is None: v = int(v)
+    elif isinstance(v, str):
+      v = v.lower() if k != 'ethertype' else v
+    key[k] = v
+  return specdiff.spec_hash(key)
+
+def add_rules(c, sg_id, rules):
+  ''' Add rules to a Security Group
+
+  :param openstack.connection c: OpenStack connection
+  :param str sg_id: Security group id
+  :param list rules: list of rules to add
+
+  Rules are created with a single bulk request.  If that is not
+  supported, rules are created one at a time.
+  '''
+  import openstack
+  data = []
+  for rule in rules:
+    rule = dict(rule)
+    rule['security_group_id'] = sg_id
+    data.append(rule)
+  if len(data) > 1 and hasattr(c.network, 'create_security_group_rules'):
+    try:
+      list(c.network.create_security_group_rules(data))
+      return
+    except openstack.exceptions.HttpException:
+      pass # Bulk create not supported, fall back to one by one...
+  for rule in data:
+    c.network.create_security_group_rule(**rule)
+
+@plans.op('create_sg', K.sg)
+def create_sg(c, name):
+  ''' Create an empty Security Group
 
-  :param list rule_list: list of rules to be flatten
-  :returns str: string represetnation of ``rule_list``.
+  :param openstack.connection c: OpenStack connection
+  :param str name: Security group name
+  :returns security-group-instance: new security group
+  '''
+  myotc.msg('Creating SG {}...'.format(name))
+  sg = c.network.create_security_group(name = name)
+  myotc.msg('DONE\n')
+  return sg
 
-  Convert ``rule_list`` to a ``str`` so we can easily compare it.
+@plans.op('update_sg_rules', K.sg)
+def update_sg_rules(c, id, name, delete, add):
+  ''' Update Security Group rules
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: Security group id
+  :param str name: Security group name, used for messages
+  :param list delete: ids of rules to delete
+  :param list add: rules to add
+  :returns security-group-instance: updated security group
   '''
-  ol = []
-  for i in rule_lst:
-    ol.append(yaml.dump(i))
-  ol.sort()
-  return yaml.dump(ol)
+  myotc.msg('SG {sgname} updating rules...'.format(sgname=name))
+  for rid in delete:
+    c.network.delete_security_group_rule(rid)
+  if len(add): add_rules(c, id, add)
+  myotc.msg('Rules removed: {rm}, added: {add}\n'.format(rm=len(delete), add=len(add)))
+  return c.network.get_security_group(id)
 
 def new_sg(sg_name, rule_list, opts):
   ''' Create Security Group
@@ -95,6 +198,7 @@ def new_sg(sg_name, rule_list, opts):
   c = opts[K.CONN]
   sid = opts[K.SID]
   dryrun = opts[K.DRYRUN]
+  inv = opts[K.INVENTORY]
 
   # Convert rules
   # NOTE: We only support ingress rules!
@@ -131,59 +235,33 @@ def new_sg(sg_name, rule_list, opts):
           rule[k] = None
     rules.append(rule)
 
-  sg = c.network.find_security_group(sg_name)
+  want = {}
+  for rule in rules:
+    want[rule_key(rule)] = rule
+
+  sg = inv.find(K.sg, sg_name)
   if sg:
-    # Pre-process existing ruleset so we can compare it later
-    oldrules = []
+    have = {}
     for osr in sg['security_group_rules']:
       if osr['direction'] != 'ingress': continue # we only know how to deal with ingress rules
-      ccr = {
-        'direction': 'ingress',
-      }
-      for k in SG_COPYKEYS:
-        if k in osr:
-          ccr[k] = osr[k]
-        else:
-          ccr[k] = None
-      oldrules.append(ccr)
+      have[rule_key(osr)] = osr
 
-    # stringify rulesets so we can easilty compare them
-    if flatten_rules(oldrules) == flatten_rules(rules):
+    old_rules = [have[k] for k in have if not k in want]
+    new_rules = [want[k] for k in want if not k in have]
+    if len(old_rules) == 0 and len(new_rules) == 0:
       # No changes needed!
       return sg
-    else:
-      # ~ print('OLD RULES====')
-      # ~ print(flatten_rules(oldrules))
-      # ~ print('NEW RULES====')
-      # ~ print(flatten_rules(rules))
 
-      if dryrun:
-        print('WONT update rules in security group {sg}'.format(sg=sg_name))
-        return sg
-
-      # Get rid of the old rule set
-      cnt = 0
-      myotc.msg('Flusing SG {sgname}...'.format(sgname=sg_name))
-      for osr in sg['security_group_rules']:
-        if osr['direction'] != 'ingress': continue # we only know how to deal with ingress rules
-        c.network.delete_security_group_rule(osr)
-        cnt += 1
-      myotc.msg('Rules flushed: {count}'.format(count=cnt))
-  else:
-    myotc.msg('Creating SG {}...'.format(sg_name))
-    sg = c.network.create_security_group(name = sg_name)
-    myotc.msg('DONE\n')
+    if dryrun:
+      myotc.out('WONT update rules in security group {sg} (+{add}/-{rm})'.format(sg=sg_name,add=len(new_rules),rm=len(old_rules)))
+      return sg
 
-  myotc.msg('SG {sgname} adding rules...'.format(sgname=sg_name))
-  cnt = 0
-  for rule in rules:
-    rule['security_group_id'] = sg.id
-    # ~ print(rule)
-    c.network.create_security_group_rule(**rule)
-    cnt += 1
-  myotc.msg('Rules added: {count}\n'.format(sgname=sg_name, count=cnt))
+    return plans.act(opts, 'update_sg_rules', id=sg['id'], name=sg_name,
+                     delete=[osr['id'] for osr in old_rules], add=new_rules)
 
-  return sg
+  sg = plans.act(opts, 'create_sg', name=sg_name)
+  return plans.act(opts, 'update_sg_rules', id=sg['id'], name=sg_name,
+                   delete=[], add=list(want.values()))
 
 def new_vpc(opts, **attrs):
   ''' Create a new VPC
@@ -201,29 +279,24 @@ def new_vpc(opts, **attrs):
   c = opts[K.CONN]
   sid = opts[K.SID]
   dryrun = opts[K.DRYRUN]
+  inv = opts[K.INVENTORY]
 
   vpcname = '{}-vpc1'.format(sid)
 
+  if K.snat in attrs:
+    snat = attrs[K.snat]
+  else:
+    snat = True
+
   if K.USE_OTC_API: # Using OTC Extensions
-    vpc = c.vpc.find_vpc(vpcname, ignore_missing = True)
+    vpc = inv.find(K.vpc, vpcname)
     if not vpc:
-      myotc.msg('Creating vpc(OTCExt API) {}...'.format(vpcname))
       apiargs = { 'name': vpcname }
       for k in ('description', 'cidr'):
         if k in attrs: apiargs[k] = attrs[k]
       if not 'cidr' in apiargs:
         apiargs['cidr'] = opts[K.CIDR_BLOCK]
-      
-      vpc = c.vpc.create_vpc(**apiargs)
-
-      if K.snat in attrs:
-        snat = attrs[K.snat]
-      else:
-        snat = True
-
-      vpc = c.vpc.update_vpc(vpc = vpc,
-                              enable_shared_snat = snat)
-      myotc.msg('DONE\n')
+      vpc = plans.act(opts, 'create_vpc', snat=snat, **apiargs)
     else:
       apiargs = {}
       for k in ('description','cidr','snat'):
@@ -231,89 +304,135 @@ def new_vpc(opts, **attrs):
         if not k in attrs: continue
         if attrs[k] != vpc[api]: apiargs[api] = attrs[k]
       if len(apiargs) > 0:
-        myotc.msg('vpc {} changing settings...'.format(vpcname))
-        vpc = c.vpc.update_vpc(vpc = vpc, **apiargs)
-        myotc.msg('DONE\n')
+        if dryrun:
+          myotc.out('vpc {} needs to change settings: {}'.format(vpcname,str(apiargs)))
+        else:
+          vpc = plans.act(opts, 'update_vpc', id=vpc['id'], name=vpcname, **apiargs)
       
   else:  
-    vpc = c.network.find_router(vpcname)
+    vpc = inv.find(K.router, vpcname)
     if not vpc:
-      myotc.msg('Creating vpc(Router API) {}...'.format(vpcname))
-      vpc = c.network.create_router(name=vpcname)
-
-      if K.snat in attrs:
-        snat = attrs[K.snat]
-      else:
-        snat = True
-
-      vpc = c.network.update_router(vpc.id,
-          external_gateway_info = {
-            'enable_snat': snat,
-            'network_id': vpc['external_gateway_info']['network_id']
-          }
-      )
-      # ~ vpc = c.network.update_router(vpc.id,tags=['X=Y'])
-      # tags, routes, location
-      myotc.msg('DONE\n')
+      vpc = plans.act(opts, 'create_router', name=vpcname, snat=snat)
     else:
       if K.snat in attrs:
         snat = bool(attrs[K.snat])
         if bool(vpc['external_gateway_info']['enable_snat']) != snat:
           if dryrun:
-            print('vpc {} needs to change snat setting to {}'.format(vpcname,snat))
+            myotc.out('vpc {} needs to change snat setting to {}'.format(vpcname,snat))
           else:
-            myotc.msg('vpc {} changing snat setting to {}...'.format(vpcname,snat))
-
-            vpc = c.network.update_router(vpc.id,
+            vpc = plans.act(opts, 'update_router', id=vpc['id'], name=vpcname,
                 external_gateway_info = {
                   'enable_snat': snat,
                   'network_id': vpc['external_gateway_info']['network_id']
                 }
             )
-            myotc.msg('DONE\n')
 
   # Always create an internal dnz zone
   if K.PRIVATE_DNS_ZONE in opts and not opts[K.PRIVATE_DNS_ZONE] is None:
     zname = '{}.{}'.format(sid,opts[K.PRIVATE_DNS_ZONE])
-    idnsz = c.dns.find_zone(myotc.sanitize_dns_name(zname),zone_type=K.private)
+    idnsz = find_zone(opts, zname, K.private)
     if not idnsz:
-      myotc.msg('Creating internal DNS zone {}...'.format(zname))
-      idnsz = c.dns.create_zone(
-        name=zname,
-        router = { K.router_id: vpc.id },
-        zone_type=K.private
-      )
-      myotc.msg('DONE\n')
+      plans.act(opts, 'create_zone', name=zname, router_id=vpc['id'])
   else:
-    print('No PRIVATE_DNS_ZONE defined')
+    myotc.out('No PRIVATE_DNS_ZONE defined')
+  return vpc
+
+@plans.op('create_vpc', K.vpc)
+def create_vpc(c, name, snat, **attrs):
+  ''' Create a VPC using the OTC extensions API
+
+  :param openstack.connection c: OpenStack connection
+  :param str name: VPC name
+  :param bool snat: Enable Source NAT
+  :param kwargs attrs: VPC attributes
+  :returns vpc-instance: new VPC
+  '''
+  myotc.msg('Creating vpc(OTCExt API) {}...'.format(name))
+  vpc = c.vpc.create_vpc(name = name, **attrs)
+  vpc = c.vpc.update_vpc(vpc = vpc,
+                          enable_shared_snat = snat)
+  myotc.msg('DONE\n')
+  return vpc
+
+@plans.op('update_vpc', K.vpc)
+def update_vpc(c, id, name, **attrs):
+  ''' Update VPC settings using the OTC extensions API
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: VPC id
+  :param str name: VPC name, used for messages
+  :param kwargs attrs: VPC attributes to change
+  :returns vpc-instance: updated VPC
+  '''
+  myotc.msg('vpc {} changing settings...'.format(name))
+  vpc = c.vpc.update_vpc(vpc = id, **attrs)
+  myotc.msg('DONE\n')
   return vpc
 
-def flatten_rs(lst):
-  ''' Flatten DNS resource records
+@plans.op('create_router', K.router)
+def create_router(c, name, snat):
+  ''' Create a VPC using the Router API
 
-  :param list lst: Resource record list
+  :param openstack.connection c: OpenStack connection
+  :param str name: VPC name
+  :param bool snat: Enable Source NAT
+  :returns router-instance: new router
+  '''
+  myotc.msg('Creating vpc(Router API) {}...'.format(name))
+  vpc = c.network.create_router(name=name)
+  vpc = c.network.update_router(vpc.id,
+      external_gateway_info = {
+        'enable_snat': snat,
+        'network_id': vpc['external_gateway_info']['network_id']
+      }
+  )
+  # ~ vpc = c.network.update_router(vpc.id,tags=['X=Y'])
+  # tags, routes, location
+  myotc.msg('DONE\n')
+  return vpc
 
-  Flatten DNS record sets so that it can be compared
+@plans.op('update_router', K.router)
+def update_router(c, id, name, **attrs):
+  ''' Update VPC settings using the Router API
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: router id
+  :param str name: VPC name, used for messages
+  :param kwargs attrs: router attributes to change
+  :returns router-instance: updated router
   '''
-  r = list(lst)
-  r.sort()
-  return yaml.dump(r)
+  myotc.msg('vpc {} changing settings...'.format(name))
+  vpc = c.network.update_router(id, **attrs)
+  myotc.msg('DONE\n')
+  return vpc
 
-def find_rrs(zn,rtype,name, c):
-  ''' Find DNS Resource Records
+@plans.op('create_zone', K.private)
+def create_zone(c, name, router_id):
+  ''' Create an internal DNS zone
 
-  :param openstack.dnszone zn: OpenStack DNS Zone to query
-  :param str rtype: Resource type being queried
-  :param str name: Resource name
   :param openstack.connection c: OpenStack connection
-  :returns None|RecordSet: None if error, list of resource record sets
+  :param str name: zone name
+  :param str router_id: id of the VPC the zone is attached to
+  :returns openstack.dnszone: new zone
   '''
+  myotc.msg('Creating internal DNS zone {}...'.format(name))
+  idnsz = c.dns.create_zone(
+    name=name,
+    router = { K.router_id: router_id },
+    zone_type=K.private
+  )
+  myotc.msg('DONE\n')
+  return idnsz
+
+def find_zone(opts, zname, zone_type):
+  ''' Find DNS zone
 
-  for rs in c.dns.recordsets(zn):
-    if ('name' in rs) and ('type' in rs):
-      if rs['name'] == name and rs['type'] == rtype:
-        return rs
-  return None
+  :param dict opts: session options
+  :param str zname: zone name
+  :param str zone_type: Set to 'private' or 'public'
+  :returns None|openstack.dnszone: the zone if found
+  '''
+  return opts[K.INVENTORY].find(zone_type, myotc.sanitize_dns_name(zname))
 
 def del_dns(zname, zone_type, bsname, rtype, opts):
   ''' Delete DNS records
@@ -324,22 +443,9 @@ def del_dns(zname, zone_type, bsname, rtype, opts):
   :param str rtype: DNS record type, e.g. ``A`` or ``CNAME`` or ``AAAA``, etc.
   :param dict opts: session options
 
+  The deletion is queued in the session DNS batch.
   '''
-  c = opts[K.CONN]
-  dryrun = opts[K.DRYRUN]
-
-  dnszn = c.dns.find_zone(myotc.sanitize_dns_name(zname),zone_type=zone_type)
-  if not dnszn: return
-  name = '{}.{}'.format(bsname,myotc.sanitize_dns_name(zname))
-
-  cset = find_rrs(dnszn, rtype, name)
-  if cset:
-    if dryrun:
-      print('WONT update DNS {type} record for {name}'.format(type=rtype,name=name))
-    else:
-      myotc.msg('Deleting DNS {type} record for {name}...'.format(type=rtype,name=name))
-      c.dns.delete_recordset(cset,dnszn)
-      myotc.msg('DONE\n')
+  new_dns(zname, zone_type, bsname, rtype, [], opts)
 
 def new_dns(zname, zone_type, bsname, rtype, rrs, opts):
   ''' Create DNS records
@@ -348,41 +454,24 @@ def new_dns(zname, zone_type, bsname, rtype, rrs, opts):
   :param str zone_type: Set to 'private' or 'public'
   :param bsname: DNS record name
   :param str rtype: DNS record type, e.g. ``A`` or ``CNAME`` or ``AAAA``, etc.
-  :param list rrs: list of records
+  :param list rrs: list of records.  An empty list deletes the records.
   :param dict opts: session options
 
+  Records are queued in the session DNS batch, and applied by
+  ``apply_dns``.
   '''
-  c = opts[K.CONN]
-  dryrun = opts[K.DRYRUN]
-
-  dnszn = c.dns.find_zone(myotc.sanitize_dns_name(zname),zone_type=zone_type)
+  dnszn = find_zone(opts, zname, zone_type)
   if not dnszn: return
   name = '{}.{}'.format(bsname,myotc.sanitize_dns_name(zname))
+  opts[K.DNS_BATCH].want(dnszn, name, rtype, rrs)
 
-  cset = find_rrs(dnszn, rtype, name, c)
-  if cset:
-    if len(rrs):
-      if flatten_rs(cset['records']) != flatten_rs(rrs):
-        # So record changed
-        if dryrun:
-          print('WONT update DNS {type} record for {name}'.format(type=rtype,name=name))
-        else:
-          myotc.msg('Updating DNS {type} record for {name}...'.format(type=rtype,name=name))
-          c.dns.delete_recordset(cset,dnszn)
-          c.dns.create_recordset(dnszn, name=name, type = rtype, records = rrs)
-          myotc.msg('DONE\n')
-    else:
-      if dryrun:
-        print('WONT delete DNS {type} record for {name}'.format(type=rtype,name=name))
-      else:
-        myotc.msg('Deleting DNS {type} record for {name}...'.format(type=rtype,name=name))
-        c.dns.delete_recordset(cset,dnszn)
-        myotc.msg('DONE\n')
-  else:
-    if len(rrs):
-      myotc.msg('Creating DNS {type} record for {name}...'.format(type=rtype,name=name))
-      c.dns.create_recordset(dnszn, name=name, type = rtype, records = rrs)
-      myotc.msg('DONE\n')
+def apply_dns(opts):
+  ''' Apply queued DNS record changes
+
+  :param dict opts: session options
+  :returns dict: number of changes, indexed by operation
+  '''
+  return opts[K.DNS_BATCH].apply(opts)
 
 
 def new_net(id_or_name, opts, **attrs):
@@ -397,16 +486,15 @@ def new_net(id_or_name, opts, **attrs):
   c = opts[K.CONN]
   sid = opts[K.SID]
   dryrun = opts[K.DRYRUN]
+  inv = opts[K.INVENTORY]
   prefix = sid + '-'
 
   name = myotc.gen_name(id_or_name, 'sn', sid)
 
   netname = '{}net'.format(name)
-  net = c.network.find_network(netname)
+  net = inv.find(K.network, netname)
   if not net:
-    myotc.msg('Creating network {}...'.format(netname))
-    net = c.network.create_network(name = netname)
-    myotc.msg('DONE\n')
+    net = plans.act(opts, 'create_network', name = netname)
 
   if 'vpc' in attrs:
     vpcname = attrs['vpc']
@@ -414,15 +502,15 @@ def new_net(id_or_name, opts, **attrs):
     vpcname = '{}-vpc1'.format(sid)
 
   if K.USE_OTC_API:
-    vpc = c.vpc.find_vpc(vpcname)
+    vpc = inv.find(K.vpc, vpcname)
   else:
-    vpc = c.network.find_router(vpcname)
+    vpc = inv.find(K.router, vpcname)
 
   if not vpc:
-    print('Error: unable to create net {net}.  Missing vpc {vpc}'.format(net=name, vpc=vpcname))
+    myotc.out('Error: unable to create net {net}.  Missing vpc {vpc}'.format(net=name, vpc=vpcname))
     return None
 
-  snx = c.network.find_subnet(name)
+  snx = inv.find(K.subnet, name)
   if not snx:
     if not 'cidr' in attrs:
       if isinstance(id_or_name,int):
@@ -433,9 +521,9 @@ def new_net(id_or_name, opts, **attrs):
 
         snsize = 8 if not K.sn_size in attrs else attrs[K.sn_size]
         cidr = '{net_id}/{prefix}'.format(net_id = vcidr.host_ip(id_or_name << snsize), prefix = 32 - snsize)        
-        print('Subnet {snet} Using CIDR: {cidr}'.format(snet=name,cidr=cidr))
+        myotc.out('Subnet {snet} Using CIDR: {cidr}'.format(snet=name,cidr=cidr))
       else:
-        print('new_net(snid={snid}): must specify CIDR'.format(snid = id_or_name))
+        myotc.out('new_net(snid={snid}): must specify CIDR'.format(snid = id_or_name))
         return None
     else:
       cidr = attrs['cidr']
@@ -451,60 +539,111 @@ def new_net(id_or_name, opts, **attrs):
     if 'dhcp' in attrs: args['is_dhcp_enabled'] = bool(attrs['dhcp'])
     if 'dns_servers' in attrs: args['dns_nameservers'] = attrs['dns_servers']
 
-    myotc.msg('Creating subnet {}...'.format(name))
-    snx = c.network.create_subnet(**args)
-
-    if K.USE_OTC_API:    
-      myotc.msg('connecting to vpc {}...'.format(vpcname))
-      # OK... for some reason, the find_router doesn't the VPC
-      vrouter = None
-      count = 0
-      while vrouter is None and count < 60:
-        count +=1
-        vrouter = c.network.find_router(vpcname)
-        if vrouter is None: 
-          # Manually find it!
-          r = c.network.routers()
-          for x in r:
-            if x.name == vpcname:
-              vrouter = x
-              break
-          if vrouter is None:
-            myotc.msg('_')
-            time.sleep(1)
-
-      c.network.add_interface_to_router(vrouter, snx.id)
-      myotc.msg('DONE\n')
-    else:
-      myotc.msg('connecting to vpc {}...'.format(vpcname))
-      c.network.add_interface_to_router(vpc, snx.id)
-      myotc.msg('DONE\n')
+    snx = plans.act(opts, 'create_subnet', **args)
+    connect_subnet(opts, snx, vpc, vpcname)
 
   else:
+    journal = opts.get(K.JOURNAL)
+    if not journal is None and journal.done('create_subnet', { K.NAME: name }) and not journal.done('attach_subnet', { K.NAME: name }):
+      # A previous run was interrupted before connecting the subnet
+      connect_subnet(opts, snx, vpc, vpcname)
+
     args = {}
     if 'cidr' in attrs:
       if snx['cidr'] != attrs['cidr']:
         # args['cidr'] = attrs['cidr']
-        print('subnet {name} cannot change CIDR on-line to {new} (was {old})'.format(name=name,new=attrs['cidr'],old=snx['cidr']))
+        myotc.out('subnet {name} cannot change CIDR on-line to {new} (was {old})'.format(name=name,new=attrs['cidr'],old=snx['cidr']))
     if 'dhcp' in attrs:
       if bool(snx['is_dhcp_enabled']) != bool(attrs['dhcp']):
         # args['is_dhcp_enabled'] = bool(attrs['dhcp'])
-        print('subnet {name} cannot change DHCP on-line to {new} (was {old})'.format(name=name,new=attrs['dhcp'],old=snx['is_dhcp_enabled']))
+        myotc.out('subnet {name} cannot change DHCP on-line to {new} (was {old})'.format(name=name,new=attrs['dhcp'],old=snx['is_dhcp_enabled']))
     if 'dns_servers' in attrs:
-      if yaml.dump(snx['dns_nameservers']) != yaml.dump(attrs['dns_servers']):
+      if not specdiff.same(attrs['dns_servers'], snx['dns_nameservers']):
         args['dns_nameservers'] = attrs['dns_servers']
     if len(args) > 0:
         if dryrun:
-          print('subnet {} needs to reconfiguration:'.format(name))
-          print(args)
+          myotc.out('subnet {} needs to reconfiguration:'.format(name))
+          myotc.out(specdiff.describe(specdiff.diff(args, { 'dns_nameservers': snx['dns_nameservers'] })))
         else:
-          myotc.msg('Updating subnet {}:\n'.format(name))
-          print(args)
-          c.network.update_subnet(snx,**args)
-          myotc.msg('DONE\n')
+          plans.act(opts, 'update_subnet', id=snx['id'], name=name, **args)
 
   return net
 
+def connect_subnet(opts, snx, vpc, vpcname):
+  ''' Connect a subnet to its VPC
+
+  :param dict opts: session options
+  :param subnet-instance snx: subnet
+  :param vpc-instance|router-instance vpc: VPC
+  :param str vpcname: VPC name
+  '''
+  if K.USE_OTC_API:
+    # Existing VPCs are already listed as routers
+    router = opts[K.INVENTORY].find(K.router, vpcname)
+    router_id = None if router is None else router['id']
+  else:
+    router_id = vpc['id']
+  plans.act(opts, 'attach_subnet', subnet_id = snx['id'], name = snx[K.NAME],
+            vpc = vpcname, router_id = router_id)
+
+@plans.op('create_network', K.network)
+def create_network(c, name):
+  ''' Create a network
+
+  :param openstack.connection c: OpenStack connection
+  :param str name: network name
+  :returns network-instance: new network
+  '''
+  myotc.msg('Creating network {}...'.format(name))
+  net = c.network.create_network(name = name)
+  myotc.msg('DONE\n')
+  return net
+
+@plans.op('create_subnet', K.subnet)
+def create_subnet(c, **args):
+  ''' Create a subnet
+
+  :param openstack.connection c: OpenStack connection
+  :param kwargs args: subnet attributes
+  :returns subnet-instance: new subnet
+  '''
+  myotc.msg('Creating subnet {}...'.format(args['name']))
+  snx = c.network.create_subnet(**args)
+  myotc.msg('DONE\n')
+  return snx
+
+@plans.op('attach_subnet')
+def attach_subnet(c, subnet_id, name, vpc, router_id = None):
+  ''' Connect a subnet to a VPC
+
+  :param openstack.connection c: OpenStack connection
+  :param str subnet_id: subnet id
+  :param str name: subnet name, used for messages
+  :param str vpc: VPC name
+  :param str router_id: (optional) router id.  If not given, the router is looked up by VPC name.
+  '''
+  myotc.msg('connecting {} to vpc {}...'.format(name, vpc))
+  if router_id is None:
+    router_id = waiter.wait_for_router(c, vpc).id
+
+  c.network.add_interface_to_router(router_id, subnet_id)
+  myotc.msg('DONE\n')
+
+@plans.op('update_subnet', K.subnet)
+def update_subnet(c, id, name, **args):
+  ''' Update subnet settings
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: subnet id
+  :param str name: subnet name, used for messages
+  :param kwargs args: subnet attributes to change
+  :returns subnet-instance: updated subnet
+  '''
+  myotc.msg('Updating subnet {}: {}...'.format(name, str(args)))
+  snx = c.network.update_subnet(id, **args)
+  myotc.msg('DONE\n')
+  return snx
+
 
 def has_eip(server):
   ''' Check if server has an floating IP
@@ -533,6 +672,7 @@ def new_srv(id_or_name, opts, **kw):
   c = opts[K.CONN]
   sid = opts[K.SID]
   dryrun = opts[K.DRYRUN]
+  inv = opts[K.INVENTORY]
   prefix = sid + '-'
 
   name = myotc.gen_name(id_or_name, 'vm', sid)
@@ -542,31 +682,31 @@ def new_srv(id_or_name, opts, **kw):
     image_name = kw['image']
   else:
     image_name = opts[K.DEFAULT_IMAGE]
-  image = c.compute.find_image(image_name)
+  image = opts[K.CATALOG].image(image_name)
   if not image:
-    print('Image {image} not found for vm {name}'.format(name=name,image=image_name))
+    myotc.out('Image {image} not found for vm {name}'.format(name=name,image=image_name))
     return None
-  args['image_id'] = image.id
+  args['image_id'] = image[K.sID]
 
   if 'flavor' in kw:
     flavor_name = kw['flavor']
   else:
-    favor_name = cf[K.DEFAULT_FLAVOR]
-  flavor = c.compute.find_flavor(flavor_name)
+    flavor_name = opts[K.DEFAULT_FLAVOR]
+  flavor = opts[K.CATALOG].flavor(flavor_name)
   if not flavor:
-    print('Flavor {flavor} not found for vm {name}'.format(name=name,flavor=flavor_name))
+    myotc.out('Flavor {flavor} not found for vm {name}'.format(name=name,flavor=flavor_name))
     return None
-  args['flavor_id'] = flavor.id
+  args['flavor_id'] = flavor[K.sID]
 
   if 'sg' in kw:
     if isinstance(kw['sg'],str):
       # This is a sg name...
       sg_name = '{}-sg-{}'.format(sid,kw['sg'])
-      sg = c.network.find_security_group(sg_name)
+      sg = inv.find(K.sg, sg_name)
       if sg is None:
-        sg = c.network.find_security_group(kw['sg'])
+        sg = inv.find(K.sg, kw['sg'])
         if sg is None:
-          print('Security group {sg} does not exist for vm {name}'.format(name=name,sg=kw['sg']))
+          myotc.out('Security group {sg} does not exist for vm {name}'.format(name=name,sg=kw['sg']))
           return None
         sg_name = kw['sg']
     else: # Assume is a list of rules...
@@ -593,13 +733,13 @@ def new_srv(id_or_name, opts, **kw):
         netname = '{sid}-sn{nid}'.format(sid = sid, nid = cnet)
       else:
         netname = '{}-{}'.format(sid,cnet)
-      net = c.network.find_network(netname)
+      net = inv.find(K.network, netname)
       if not net:
-        print('Network {net} not found for vm {name}'.format(name=name,net=netname))
+        myotc.out('Network {net} not found for vm {name}'.format(name=name,net=netname))
         return None
       args['networks'].append({'uuid': net.id})
   if len(args['networks']) == 0:
-    print('vm {name} is not connected to any network'.format(name=name))
+    myotc.out('vm {name} is not connected to any network'.format(name=name))
     return None
 
   if 'user_file' in kw:
@@ -615,90 +755,76 @@ def new_srv(id_or_name, opts, **kw):
       txt += yaml.dump(kw['user_data'])
       args['user_data'] = base64.b64encode(txt.encode('utf-8')).decode('ascii')
 
-  server = c.compute.find_server(name)
+  server = inv.find(K.server, name)
+  new_vols = None
   if not server:
-    myotc.msg('Creating server {}...'.format(args['name']))
-    server = c.compute.create_server(**args)
-    server = c.compute.wait_for_server(server)
-    # Tag the server...
-    myotc.msg('tagging...')
-    server.add_tag(c.compute, 'SID={sid}'.format(sid= sid))
-    myotc.msg('DONE\n')
+    # Boot and data volumes are created along with the server
+    new_vols = server_volumes(opts, name, kw.get('vols', {}), wait = False)
+    bdm = [ { 'uuid': v, 'source_type': 'volume', 'destination_type': 'volume',
+              'boot_index': -1, 'delete_on_termination': False } for v in new_vols ]
+    if 'image_size' in kw:
+      size = int(kw['image_size'])
+      if 'min_disk' in image and not image['min_disk'] is None and size < int(image['min_disk']):
+        myotc.out('Ignoring {vname} image_size:{size} < min_disk:{mind}'.format(vname = name, size = size, mind = image['min_disk']))
+        size = int(image['min_disk'])
+      bdm.insert(0, { 'uuid': args['image_id'], 'source_type': 'image', 'destination_type': 'volume',
+                      'boot_index': 0, 'volume_size': size, 'delete_on_termination': True })
+    if len(bdm) > 0:
+      server = plans.act(opts, 'create_server', sid=sid, block_device_mapping=bdm, **args)
+    else:
+      server = plans.act(opts, 'create_server', sid=sid, **args)
+  elif server[K.status] == 'BUILD':
+    # Still being created, e.g. by an interrupted deploy
+    server = plans.act(opts, 'finish_server', id=server['id'], name=name, sid=sid)
   else:
-    server = c.compute.get_server(server)
-
     nc = {}
     oc = {}
     for k in args:
+      if k in ('flavor_id', 'networks'): continue # Flavor is compared by name, networks we don't get right!
+      if not k in server or server[k] is None: continue # Not returned by the API (e.g. user_data)
       nc[k] = args[k]
-      if k in server: oc[k] = server[k]
+      oc[k] = server[k]
 
-    nc['flavor_id'] = None
     nc['flavor_name'] = flavor_name
     oc['flavor_name'] = server['flavor']['original_name']
-    oc['image_id'] = server['image']['id']
-    nc['networks'] = None # Note, we don't get this right!
+    nc['image_id'] = args['image_id']
+    if isinstance(server['image'], dict) and server['image'].get('id'):
+      oc['image_id'] = server['image']['id']
+    elif not boot_volume(server, image_name, lambda vid: find_volume(opts, vid, True)) is None:
+      oc['image_id'] = args['image_id'] # Booted from a volume made from the image
+    else:
+      oc['image_id'] = None
+    if 'security_groups' in nc and len(nc['security_groups']) == 0:
+      # None requested, Nova picks them
+      del nc['security_groups'], oc['security_groups']
 
-    if yaml.dump(nc) != yaml.dump(oc):
+    drift = specdiff.diff(nc, oc, unordered = ('security_groups',))
+    if len(drift) > 0:
       if dryrun:
-        print('WONT recreate vm {} settings changing'.format(name))
-        # ~ print(args)
+        myotc.out('WONT recreate vm {} settings changing: {}'.format(name, specdiff.describe(drift)))
       else:
         # We destroy the server and re-create it...
-        myotc.msg('Deleting vm {}...'.format(name))
-        c.compute.delete_server(server['id'])
-        c.compute.wait_for_delete(server)
-        myotc.msg('Re-creating...');
-        server = c.compute.create_server(**args)
-        server = c.compute.wait_for_server(server)
-        myotc.msg('DONE\n')
-
-  if 'image_size' in kw:
+        myotc.msg('vm {} settings changed: {}\n'.format(name, specdiff.describe(drift)))
+        plans.act(opts, 'delete_server', id=server['id'], name=name)
+        server = plans.act(opts, 'create_server', sid=sid, **args)
+
+  if 'image_size' in kw and new_vols is None:
     # We may need to resize image volume
-    for vid in server['attached_volumes']:
-      vdat = c.block_store.get_volume(vid['id'])
-      if not 'is_bootable' in vdat: continue
-      if not 'volume_image_metadata' in vdat: continue
-      if not vdat['is_bootable']: continue
-      if not 'image_name' in vdat['volume_image_metadata']: continue
-      if vdat['volume_image_metadata']['image_name'] != image_name: continue
-
-      # From here on we consider this volume the boot volume
-      if not 'min_disk' in vdat['volume_image_metadata']: break
-      if int(kw['image_size']) < int(vdat['volume_image_metadata']['min_disk']):
-        print('Ignoring {vname} image_size:{size} < min_disk:{mind}'.format(
-              vname = name,
-              size = kw['image_size'],
-              mind = vdat['volume_image_metadata']['min_disk'],
-            ))
-        break
-      if not 'size' in vdat: break
-      if int(kw['image_size']) != int(vdat['size']):
-        if int(kw['image_size']) < int(vdat['size']):
-            print('Unable resize image volume for {name} from {csize} => {tsize}'.format(
-                    name  = name,
-                    csize = int(vdat['size']),
-                    tsize = int(kw['image_size']),
-                  ))
-            break
-        myotc.msg('Resizing image volume for {name} from {csize} to {tsize}...'.format(
-                  name  = name,
-                  csize = int(vdat['size']),
-                  tsize = int(kw['image_size']),
-                ))
-        # must resize image volume
-        vdat.extend(c.block_store,int(kw['image_size']))
-        myotc.msg('DONE\n')
+    if plans.is_ref(server):
+      # Boot volume is only known once the server exists
+      plans.act(opts, 'resize_boot_volume', server_id=server['id'], name=name,
+                image_name=image_name, size=int(kw['image_size']))
+    else:
+      vdat = boot_volume(server, image_name, lambda vid: find_volume(opts, vid, True))
+      if not vdat is None and boot_resize(name, vdat, kw['image_size']):
+        plans.act(opts, 'extend_volume', id=vdat['id'], name=vdat['name'], size=int(kw['image_size']))
 
   # update internal DNS zone...
-  rrs = { 'A': [], 'AAAA': [] }
-  for sn in server['addresses']:
-    for ip in server['addresses'][sn]:
-      if ip['OS-EXT-IPS:type'] == 'fixed' and 'addr' in ip:
-        if ip['version'] == 6:
-          rrs['AAAA'].append(ip['addr'])
-        else:
-          rrs['A'].append(ip['addr'])
+  if plans.is_ref(server):
+    # Addresses are only known once the server exists
+    rrs = { 'A': server['fixed_ipv4'], 'AAAA': server['fixed_ipv6'] }
+  else:
+    rrs = fixed_ips(server)
 
   for rtype in rrs:
     new_dns('{}.{}'.format(sid,opts[K.PRIVATE_DNS_ZONE]), K.private, name, rtype, rrs[rtype], opts)
@@ -714,11 +840,11 @@ def new_srv(id_or_name, opts, **kw):
     if kw['eip']:
       # TODO: add support for IPv6
       ip_addr = has_eip(server)
+      if ip_addr and len(inv.lookup(K.fip, 'floating_ip_address', ip_addr)) == 0:
+        ip_addr = None # Server addresses are out of date, the IP was released
       if not ip_addr:
-        myotc.msg('Creating floating IP for server {}...'.format(name))
-        eip = c.create_floating_ip(server = server)
-        myotc.msg('DONE\n')
-        ip_addr = eip.floating_ip_address
+        eip = plans.act(opts, 'create_fip', server=server, name=name)
+        ip_addr = eip['floating_ip_address']
 
       if upd_dns:
         new_dns(opts[K.PUBLIC_DNS_ZONE], K.public, name, 'A', [ ip_addr ], opts)
@@ -732,14 +858,12 @@ def new_srv(id_or_name, opts, **kw):
           port_ids[interface['port_id']] = '{server}-if{port}'.format(server = name, port = i)
           ++i
 
-        for ip in c.network.ips():
-          if ip.port_id in port_ids:
+        for port_id in port_ids:
+          for ip in inv.lookup(K.fip, 'port_id', port_id):
             if dryrun:
-              print('WONT release IP {ip} from server port {port}'.format(ip=ip.floating_ip_address, port = port_ids[ip.port_id]))
+              myotc.out('WONT release IP {ip} from server port {port}'.format(ip=ip.floating_ip_address, port = port_ids[ip.port_id]))
             else:
-              myotc.msg('Releasing IP {ip} from server port {port}...'.format(ip=ip.floating_ip_address, port = port_ids[ip.port_id]))
-              c.network.delete_ip(ip)
-              myotc.msg('DONE\n')
+              plans.act(opts, 'delete_fip', id=ip['id'], address=ip.floating_ip_address, port=port_ids[ip.port_id])
               del_dns(opts[K.PUBLIC_DNS_ZONE], K.public, name, 'A', opts)
 
 
@@ -752,57 +876,261 @@ def new_srv(id_or_name, opts, **kw):
       for cn in cnames:
         new_dns(opts[K.PUBLIC_DNS_ZONE], K.public, cn, 'CNAME', [ dns_name ], opts)
 
-  # create and attach volumes
-  if 'vols' in kw:
-    v_x = {}
-    for v_id_or_name in kw['vols']:
-      if isinstance(v_id_or_name,str):
-        v = find_volume(c, v_id_or_name)
-        if not v is None:
-          v_x[v['id']] = v
-          continue
-      vol_name = myotc.gen_name(v_id_or_name, name[len(sid)+1:]+'-v',sid)
-      v = new_vol(vol_name, opts, **kw['vols'][v_id_or_name])
+  # create and attach volumes to existing servers
+  if 'vols' in kw and new_vols is None:
+    v_x = server_volumes(opts, name, kw['vols'])
+
+    if not plans.is_ref(server):
+      root_device = server['root_device_name']
+      # ~ print(root_device)
+      # ~ print(server['attached_volumes'])
+      for av in server['attached_volumes']:
+        # ~ print(av)
+        v = av['id']
+        xvol = find_volume(opts, v, True)
+        device = volume_device(xvol, server['id'])
+        if device is None:
+          device = c.compute.get_volume_attachment(server,v)['device']
+        if device == root_device: continue # We skip the root device
+        if v in v_x:
+          # Already been attached, so remove it from the list...
+          del(v_x[v])
+        else:
+          # We don't know about this volume
+          if dryrun:
+            myotc.out('WONT detach volume {} from vm {}'.format(xvol['name'], name))
+          else:
+            plans.act(opts, 'detach_volume', id=v, name=xvol['name'], server_id=server['id'], server_name=name)
+
+    # Attaching any remaining volumes...
+    for v in v_x:
+      plans.act(opts, 'attach_volume', id=v, name=v_x[v]['name'], server_id=server['id'], server_name=name)
+  return server
+
+def server_volumes(opts, name, vols, wait = True):
+  ''' Find or create the data volumes of a server
+
+  :param dict opts: session options
+  :param str name: vm name
+  :param dict vols: volumes declared for the vm
+  :param bool wait: (optional) if False, do not wait for new volumes to become available
+  :returns dict: volumes indexed by id
+  '''
+  sid = opts[K.SID]
+  v_x = {}
+  for v_id_or_name in vols:
+    if isinstance(v_id_or_name,str):
+      v = find_volume(opts, v_id_or_name)
       if not v is None:
         v_x[v['id']] = v
+        continue
+    vol_name = myotc.gen_name(v_id_or_name, name[len(sid)+1:]+'-v',sid)
+    v = new_vol(vol_name, opts, wait, **vols[v_id_or_name])
+    if not v is None:
+      v_x[v['id']] = v
+  return v_x
 
-    root_device = server['root_device_name']
-    # ~ print(root_device)
-    # ~ print(server['attached_volumes'])
-    for av in server['attached_volumes']:
-      # ~ print(av)
-      avd = c.compute.get_volume_attachment(server,av['id'])
-      if avd['device'] == root_device: continue # We skip the root device
-      v = avd['volume_id']
-      if v in v_x:
-        # Already been attached, so remove it from the list...
-        del(v_x[v])
-      else:
-        # We don't know about this volume
-        xvol = find_volume(c, v)
-        if dryrun:
-          print('WONT detach volume {} from vm {}'.format(xvol['name'], name))
+def fixed_ips(server):
+  ''' Fixed IP addresses of a server
+
+  :param openstack.server server: OpenStack server instance
+  :returns dict: addresses indexed by DNS record type (``A`` and ``AAAA``)
+  '''
+  rrs = { 'A': [], 'AAAA': [] }
+  for sn in server['addresses']:
+    for ip in server['addresses'][sn]:
+      if ip['OS-EXT-IPS:type'] == 'fixed' and 'addr' in ip:
+        if ip['version'] == 6:
+          rrs['AAAA'].append(ip['addr'])
         else:
-          myotc.msg('Detaching volume {} from vm {}...'.format(xvol['name'], name))
-          c.compute.delete_volume_attachment(av['id'],server)
-          c.block_store.wait_for_status(xvol,
-                                    status='in-use',
-                                    failures=['error'],
-                                    interval=5,
-                                    wait=120)
-          myotc.msg('DONE\n')
+          rrs['A'].append(ip['addr'])
+  return rrs
 
-    # Attaching any remaining volumes...
-    for v in v_x:
-      myotc.msg('Attaching volume {} to vm {}...'.format(v_x[v]['name'],name))
-      c.compute.create_volume_attachment(server, volume_id=v_x[v]['id'])
-      c.block_store.wait_for_status(v_x[v],
-                                    status='in-use',
-                                    failures=['error'],
-                                    interval=5,
-                                    wait=120)
-      myotc.msg('DONE\n')
+@plans.derived('fixed_ipv4')
+def fixed_ipv4(server):
+  return fixed_ips(server)['A']
+
+@plans.derived('fixed_ipv6')
+def fixed_ipv6(server):
+  return fixed_ips(server)['AAAA']
+
+def boot_volume(server, image_name, getvol):
+  ''' Find the boot volume of a server
+
+  :param openstack.server server: OpenStack server instance
+  :param str image_name: image the server was created from
+  :param callable getvol: function returning a volume from its id
+  :returns None|openstack.volume: boot volume if found
+  '''
+  for vid in server['attached_volumes']:
+    vdat = getvol(vid['id'])
+    if not 'is_bootable' in vdat: continue
+    if not 'volume_image_metadata' in vdat: continue
+    if not vdat['is_bootable']: continue
+    if not 'image_name' in vdat['volume_image_metadata']: continue
+    if vdat['volume_image_metadata']['image_name'] != image_name: continue
+    return vdat
+  return None
+
+def boot_resize(name, vdat, image_size):
+  ''' Check if a boot volume needs to be resized
+
+  :param str name: vm name, used for messages
+  :param openstack.volume vdat: boot volume
+  :param int image_size: requested size
+  :returns bool: True if the volume must be extended
+  '''
+  if not 'min_disk' in vdat['volume_image_metadata']: return False
+  if int(image_size) < int(vdat['volume_image_metadata']['min_disk']):
+    myotc.out('Ignoring {vname} image_size:{size} < min_disk:{mind}'.format(
+          vname = name,
+          size = image_size,
+          mind = vdat['volume_image_metadata']['min_disk'],
+        ))
+    return False
+  if not 'size' in vdat: return False
+  if int(image_size) == int(vdat['size']): return False
+  if int(image_size) < int(vdat['size']):
+    myotc.out('Unable resize image volume for {name} from {csize} => {tsize}'.format(
+            name  = name,
+            csize = int(vdat['size']),
+            tsize = int(image_size),
+          ))
+    return False
+  return True
+
+@plans.op('create_server', K.server)
+def create_server(c, sid, **args):
+  ''' Create a server and tag it with its SID
+
+  :param openstack.connection c: OpenStack connection
+  :param str sid: system ID
+  :param kwargs args: server attributes
+  :returns openstack.server: new server
+
+  Volumes in the ``block_device_mapping`` are waited for together
+  before the server is created.
+  '''
+  vols = [ m['uuid'] for m in args.get('block_device_mapping', []) if m['source_type'] == 'volume' ]
+  if len(vols) > 0:
+    # Volumes must be available before they can be mapped
+    myotc.msg('Waiting for volumes of server {}...'.format(args['name']))
+    w = waiter.get(c)
+    for fut in [ w.volume(v) for v in vols ]: fut.result()
+    myotc.msg('DONE\n')
+  myotc.msg('Creating server {}...'.format(args['name']))
+  server = c.compute.create_server(**args)
+  server = waiter.wait_for_server(c, server)
+  # Tag the server...
+  myotc.msg('tagging...')
+  server.add_tag(c.compute, 'SID={sid}'.format(sid= sid))
+  myotc.msg('DONE\n')
   return server
 
+@plans.op('finish_server', K.server)
+def finish_server(c, id, name, sid):
+  ''' Wait for a server being created and tag it with its SID
 
+  :param openstack.connection c: OpenStack connection
+  :param str id: server id
+  :param str name: server name, used for messages
+  :param str sid: system ID
+  :returns openstack.server: the server once active
+  '''
+  myotc.msg('Waiting for server {}...'.format(name))
+  server = waiter.wait_for_server(c, id)
+  myotc.msg('tagging...')
+  server.add_tag(c.compute, 'SID={sid}'.format(sid= sid))
+  myotc.msg('DONE\n')
+  return server
+
+@plans.op('delete_server', K.server, remove=True)
+def delete_server(c, id, name):
+  ''' Delete a server and wait for it to go away
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: server id
+  :param str name: server name, used for messages
+  '''
+  myotc.msg('Deleting vm {}...'.format(name))
+  c.compute.delete_server(id)
+  waiter.wait_for_delete(c, K.server, id)
+  myotc.msg('DONE\n')
+
+@plans.op('resize_boot_volume', K.volume)
+def resize_boot_volume(c, server_id, name, image_name, size):
+  ''' Resize the boot volume of a newly created server
 
+  :param openstack.connection c: OpenStack connection
+  :param str server_id: server id
+  :param str name: server name, used for messages
+  :param str image_name: image the server was created from
+  :param int size: requested size
+  :returns None|openstack.volume: updated boot volume
+  '''
+  server = c.compute.get_server(server_id)
+  vdat = boot_volume(server, image_name, lambda vid: c.block_store.get_volume(vid))
+  if vdat is None or not boot_resize(name, vdat, size): return None
+  return extend_volume(c, vdat['id'], vdat['name'], size)
+
+@plans.op('create_fip', K.fip)
+def create_fip(c, server, name):
+  ''' Create a floating IP for a server
+
+  :param openstack.connection c: OpenStack connection
+  :param str|openstack.server server: server or server id
+  :param str name: server name, used for messages
+  :returns floating-ip-instance: new floating IP
+  '''
+  if isinstance(server, str): server = c.compute.get_server(server)
+  myotc.msg('Creating floating IP for server {}...'.format(name))
+  eip = c.create_floating_ip(server = server)
+  myotc.msg('DONE\n')
+  return eip
+
+@plans.op('delete_fip', K.fip, remove=True)
+def delete_fip(c, id, address, port):
+  ''' Release a floating IP
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: floating IP id
+  :param str address: floating IP address, used for messages
+  :param str port: port description, used for messages
+  '''
+  myotc.msg('Releasing IP {ip} from server port {port}...'.format(ip=address, port=port))
+  c.network.delete_ip(id)
+  myotc.msg('DONE\n')
+
+@plans.op('attach_volume', K.volume)
+def attach_volume(c, id, name, server_id, server_name):
+  ''' Attach a volume to a server
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: volume id
+  :param str name: volume name, used for messages
+  :param str server_id: server id
+  :param str server_name: server name, used for messages
+  :returns openstack.volume: updated volume
+  '''
+  myotc.msg('Attaching volume {} to vm {}...'.format(name, server_name))
+  c.compute.create_volume_attachment(server_id, volume_id=id)
+  vol = waiter.wait_for_volume(c, id, 'in-use')
+  myotc.msg('DONE\n')
+  return vol
+
+@plans.op('detach_volume', K.volume)
+def detach_volume(c, id, name, server_id, server_name):
+  ''' Detach a volume from a server
+
+  :param openstack.connection c: OpenStack connection
+  :param str id: volume id
+  :param str name: volume name, used for messages
+  :param str server_id: server id
+  :param str server_name: server name, used for messages
+  :returns openstack.volume: updated volume
+  '''
+  myotc.msg('Detaching volume {} from vm {}...'.format(name, server_name))
+  c.compute.delete_volume_attachment(server_id, id)
+  vol = waiter.wait_for_volume(c, id, 'available')
+  myotc.msg('DONE\n')
+  return vol
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+'''
+Batched DNS record reconciliation
+
+Instead of looking up and modifying DNS records one at a time, the
+desired records are collected during a deployment and applied in
+one go at the end.  The record sets of each zone are listed only once
+and indexed by ``(name, type)``.
+'''
+import threading
+import myotc
+import plans
+import specdiff
+import consts as K
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+def same_records(rtype, old, new):
+  ''' Compare DNS resource records
+
+  :param str rtype: Resource record type
+  :param list old: records currently defined
+  :param list new: desired records
+  :returns bool: True if both lists contain the same records
+
+  Host names in ``CNAME`` records are compared regardless of the
+  trailing dot.
+  '''
+  if isinstance(new, str):
+    # Deferred records are only known when a plan is applied
+    return False
+  if rtype == K.CNAME:
+    old = [myotc.sanitize_dns_name(r) for r in old]
+    new = [myotc.sanitize_dns_name(r) for r in new]
+  return specdiff.same(new, old, unordered = True)
+
+class DnsBatch:
+  ''' Collect desired DNS records and apply them as a batch
+
+  :param openstack.connection c: OpenStack connection
+  '''
+  def __init__(self, c):
+    self.conn = c
+    self.lock = threading.RLock()
+    self.zones = {}
+    ''' zone instances indexed by zone id '''
+    self.rrsets = {}
+    ''' record sets indexed by zone id and then by ``(name, type)`` '''
+    self.desired = {}
+    ''' desired records indexed by ``(zone id, name, type)`` '''
+
+  def recordsets(self, zone):
+    ''' Return the record set index for a zone
+
+    :param openstack.dnszone zone: DNS zone
+    :returns dict: record sets indexed by ``(name, type)``
+
+    Record sets are listed only the first time a zone is used.
+    '''
+    with self.lock:
+      if not zone.id in self.rrsets:
+        idx = {}
+        # A zone still to be created by a plan has no records
+        rsets = [] if plans.is_ref(zone) else self.conn.dns.recordsets(zone)
+        for rs in rsets:
+          if (K.NAME in rs) and (K.type in rs):
+            idx[(rs[K.NAME], rs[K.type])] = rs
+        self.zones[zone.id] = zone
+        self.rrsets[zone.id] = idx
+      return self.rrsets[zone.id]
+
+  def want(self, zone, name, rtype, records):
+    ''' Declare the desired records for a name
+
+    :param openstack.dnszone zone: DNS zone
+    :param str name: fully qualified record name
+    :param str rtype: DNS record type, e.g. ``A`` or ``CNAME`` or ``AAAA``, etc.
+    :param list|str records: desired records.  An empty list removes the record set.
+      A reference token defers the records to when a plan is applied.
+    '''
+    with self.lock:
+      self.recordsets(zone)
+      self.desired[(zone.id, name, rtype)] = records if isinstance(records, str) else list(records)
+
+  def changes(self):
+    ''' Compute the changes needed
+
+    :returns list: list of tuples ``(op, zone, name, rtype, recordset, records)``
+    '''
+    res = []
+    with self.lock:
+      for (zid, name, rtype), rrs in self.desired.items():
+        zone = self.zones[zid]
+        cset = self.rrsets[zid].get((name, rtype))
+        if cset:
+          if len(rrs) == 0:
+            res.append((DELETE, zone, name, rtype, cset, rrs))
+          elif not same_records(rtype, cset[K.records], rrs):
+            res.append((UPDATE, zone, name, rtype, cset, rrs))
+        elif len(rrs):
+          res.append((CREATE, zone, name, rtype, None, rrs))
+    return res
+
+  def apply(self, opts):
+    ''' Apply the desired DNS records
+
+    :param dict opts: session options
+    :returns dict: number of changes, indexed by operation
+
+    As with other resources, new records are created even on dry-run.
+    '''
+    dryrun = opts[K.DRYRUN]
+    counts = { CREATE: 0, UPDATE: 0, DELETE: 0 }
+    changes = self.changes()
+    unchanged = len(self.desired) - len(changes)
+    for op, zone, name, rtype, cset, rrs in changes:
+      counts[op] += 1
+      if op != CREATE and dryrun:
+        print('WONT {op} DNS {type} record for {name}'.format(op=op,type=rtype,name=name))
+        continue
+      cset = plans.act(opts, 'set_records', zone_id = zone.id, name = name, type = rtype,
+                       records = rrs, rrset = cset)
+      if plans.is_ref(cset): continue
+      if cset is None:
+        self.rrsets[zone.id].pop((name, rtype), None)
+      else:
+        self.rrsets[zone.id][(name, rtype)] = cset
+
+    if dryrun:
+      print('DNS summary: {c} created, {u} to update, {d} to delete, {n} unchanged'.format(
+              c = counts[CREATE], u = counts[UPDATE], d = counts[DELETE], n = unchanged))
+    self.desired = {}
+    return counts
+
+@plans.op('set_records')
+def set_records(c, zone_id, name, type, records, rrset = None):
+  ''' Create, update or delete a DNS record set
+
+  :param openstack.connection c: OpenStack connection
+  :param str zone_id: DNS zone id
+  :param str name: fully qualified record name
+  :param str type: DNS record type
+  :param list records: desired records.  An empty list removes the record set.
+  :param None|str|openstack.recordset rrset: (optional) existing record set or its id
+  :returns None|openstack.recordset: resulting record set
+  '''
+  if rrset is None:
+    if len(records) == 0: return None
+    myotc.msg('Creating DNS {type} record for {name}...'.format(type=type,name=name))
+    rrset = c.dns.create_recordset(zone_id, name=name, type = type, records = records)
+    myotc.msg('DONE\n')
+    return rrset
+
+  if len(records) == 0:
+    myotc.msg('Deleting DNS {type} record for {name}...'.format(type=type,name=name))
+    c.dns.delete_recordset(rrset, zone_id)
+    myotc.msg('DONE\n')
+    return None
+
+  if isinstance(rrset, str): rrset = c.dns.get_recordset(rrset, zone_id)
+  if same_records(type, rrset[K.records], records): return rrset
+  myotc.msg('Updating DNS {type} record for {name}...'.format(type=type,name=name))
+  rrset = c.dns.update_recordset(rrset, records = records)
+  myotc.msg('DONE\n')
+  return rrset
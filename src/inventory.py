@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+'''
+In-memory snapshot of project resources
+
+Listing resources in bulk is a lot cheaper than looking them up one
+at a time by name.  An ``Inventory`` fetches each resource type with
+a single list call and indexes the results by name and by id.  Callers
+that create, update or delete resources are expected to keep the
+snapshot current with ``add`` and ``remove``.  Some resource types are
+also indexed by other fields, e.g. floating IPs by port and address.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import consts as K
+
+LISTERS = {
+  K.server:   lambda c, **q: c.compute.servers(**q),
+  K.network:  lambda c, **q: c.network.networks(**q),
+  K.subnet:   lambda c, **q: c.network.subnets(**q),
+  K.router:   lambda c, **q: c.network.routers(**q),
+  K.vpc:      lambda c, **q: c.vpc.vpcs(**q),
+  K.sg:       lambda c, **q: c.network.security_groups(**q),
+  K.volume:   lambda c, **q: c.block_store.volumes(**q),
+  K.fip:      lambda c, **q: c.network.ips(**q),
+  K.public:   lambda c, **q: c.dns.zones(**q),
+  K.private:  lambda c, **q: c.dns.zones(zone_type=K.private, **q),
+}
+''' Bulk list call used to load each resource type, taking optional query filters '''
+
+INDEXES = {
+  K.fip:      ('port_id', 'floating_ip_address'),
+}
+''' Additional fields indexed for each resource type, see ``Inventory.lookup`` '''
+
+def kinds():
+  ''' Resource types available in this environment
+
+  :returns list: resource types that can be loaded
+  '''
+  return [kind for kind in LISTERS if kind != K.vpc or K.USE_OTC_API]
+
+class Inventory:
+  ''' Indexed snapshot of project resources
+
+  :param openstack.connection c: OpenStack connection
+  :param dict query: (optional) list call filters indexed by resource type
+
+  Resource types are loaded on first use, or in bulk using ``load``.
+  With a ``query`` the snapshot only holds the resources matching
+  the filters, which are applied by the API.
+  '''
+  def __init__(self, c, query = None):
+    self.conn = c
+    self.query = query or {}
+    self.lock = threading.RLock()
+    self.by_name = {}
+    self.by_id = {}
+    self.by_field = {}
+
+  def load(self, kind_list = None, jobs = 4):
+    ''' Load resource types in bulk
+
+    :param list kind_list: (optional) resource types to load, defaults to all
+    :param int jobs: (optional) number of concurrent list calls
+    '''
+    if kind_list is None: kind_list = kinds()
+    with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+      res = dict(zip(kind_list, pool.map(self._list, kind_list)))
+    with self.lock:
+      for kind in kind_list:
+        self._index(kind, res[kind])
+
+  def _list(self, kind):
+    ''' List the resources of a type
+
+    :param str kind: resource type
+    :returns list: resources matching the query for that type
+    '''
+    return list(LISTERS[kind](self.conn, **self.query.get(kind, {})))
+
+  def _index(self, kind, resources):
+    ''' Replace the index for a resource type
+
+    :param str kind: resource type
+    :param list resources: resources of that type
+    '''
+    self.by_name[kind] = {}
+    self.by_id[kind] = {}
+    self.by_field[kind] = { field: {} for field in INDEXES.get(kind, ()) }
+    for r in resources:
+      self._add(kind, r)
+
+  def _add(self, kind, res):
+    if K.sID in res and not res[K.sID] is None:
+      self.by_id[kind][res[K.sID]] = res
+    if K.NAME in res and not res[K.NAME] is None:
+      if not res[K.NAME] in self.by_name[kind]:
+        self.by_name[kind][res[K.NAME]] = res
+    for field, idx in self.by_field[kind].items():
+      if field in res and not res[field] is None:
+        idx.setdefault(res[field], []).append(res)
+
+  def _loaded(self, kind):
+    ''' Make sure a resource type has been loaded
+
+    :param str kind: resource type
+    '''
+    if not kind in self.by_id:
+      self._index(kind, self._list(kind))
+
+  def find(self, kind, name_or_id):
+    ''' Find a resource by name or id
+
+    :param str kind: resource type
+    :param str name_or_id: resource name or id
+    :returns None|resource: the resource if found
+    '''
+    with self.lock:
+      self._loaded(kind)
+      if name_or_id in self.by_name[kind]: return self.by_name[kind][name_or_id]
+      if name_or_id in self.by_id[kind]: return self.by_id[kind][name_or_id]
+    return None
+
+  def lookup(self, kind, field, value):
+    ''' Find resources by an indexed field
+
+    :param str kind: resource type
+    :param str field: field name, one of ``INDEXES[kind]``
+    :param str value: value to look for
+    :returns list: resources with that value
+    '''
+    with self.lock:
+      self._loaded(kind)
+      return list(self.by_field[kind][field].get(value, []))
+
+  def items(self, kind):
+    ''' List resources of a given type
+
+    :param str kind: resource type
+    :returns list: resources in the snapshot
+    '''
+    with self.lock:
+      self._loaded(kind)
+      return list(self.by_id[kind].values())
+
+  def partition(self, key, kind_list, shared = (), parts = ()):
+    ''' Split the snapshot in several snapshots
+
+    :param callable key: called as ``key(kind, res)``, returns the part a resource belongs to, or None to leave it out
+    :param list kind_list: resource types to split
+    :param list shared: (optional) resource types copied whole to every part
+    :param list parts: (optional) parts to create even if nothing belongs to them
+    :returns dict: ``Inventory`` for each part returned by ``key``
+
+    Each resource is looked at once.  Parts hold the same resource
+    objects as this snapshot, but are indexed separately, so adding
+    or removing resources in a part does not change the others.
+    '''
+    groups = { part: {} for part in parts }
+    with self.lock:
+      for kind in kind_list:
+        self._loaded(kind)
+        for res in self.by_id[kind].values():
+          part = key(kind, res)
+          if part is None: continue
+          groups.setdefault(part, {}).setdefault(kind, []).append(res)
+      for kind in shared:
+        self._loaded(kind)
+
+      result = {}
+      for part, found in groups.items():
+        inv = Inventory(self.conn)
+        for kind in kind_list:
+          inv._index(kind, found.get(kind, []))
+        for kind in shared:
+          inv._index(kind, list(self.by_id[kind].values()))
+        result[part] = inv
+    return result
+
+  def add(self, kind, res):
+    ''' Add or replace a resource in the snapshot
+
+    :param str kind: resource type
+    :param resource res: resource to add
+    :returns resource: ``res``
+    '''
+    with self.lock:
+      self._loaded(kind)
+      old = self.by_id[kind].get(res[K.sID]) if K.sID in res else None
+      if not old is None: self._remove(kind, old)
+      self._add(kind, res)
+    return res
+
+  def _remove(self, kind, res):
+    for field, idx in self.by_field[kind].items():
+      if field in res and res[field] in idx:
+        idx[res[field]] = [r for r in idx[res[field]] if not r is res]
+        if len(idx[res[field]]) == 0: del idx[res[field]]
+    if K.sID in res and self.by_id[kind].get(res[K.sID]) is res:
+      del self.by_id[kind][res[K.sID]]
+    if K.NAME in res and self.by_name[kind].get(res[K.NAME]) is res:
+      del self.by_name[kind][res[K.NAME]]
+      # A resource with a duplicate name may now be the one found
+      for r in self.by_id[kind].values():
+        if K.NAME in r and r[K.NAME] == res[K.NAME]:
+          self.by_name[kind][r[K.NAME]] = r
+          break
+
+  def remove(self, kind, res):
+    ''' Remove a resource from the snapshot
+
+    :param str kind: resource type
+    :param resource res: resource to remove
+    '''
+    with self.lock:
+      self._loaded(kind)
+      if K.sID in res and res[K.sID] in self.by_id[kind]:
+        res = self.by_id[kind][res[K.sID]]
+      self._remove(kind, res)
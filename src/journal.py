@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Deployment progress journal
+
+Every step completed by a deployment is appended to a journal file
+named after the SID.  The file starts with the hash of the YAML
+source, so a journal is only picked up again for the same
+configuration.  When a deployment is resumed, journaled steps are
+verified against the inventory with a single bulk check and then
+skipped.  The journal is removed once a deployment completes.
+'''
+import json
+import os
+import threading
+import time
+import consts as K
+
+def step_key(action, args):
+  ''' Identify a step
+
+  :param str action: action name
+  :param dict args: action arguments
+  :returns str: key identifying the step
+  '''
+  target = args[K.NAME] if K.NAME in args else args.get(K.sID)
+  return '{}:{}:{}'.format(action, target, args.get(K.type, ''))
+
+class Journal:
+  ''' Record of completed deployment steps
+
+  :param str fname: journal file name
+  :param bool resume: (optional) if True, keep the steps recorded by a previous run
+  :param str sha: (optional) hash of the YAML source, see ``plans.source_hash``
+
+  ``changed`` is set if the journal of a previous run was written
+  for a different YAML source.  Its steps are then discarded.
+  '''
+  def __init__(self, fname, resume = False, sha = None):
+    self.fname = fname
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.changed = False
+    if resume and os.path.isfile(fname):
+      with open(fname, 'r') as fp:
+        for line in fp:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            continue # Partially written line from an interrupted run
+          if not 'key' in entry:
+            self.changed = entry.get('sha') != sha
+            continue
+          self.entries[entry['key']] = entry
+      if not self.changed: return
+      self.entries = {}
+    with open(fname, 'w') as fp:
+      fp.write(json.dumps({ 'sha': sha }) + '\n')
+
+  def done(self, action, args):
+    ''' Check if a step was completed
+
+    :param str action: action name
+    :param dict args: action arguments
+    :returns None|dict: journal entry if the step was completed
+    '''
+    with self.lock:
+      return self.entries.get(step_key(action, args))
+
+  def record(self, action, kind, args, res):
+    ''' Record a completed step
+
+    :param str action: action name
+    :param str kind: inventory resource type affected by the step
+    :param dict args: action arguments
+    :param None|resource res: resulting resource
+    '''
+    entry = {
+      'key': step_key(action, args),
+      'op': action,
+      'kind': kind,
+      'id': res[K.sID] if isinstance(res, dict) and K.sID in res else None,
+      'time': time.time(),
+    }
+    with self.lock:
+      self.entries[entry['key']] = entry
+      with open(self.fname, 'a') as fp:
+        fp.write(json.dumps(entry) + '\n')
+
+  def verify(self, inv):
+    ''' Check journaled resources against the inventory
+
+    :param inventory.Inventory inv: project inventory
+    :returns int: number of steps dropped because their resources are gone
+
+    Steps whose resources no longer exist are forgotten, so they
+    are performed again.
+    '''
+    dropped = 0
+    with self.lock:
+      for key in list(self.entries):
+        entry = self.entries[key]
+        if entry['kind'] is None or entry['id'] is None: continue
+        if inv.find(entry['kind'], entry['id']) is None:
+          del self.entries[key]
+          dropped += 1
+    return dropped
+
+  def finish(self):
+    ''' Remove the journal after a complete deployment '''
+    with self.lock:
+      if os.path.isfile(self.fname): os.unlink(self.fname)
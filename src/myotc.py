@@ -3,35 +3,98 @@
 '''Main command line'''
 ###################################################################
 import cli
-import openstack
 import os
 import ypp
 import sys
 from dataclasses import dataclass
 import consts as K
 import shlex
+import threading
 import proxycfg
+import profiler
+import daemon
 
 @dataclass
 class Settings:
   ''' Data structure containing MyOTC settings '''
-  connection: openstack.connection
+  connection: 'openstack.connection'
   ''' Currently active OpenStack connection '''
+  cloud: tuple
+  ''' ``(cloud, project)`` of the active connection '''
+  shared_auth: dict
+  ''' Authentication shared by a parent process, see ``auth_data`` '''
+  connections: dict
+  ''' Connections opened so far, indexed by cloud and project '''
 
 settings = Settings(
   None,
+  None,
+  None,
+  {},
 )
 DEFAULT_NAME_SERVERS = [ '100.125.4.25', '100.125.129.199' ]
 
+msg_lock = threading.Lock()
+''' Serializes output to stdout and stderr between worker threads '''
+msg_buf = threading.local()
+''' Per-thread buffer for partial progress lines '''
 
 def msg(text):
   '''Output message to stderr with autoflush
 
   :param str text: text to display
+
+  When called from a worker thread, text is buffered until a full
+  line is available, so that progress messages from concurrent
+  operations do not get mixed up.
+  '''
+  if threading.current_thread() is threading.main_thread():
+    with msg_lock:
+      sys.stderr.write(text)
+      sys.stderr.flush()
+    return
+
+  text = getattr(msg_buf, 'text', '') + text
+  lines, nl, rest = text.rpartition('\n')
+  msg_buf.text = rest
+  if nl:
+    with msg_lock:
+      sys.stderr.write(lines + nl)
+      sys.stderr.flush()
+
+def msg_flush():
+  '''Output any partial progress line buffered by the current thread'''
+  text = getattr(msg_buf, 'text', '')
+  if text == '': return
+  msg_buf.text = ''
+  with msg_lock:
+    sys.stderr.write(text + '\n')
+    sys.stderr.flush()
+
+def out(text):
+  '''Print a line of output to stdout
+
+  :param str text: line to print
+
+  Lines are written whole, so output from concurrent worker threads
+  does not get mixed up.
   '''
-  sys.stderr.write(text)
-  sys.stderr.flush()
+  with msg_lock:
+    sys.stdout.write(str(text) + '\n')
+    sys.stdout.flush()
 
+def confirm(question):
+  '''Ask the user for confirmation
+
+  :param str question: question to ask
+  :returns bool: True if the user answered yes
+  '''
+  msg_flush()
+  try:
+    answer = input('{} [y/N] '.format(question))
+  except EOFError:
+    return False
+  return answer.strip().lower() in ('y', 'yes')
 
 def gen_name(id_or_name, prefix, sid):
   '''Generate resource name
@@ -53,6 +116,9 @@ def connect(args = None):
 
   :param namespace args: namespace generated by a CLI parser
   :returns openstack.connection: OpenStack connection
+
+  The OpenStack SDK is only imported here, so that commands that
+  never connect do not pay for it.
   '''
   project = None
   if settings.connection is None:
@@ -67,18 +133,55 @@ def connect(args = None):
       auth = os.getenv(K.CLOUD, K.DEFAULT_CLOUD)
       project = os.getenv(K.PROJECT, None)
 
-    cloud = { 'cloud': auth }
-    cloud_region = openstack.config.get_cloud_region(**cloud)    
-    if not 'project_name' in cloud_region.config['auth']:
-      # No project_name defined!
-      if project is None:
-        project = cloud_region.config['region_name']
-        sys.stderr.write('Assuming "{region}" for project name\n'.format(region=project))
-      cloud['project_name'] = project
-
-    settings.connection = openstack.connect(**cloud)
+    key = (auth, project)
+    if not key in settings.connections:
+      import ratelimit
+      if auth == K.SIMULATOR:
+        import simulator
+        c = simulator.connect(project)
+      else:
+        import openstack
+        import keystoneauth1.access
+        import tokencache
+        cloud = { 'cloud': auth }
+        cloud_region = openstack.config.get_cloud_region(**cloud)    
+        if not 'project_name' in cloud_region.config['auth']:
+          # No project_name defined!
+          if project is None:
+            project = cloud_region.config['region_name']
+            sys.stderr.write('Assuming "{region}" for project name\n'.format(region=project))
+          cloud['project_name'] = project
+
+        c = tokencache.use(openstack.connect(**cloud), auth, project)
+        shared = settings.shared_auth
+        if not shared is None and shared['cloud'] == auth and shared['project'] == project:
+          # Re-use token and service catalog instead of authenticating again
+          c.session.auth.auth_ref = keystoneauth1.access.create(body = shared['body'], auth_token = shared['token'])
+      settings.connections[key] = ((auth, project), profiler.wrap(ratelimit.wrap(c)))
+    settings.cloud, settings.connection = settings.connections[key]
   return settings.connection
 
+def auth_data(c):
+  ''' Authenticate a connection and return data to share it
+
+  :param openstack.connection c: OpenStack connection created by ``connect``
+  :returns None|dict: token and service catalog, to be used as ``settings.shared_auth``
+  :raises TypeError: if the token body cannot be read, see ``tokencache.body``
+
+  The data contains a valid token, so it must only be handed to
+  child processes, never saved.
+  '''
+  if c.session.auth is None: return None # Simulated cloud
+  import tokencache
+  auth_ref = c.session.auth.get_access(c.session)
+  auth, project = settings.cloud
+  return {
+    'cloud': auth,
+    'project': project,
+    'token': auth_ref.auth_token,
+    'body': tokencache.body(auth_ref),
+  }
+
 def sanitize_dns_name(zname):
   return zname.rstrip('.')+'.'
 
@@ -105,10 +208,16 @@ if __name__ == '__main__':
   argparser = cli.parser()
   env_defaults()
   args = argparser.parse_args()
-  if args.debug: openstack.enable_logging(debug=True)
+  if args.debug:
+    import openstack
+    openstack.enable_logging(debug=True)
   proxycfg.proxy_cfg(args.autocfg, args.debug)
+  if args.profile_api or args.profile_json: profiler.enable(args.profile_json)
 
   if 'func' in args:
+    if daemon.forwardable(args):
+      code = daemon.forward(sys.argv[1:])
+      if not code is None: sys.exit(code)
     args.func(args)
   else:
     argparser.print_help()
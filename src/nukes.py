@@ -2,9 +2,14 @@
 '''
 Handling Nuking of resources
 '''
+import re
+import fnmatch
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import myotc
 import consts as K
-import openstack
+import waiter
+import inventory
 
 ###################################################################
 #
@@ -24,171 +29,395 @@ def cname_match(prefix, rs):
       return True
   return False
 
-def nuke(c, sid, doIt = False, def_priv_zone='localnet', def_public_zone= None):
-  ''' Main function to destroy OTC resources
+TIERS = [
+  'DNS records and floating IPs',
+  'servers and volumes',
+  'subnets',
+  'networks, security groups and VPCs',
+]
+''' Deletion tiers, each one only starts once the previous one is gone '''
+
+DETACHING = ('in-use', 'detaching')
+''' Volume states waited for when attached to a server being deleted '''
+
+def targets(c, sid, def_priv_zone, def_public_zone, inv, records = None):
+  ''' Find the resources of an environment
 
   :param openstack.connection c: Connection to OpenStack environment
   :param str sid: system ID for the environment being destroyed
-  :param bool doIt: (optional) Defaults to False, if true, will only show what would happen, but nothing will be destroyed.
-  :param str def_priv_zone: (optional) Default private zone used by this environment
-  :param str def_public_zone: (optional) Public DNS zone where records have been stored.
+  :param str def_priv_zone: Default private zone used by this environment
+  :param None|str def_public_zone: Public DNS zone where records have been stored.
+  :param inventory.Inventory inv: project inventory
+  :param list records: (optional) public zone record sets, listed and checked for by the caller
+  :returns list: one list per tier in ``TIERS`` of ``(wont, doing, fn)`` tuples
+
+  ``wont`` and ``doing`` are the dry-run and progress messages.
+  ``fn`` deletes the resource, and may return a future that completes
+  once the resource is gone.
   '''
-  dryRun = not doIt
+  import openstack
   prefix = sid + '-'
+  tiers = [ [] for t in TIERS ]
+  w = waiter.get(c)
 
   # Remove automatic DNS entries
   zone_name = '{}.{}'.format(sid,def_priv_zone)
-  zn = c.dns.find_zone(myotc.sanitize_dns_name(zone_name),zone_type=K.private)
+  zn = inv.find(K.private, myotc.sanitize_dns_name(zone_name))
   if zn:
-    if dryRun:
-      print('WONT remove DNS internal zone {}'.format(zone_name))
-    else:
-      myotc.msg('Removing DNS internal zone {}...'.format(zone_name))
-      c.dns.delete_zone(zn)
-      myotc.msg('DONE\n')
+    tiers[0].append(('remove DNS internal zone {}'.format(zone_name),
+                     'Removing DNS internal zone {}'.format(zone_name),
+                     lambda zn=zn: c.dns.delete_zone(zn)))
 
   if not def_public_zone is None:
     zone_name = def_public_zone
-    zn = c.dns.find_zone(myotc.sanitize_dns_name(zone_name))
+    zn = inv.find(K.public, myotc.sanitize_dns_name(zone_name))
     if not zn is None:
-      for rs in c.dns.recordsets(zn):
-        if K.NAME in rs:
-          if rs[K.NAME].startswith(sid):
-            if dryRun:
-              print('WONT remove DNS record for {}'.format(rs[K.NAME]))
-              continue
-            else:
-              myotc.msg('Removing DNS record for {}...'.format(rs[K.NAME]))
-              c.dns.delete_recordset(rs,zn)
-              myotc.msg('DONE\n')
-              continue
-        if K.type in rs:
-          if rs[K.type] == K.CNAME:
-            if cname_match(prefix, rs[K.records]):
-              if dryRun:
-                print('WONT remove DNS record for {}'.format(rs[K.NAME]))
-              else:
-                myotc.msg('Removing DNS record for {}...'.format(rs[K.NAME]))
-                c.dns.delete_recordset(rs,zn)
-                myotc.msg('DONE\n')
-
-  else:
+      if records is None: records = c.dns.recordsets(zn)
+      for rs in records:
+        if not K.NAME in rs: continue
+        if rs[K.NAME].startswith(sid) or (rs.get(K.type) == K.CNAME and cname_match(prefix, rs[K.records])):
+          tiers[0].append(('remove DNS record for {}'.format(rs[K.NAME]),
+                           'Removing DNS record for {}'.format(rs[K.NAME]),
+                           lambda rs=rs, zn=zn: c.dns.delete_recordset(rs,zn)))
+  elif records is None:
     print('Not modifying Public DNS records (Missing PUBLIC_DNS_ZONE definition)')
 
+  servers = [s for s in inv.items(K.server) if K.NAME in s and s[K.NAME].startswith(prefix)]
 
-  # Go first through servers to identify all port-ids
-  port_ids = {}
-  for s in c.compute.servers():
-    if K.NAME in s:
-      if s[K.NAME].startswith(sid):
-        i = 0
-        for interface in c.compute.server_interfaces(s):
-          port_ids[interface[K.port_id]] = '{server}-if{port}'.format(server = s[K.NAME], port = i)
-          ++i
-
-  for ip in c.network.ips():
-    if ip.port_id in port_ids:
-      if dryRun:
-        print('WONT release IP {ip} from server port {port}'.format(ip=ip.floating_ip_address, port = port_ids[ip.port_id]))
-      else:
-        myotc.msg('Releasing IP {ip} from server port {port}...'.format(ip=ip.floating_ip_address, port = port_ids[ip.port_id]))
-        c.network.delete_ip(ip)
-        myotc.msg('DONE\n')
+  # Floating IPs are listed in the server addresses
+  def release_ip(ip):
+    c.network.delete_ip(ip)
+    inv.remove(K.fip, ip)
+
+  for s in servers:
+    for net in s.get(K.addresses) or {}:
+      for addr in s[K.addresses][net]:
+        if addr.get(K.OS_EXT_IPS_TYPE) != 'floating': continue
+        for ip in inv.lookup(K.fip, 'floating_ip_address', addr[K.addr]):
+          tiers[0].append(('release IP {ip} from server {server}'.format(ip=ip.floating_ip_address, server = s[K.NAME]),
+                           'Releasing IP {ip} from server {server}'.format(ip=ip.floating_ip_address, server = s[K.NAME]),
+                           lambda ip=ip: release_ip(ip)))
 
   # delete all servers
-  for s in c.compute.servers():
-    if K.NAME in s:
-      if s[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete vm {}'.format(s[K.NAME]))
-        else:
-          myotc.msg('Deleting vm {}...'.format(s[K.NAME]))
-          c.compute.delete_server(s[K.sID])
-          c.compute.wait_for_delete(s)
-          myotc.msg('DONE\n')
-
-  # delete all left-over volumes...
-  for v in c.block_store.volumes():
+  def delete_server(s):
+    c.compute.delete_server(s[K.sID])
+    return w.deleted(K.server, s)
+
+  for s in servers:
+    tiers[1].append(('delete vm {}'.format(s[K.NAME]),
+                     'Deleting vm {}'.format(s[K.NAME]),
+                     lambda s=s: delete_server(s)))
+
+  # delete all left-over volumes, each one as soon as it is detached
+  deleted_ids = set([s[K.sID] for s in servers])
+  def delete_volume(v):
+    attached = [att.get(K.server_id) for att in v.get(K.attachments) or []]
+    if v[K.status] in DETACHING and any([srv in deleted_ids for srv in attached]):
+      myotc.msg('(waiting for detach)...')
+      w.volume(v).result()
+    c.block_store.delete_volume(v)
+    return w.deleted(K.volume, v)
+
+  for v in inv.items(K.volume):
     if K.NAME in v:
       if v[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete volume {}'.format(v[K.NAME]))
-        else:
-          myotc.msg('Deleting volume {}...'.format(v[K.NAME]))
-          c.block_store.delete_volume(v)
-          myotc.msg('DONE\n')
+        tiers[1].append(('delete volume {}'.format(v[K.NAME]),
+                         'Deleting volume {}'.format(v[K.NAME]),
+                         lambda v=v: delete_volume(v)))
 
   # Find all the relevant routers
   routers = []
-  for r in c.network.routers():
+  for r in inv.items(K.router):
     if K.NAME in r:
       if r[K.NAME].startswith(prefix):
         routers.append(r)
 
   # Delete all targeted subnets
-  for sn in c.network.subnets():
+  def delete_subnet(sn):
+    for r in routers:
+      try:
+        c.network.remove_interface_from_router(r.id, sn.id)
+      except openstack.exceptions.ResourceNotFound:
+        pass
+      else:
+        myotc.msg('(disconnected from vpc {})...'.format(r.name))
+    c.network.delete_subnet(sn[K.sID])
+
+  for sn in inv.items(K.subnet):
     if K.NAME in sn:
       if sn[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete subnet {}'.format(sn[K.NAME]))
-        else:
-          for r in routers:
-            myotc.msg('Disconnecting vpc {vpc} from subnet {sn}...'.format(vpc = r.name, sn = sn.name))
-            try:
-              c.network.remove_interface_from_router(r.id, sn.id)
-            except openstack.exceptions.ResourceNotFound:
-              myotc.msg('(NOT CONNECTED)\n')
-            else:
-              myotc.msg('DONE\n')
-
-          myotc.msg('Deleting subnet {}...'.format(sn[K.NAME]))
-          c.network.delete_subnet(sn[K.sID])
-          myotc.msg('DONE\n')
+        tiers[2].append(('delete subnet {}'.format(sn[K.NAME]),
+                         'Deleting subnet {}'.format(sn[K.NAME]),
+                         lambda sn=sn: delete_subnet(sn)))
 
   # Delete all targeted networks
-  for n in c.network.networks():
+  for n in inv.items(K.network):
     if K.NAME in n:
       if n[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete net {}'.format(n[K.NAME]))
-        else:
-          myotc.msg('Deleting net {}...'.format(n[K.NAME]))
-          c.network.delete_network(n[K.sID])
-          myotc.msg('DONE\n')
-
-  # Delete internal dnz zone
-  zname = '{}.'.format(sid,def_priv_zone)
-  idnsz = c.dns.find_zone(myotc.sanitize_dns_name(zname),zone_type=K.private)
-  if idnsz:
-    if dryRun:
-      print('WONT delete internal DNS zone {}'.format(zname))
-    else:
-      myotc.msg('Deleting internal DNS zone {}...'.format(zname))
-      c.dns.delete_zone(idnsz)
-      myotc.msg('DONE\n')
+        tiers[3].append(('delete net {}'.format(n[K.NAME]),
+                         'Deleting net {}'.format(n[K.NAME]),
+                         lambda n=n: c.network.delete_network(n[K.sID])))
 
   # Delete network security groups
-  for g in c.network.security_groups():
+  for g in inv.items(K.sg):
     if K.NAME in g:
       if g[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete sg {}'.format(g[K.NAME]))
-        else:
-          myotc.msg('Deleting sg {}...'.format(g[K.NAME]))
-          c.network.delete_security_group(g[K.sID])
-          myotc.msg('DONE\n')
-
+        tiers[3].append(('delete sg {}'.format(g[K.NAME]),
+                         'Deleting sg {}'.format(g[K.NAME]),
+                         lambda g=g: c.network.delete_security_group(g[K.sID])))
 
   # Delete VPCs (aka routers)
-  for r in c.network.routers():
-    if K.NAME in r:
-      if r[K.NAME].startswith(prefix):
-        if dryRun:
-          print('WONT delete vpc {}'.format(r[K.NAME]))
-        else:
-          myotc.msg('Deleting vpc {}...'.format(r[K.NAME]))
-          c.network.delete_router(r[K.sID])
-          myotc.msg('DONE\n')
+  for r in routers:
+    tiers[3].append(('delete vpc {}'.format(r[K.NAME]),
+                     'Deleting vpc {}'.format(r[K.NAME]),
+                     lambda r=r: c.network.delete_router(r[K.sID])))
+
+  return tiers
+
+def delete(doing, fn):
+  ''' Delete a resource from a worker thread
+
+  :param str doing: progress message
+  :param callable fn: deletes the resource
+  :returns None|Future: result of ``fn``
+  '''
+  try:
+    myotc.msg('{}...'.format(doing))
+    res = fn()
+    myotc.msg('DONE\n')
+    return res
+  finally:
+    myotc.msg_flush()
+
+def run_tier(name, tier, jobs):
+  ''' Delete the resources of a tier concurrently
+
+  :param str name: tier name, used for messages
+  :param list tier: ``(wont, doing, fn)`` tuples as returned by ``targets``
+  :param int jobs: maximum number of deletions in flight
+  :returns bool: True if all the resources are gone
+  '''
+  if len(tier) == 0: return True
+  ok = True
+  with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+    tasks = [ (doing, pool.submit(delete, doing, fn)) for wont, doing, fn in tier ]
+    pending = []
+    for doing, task in tasks:
+      try:
+        res = task.result()
+        if not res is None: pending.append((doing, res))
+      except Exception as e:
+        myotc.msg('{} failed: {}\n'.format(doing, str(e)))
+        ok = False
+
+  if len(pending):
+    myotc.msg('Waiting for {n} {name} to be deleted...'.format(n = len(pending), name = name))
+    for doing, fut in pending:
+      try:
+        fut.result()
+      except Exception as e:
+        myotc.msg('\n{} failed: {}\n'.format(doing, str(e)))
+        ok = False
+    myotc.msg('DONE\n')
+  return ok
+
+KINDS = [ K.server, K.volume, K.fip, K.subnet, K.network, K.sg, K.router, K.public, K.private ]
+''' Resource types looked at by ``targets`` '''
+
+def snapshot(c, sid):
+  ''' Take the inventory needed to nuke an environment
+
+  :param openstack.connection c: Connection to OpenStack environment
+  :param str sid: system ID for the environment being destroyed
+  :returns inventory.Inventory: inventory, loaded in a single pass
+
+  Servers are filtered by name by the API.  The other services only
+  filter on exact names, so their resources are filtered by ``targets``.
+  '''
+  inv = inventory.Inventory(c, { K.server: { K.NAME: '^' + re.escape(sid) } })
+  inv.load(KINDS)
+  return inv
+
+def count(tiers):
+  ''' Number of resources to delete
+
+  :param list tiers: tiers as returned by ``targets``
+  :returns int: number of deletions
+  '''
+  return sum([len(tier) for tier in tiers])
+
+def show(tiers):
+  ''' Show what would be deleted
+
+  :param list tiers: tiers as returned by ``targets``
+  '''
+  for tier in tiers:
+    for wont, doing, fn in tier:
+      print('WONT {}'.format(wont))
+
+def execute(tiers, jobs = 8):
+  ''' Delete the resources of an environment
+
+  :param list tiers: tiers as returned by ``targets``
+  :param int jobs: (optional) maximum number of deletions in flight
+  :returns bool: True on success
+
+  All the deletions of a tier are issued concurrently, and the next
+  tier is only started once the resources of the previous one are
+  gone.  Deletion stops at the end of a tier if any of its deletions
+  failed.
 
+  Server deletes are all issued before any volume is looked at, and
+  waited for together by the shared waiter.  Each volume is deleted
+  as soon as it is detached, without waiting for the other servers.
+  '''
+  for name, tier in zip(TIERS, tiers):
+    if not run_tier(name, tier, jobs): return False
+  return True
+
+###################################################################
+#
+# Nuking several environments
+#
+###################################################################
+
+SHARED = [ K.fip, K.public ]
+''' Resource types not named after an environment, shared by all of them '''
+
+def sid_of(sids, name):
+  ''' Find the environment a resource name belongs to
+
+  :param set sids: system IDs to look for
+  :param str name: resource or DNS name
+  :returns None|str: longest SID followed by a dash or a dot in ``name``
+
+  SIDs may contain dashes, so ``ts-v2-vm1`` belongs to ``ts-v2``
+  rather than to ``ts`` when both are looked for.
+  '''
+  found = None
+  for m in re.finditer(r'[-.]', name):
+    if name[:m.start()] in sids: found = name[:m.start()]
+  return found
+
+def discover(inv, def_priv_zone):
+  ''' Find the environments deployed in a project
+
+  :param inventory.Inventory inv: project inventory
+  :param str def_priv_zone: Default private zone used by the environments
+  :returns set: SIDs tagged on servers, or found in VPC and private zone names
+  '''
+  found = set()
+  for s in inv.items(K.server):
+    for tag in s.get(K.tags) or []:
+      if tag.startswith(K.SID + '='): found.add(tag[len(K.SID)+1:])
+  for r in inv.items(K.router):
+    m = re.match(r'^(.+)-vpc\d+$', r.get(K.NAME) or '')
+    if m: found.add(m.group(1))
+  suffix = '.' + myotc.sanitize_dns_name(def_priv_zone)
+  for zn in inv.items(K.private):
+    if (zn.get(K.NAME) or '').endswith(suffix): found.add(zn[K.NAME][:-len(suffix)])
+  return found
+
+def select(inv, patterns, def_priv_zone):
+  ''' Find the environments to nuke
+
+  :param inventory.Inventory inv: project inventory
+  :param list patterns: SIDs or shell-style patterns, e.g. ``train-*``
+  :param str def_priv_zone: Default private zone used by the environments
+  :returns list: sorted SIDs
+
+  Patterns are matched against the SIDs found by ``discover``.
+  SIDs given without wildcards are always selected.
+  '''
+  sids = set()
+  found = None
+  for p in patterns:
+    if not any([ch in p for ch in '*?[']):
+      sids.add(p)
+      continue
+    if found is None: found = discover(inv, def_priv_zone)
+    sids.update(fnmatch.filter(found, p))
+  return sorted(sids)
+
+def created(res):
+  ''' Creation time of a resource
+
+  :param resource res: resource with a ``created_at`` timestamp
+  :returns float: seconds since the epoch
+  '''
+  ts = res[K.created_at]
+  if ts.endswith('Z'): ts = ts[:-1] + '+00:00'
+  return datetime.fromisoformat(ts).timestamp()
+
+def newest(inv):
+  ''' Creation time of the newest server
+
+  :param inventory.Inventory inv: environment inventory
+  :returns None|float: seconds since the epoch, None if there are no servers
+  '''
+  times = [created(s) for s in inv.items(K.server) if s.get(K.created_at)]
+  if len(times) == 0: return None
+  return max(times)
+
+def split(inv, sids):
+  ''' Split a project inventory by environment
+
+  :param inventory.Inventory inv: project inventory, see ``KINDS``
+  :param list sids: system IDs of the environments
+  :returns dict: ``Inventory`` for each SID
+
+  Resources are assigned to the longest SID prefixing their name,
+  in a single pass.  Floating IPs and public zones are shared.
+  '''
+  sids = set(sids)
+  def key(kind, res):
+    if res.get(K.NAME) is None: return None
+    return sid_of(sids, res[K.NAME])
+  return inv.partition(key, [kind for kind in KINDS if not kind in SHARED], SHARED, sids)
+
+def split_records(c, inv, sids, def_public_zone):
+  ''' List the public zone record sets once, split by environment
+
+  :param openstack.connection c: Connection to OpenStack environment
+  :param inventory.Inventory inv: project inventory
+  :param list sids: system IDs of the environments
+  :param None|str def_public_zone: Public DNS zone where records have been stored.
+  :returns dict: list of record sets for each SID
+
+  ``CNAME`` records not named after an environment belong to the
+  environment of the host they point to.
+  '''
+  records = { sid: [] for sid in sids }
+  if def_public_zone is None: return records
+  zn = inv.find(K.public, myotc.sanitize_dns_name(def_public_zone))
+  if zn is None: return records
+  sids = set(sids)
+  for rs in c.dns.recordsets(zn):
+    if not K.NAME in rs: continue
+    sid = sid_of(sids, rs[K.NAME])
+    if sid is None and rs.get(K.type) == K.CNAME:
+      for r in rs[K.records]:
+        sid = sid_of(sids, r)
+        if not sid is None: break
+    if not sid is None: records[sid].append(rs)
+  return records
+
+def execute_many(envs, jobs = 8, procs = 4):
+  ''' Delete the resources of several environments concurrently
+
+  :param dict envs: tiers as returned by ``targets`` for each SID
+  :param int jobs: (optional) maximum number of deletions in flight in each environment
+  :param int procs: (optional) number of environments deleted concurrently
+  :returns dict: True for each SID deleted successfully
+
+  Each environment goes through its tiers on its own, see ``execute``.
+  '''
+  def run(tiers):
+    try:
+      return execute(tiers, jobs)
+    finally:
+      myotc.msg_flush()
 
-  return
+  with ThreadPoolExecutor(max_workers = max(1,procs)) as pool:
+    tasks = { sid: pool.submit(run, tiers) for sid, tiers in envs.items() }
+    return { sid: task.result() for sid, task in tasks.items() }
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+'''
+Orphaned resource scanner
+
+Interrupted deployments and nukes leave resources behind that nothing
+uses any more.  Each resource type is listed once, and the listings
+are joined in memory to find:
+
+* volumes that are available and not attached to a server
+* floating IPs not bound to a port
+* security groups not used by any port or server
+* subnets not connected to a router
+* DNS records pointing to addresses no longer in use
+
+Orphans are grouped by the environment their name belongs to, and
+are deleted with the nuke engine, see ``nukes.execute``.  Resources
+not named after a known environment are reported but never deleted,
+and neither are subnets: a subnet may be kept off the routers on
+purpose.
+'''
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+import consts as K
+import waiter
+import inventory
+import nukes
+
+KINDS = nukes.KINDS
+''' Resource types looked at by ``scan`` '''
+
+ADDRESS_RECORDS = ('A', 'AAAA')
+''' DNS record types holding addresses '''
+
+ROUTER_PORTS = 'network:router_interface'
+''' Prefix of the device owner of router interface ports '''
+
+def snapshot(c, jobs = 4):
+  ''' List the resources needed to find orphans
+
+  :param openstack.connection c: Connection to OpenStack environment
+  :param int jobs: (optional) number of concurrent list calls
+  :returns tuple: ``(inv, ports, records)`` with the inventory, the ports and ``(zone, recordset)`` tuples
+
+  Record sets are listed once for each DNS zone.
+  '''
+  inv = inventory.Inventory(c)
+  inv.load(KINDS, jobs)
+  zones = inv.items(K.public) + inv.items(K.private)
+  with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+    ports = pool.submit(lambda: list(c.network.ports()))
+    rsets = list(pool.map(lambda zn: list(c.dns.recordsets(zn)), zones))
+    ports = ports.result()
+  records = [ (zn, rs) for zn, rsl in zip(zones, rsets) for rs in rsl ]
+  return inv, ports, records
+
+def group(sids, name):
+  ''' Find the environment a resource belongs to
+
+  :param set sids: known system IDs
+  :param str name: resource or DNS name
+  :returns str: SID, or an empty string if the name does not belong to a known environment
+  '''
+  sid = nukes.sid_of(sids, name)
+  if sid is None: return ''
+  return sid
+
+def orphan(sid, kind, name, why, tier, fn):
+  ''' Describe an orphan
+
+  :param str sid: environment the resource belongs to
+  :param str kind: resource type, used for messages
+  :param str name: resource name
+  :param str why: reason the resource is an orphan
+  :param int tier: index in ``nukes.TIERS`` of the deletion tier
+  :param None|callable fn: deletes the resource, may return a future, None if it is only reported
+  :returns dict: orphan
+  '''
+  return { K.SID: sid, K.type: kind, K.NAME: name, 'why': why, 'tier': tier, 'fn': fn }
+
+def scan(c, inv, ports, records, def_priv_zone = K.DEFAULT_PRIVATE_DNS_ZONE, known = ()):
+  ''' Find orphaned resources
+
+  :param openstack.connection c: Connection to OpenStack environment
+  :param inventory.Inventory inv: project inventory, see ``KINDS``
+  :param list ports: project ports
+  :param list records: ``(zone, recordset)`` tuples of the project DNS zones
+  :param str def_priv_zone: (optional) Default private zone used by the environments
+  :param list known: (optional) SIDs to group by, in addition to the ones found by ``nukes.discover``
+  :returns list: orphans, see ``orphan``
+
+  Public zones may hold records for hosts outside the project, so
+  their records are only looked at when named after a host of an
+  environment, i.e. with a dash in their host name.  Private zone
+  records are looked at when their addresses belong to a project
+  subnet.
+  '''
+  sids = nukes.discover(inv, def_priv_zone) | set(known)
+  w = waiter.get(c)
+  found = []
+
+  # Addresses in use
+  used = set()
+  for p in ports:
+    for f in p.get('fixed_ips') or []:
+      used.add(f['ip_address'])
+  for ip in inv.items(K.fip):
+    if not ip.get(K.port_id) is None: used.add(ip['floating_ip_address'])
+  for s in inv.items(K.server):
+    for net in s.get(K.addresses) or {}:
+      for addr in s[K.addresses][net]:
+        used.add(addr[K.addr])
+
+  # DNS records
+  cidrs = [ipaddress.ip_network(sn['cidr'], strict = False) for sn in inv.items(K.subnet) if sn.get('cidr')]
+  def in_subnet(addr):
+    addr = ipaddress.ip_address(addr)
+    return any([addr in cidr for cidr in cidrs if cidr.version == addr.version])
+
+  by_addr = {}
+  for zn, rs in records:
+    if not rs.get(K.type) in ADDRESS_RECORDS or not K.NAME in rs: continue
+    addrs = rs[K.records] or []
+    for addr in addrs: by_addr.setdefault(addr, []).append(rs)
+    if len(addrs) == 0 or any([addr in used for addr in addrs]): continue
+    if zn.get('zone_type', K.public) == K.private:
+      if not all([in_subnet(addr) for addr in addrs]): continue
+    elif not '-' in rs[K.NAME].split('.')[0]:
+      continue
+    found.append(orphan(group(sids, rs[K.NAME]), 'record', rs[K.NAME],
+                        'points to unused {}'.format(', '.join(addrs)), 0,
+                        lambda rs=rs, zn=zn: c.dns.delete_recordset(rs, zn)))
+
+  # Floating IPs, named after the DNS records pointing to them
+  for ip in inv.items(K.fip):
+    if not ip.get(K.port_id) is None: continue
+    addr = ip['floating_ip_address']
+    names = [rs[K.NAME] for rs in by_addr.get(addr, [])]
+    found.append(orphan(group(sids, names[0]) if len(names) else '', 'fip', addr,
+                        'not bound to a port' + (' ({})'.format(', '.join(names)) if len(names) else ''), 0,
+                        lambda ip=ip: c.network.delete_ip(ip)))
+
+  # Volumes
+  def delete_volume(v):
+    c.block_store.delete_volume(v)
+    return w.deleted(K.volume, v)
+
+  for v in inv.items(K.volume):
+    if v.get(K.status) != 'available' or len(v.get(K.attachments) or []): continue
+    name = v.get(K.NAME) or v[K.sID]
+    found.append(orphan(group(sids, name), 'volume', name,
+                        '{} GB, not attached'.format(v.get('size')), 1,
+                        lambda v=v: delete_volume(v)))
+
+  # Subnets
+  routed = set()
+  for p in ports:
+    if not (p.get('device_owner') or '').startswith(ROUTER_PORTS): continue
+    for f in p.get('fixed_ips') or []:
+      routed.add(f['subnet_id'])
+  for sn in inv.items(K.subnet):
+    if sn[K.sID] in routed: continue
+    found.append(orphan(group(sids, sn.get(K.NAME) or ''), 'subnet', sn.get(K.NAME) or sn[K.sID],
+                        'not connected to a router', 2, None))
+
+  # Security groups
+  in_use = set()
+  for p in ports:
+    in_use.update(p.get('security_group_ids') or [])
+  names = set()
+  for s in inv.items(K.server):
+    for g in s.get('security_groups') or []:
+      names.add(g.get(K.NAME))
+  groups = inv.items(K.sg)
+  in_use.update([g[K.sID] for g in groups if g.get(K.NAME) in names])
+  for g in groups:
+    if not g[K.sID] in in_use: continue
+    for rule in g.get(K.security_group_rules) or []:
+      if not rule.get('remote_group_id') is None: in_use.add(rule['remote_group_id'])
+  for g in groups:
+    if g[K.sID] in in_use or g.get(K.NAME) == 'default': continue
+    found.append(orphan(group(sids, g.get(K.NAME) or ''), 'sg', g.get(K.NAME) or g[K.sID],
+                        'not used by any port', 3,
+                        lambda g=g: c.network.delete_security_group(g[K.sID])))
+
+  return found
+
+def deletable(o):
+  ''' Check if an orphan may be deleted
+
+  :param dict o: orphan, see ``orphan``
+  :returns bool: True if the orphan belongs to an environment and can be deleted
+  '''
+  return o[K.SID] != '' and not o['fn'] is None
+
+def show(found):
+  ''' Show orphans grouped by environment
+
+  :param list found: orphans, see ``scan``
+
+  Orphans that are only reported are marked as kept.
+  '''
+  sids = sorted(set([o[K.SID] for o in found]))
+  for sid in sids:
+    items = [o for o in found if o[K.SID] == sid]
+    print('# {sid}: {n} orphans'.format(sid = sid or '(no SID)', n = len(items)))
+    for o in sorted(items, key = lambda o: (o['tier'], o[K.type], o[K.NAME])):
+      print('{type:8} {name:32} {why}{kept}'.format(type = o[K.type], name = o[K.NAME], why = o['why'],
+                                                    kept = '' if deletable(o) else ' (kept)'))
+  print('# {n} orphans in {e} environments'.format(n = len(found), e = len(sids)))
+
+def tiers(found):
+  ''' Deletion tiers for the nuke engine
+
+  :param list found: orphans, see ``scan``
+  :returns list: tiers as returned by ``nukes.targets``, orphans that are only reported are left out
+  '''
+  res = [ [] for t in nukes.TIERS ]
+  for o in found:
+    if not deletable(o): continue
+    res[o['tier']].append(('delete {} {}'.format(o[K.type], o[K.NAME]),
+                           'Deleting {} {}'.format(o[K.type], o[K.NAME]),
+                           o['fn']))
+  return res
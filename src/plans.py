@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+'''
+Two-phase deployment
+
+Deployment functions perform every modification through ``act``.
+Normally the action is executed right away.  When planning, the
+action is recorded in a ``Plan`` instead, and a placeholder ``Ref`` is
+returned in place of the resource that would have been created.
+
+A saved plan can later be applied without repeating the discovery
+phase.  Placeholders in the recorded arguments are replaced by the
+resources created by earlier steps.
+'''
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+import consts as K
+import myotc
+import inventory
+import ypp
+
+PLAN_VERSION = 1
+
+OPS = {}
+''' Registered actions: ``name => (function, resource type, remove)`` '''
+DERIVED = {}
+''' Computed attributes that can be referenced from placeholders '''
+
+TOKEN_RE = re.compile(r'^@(\d+)(?:\.(\w+))?$')
+''' Placeholder reference in recorded arguments '''
+
+def op(name, kind = None, remove = False):
+  ''' Register an action
+
+  :param str name: action name
+  :param str kind: (optional) inventory resource type affected by the action
+  :param bool remove: (optional) True if the action deletes the resource
+
+  The decorated function is called as ``fn(c, **args)``.  Actions that
+  take an ``id`` argument modify an existing resource, actions without
+  it create a new one.
+  '''
+  def register(fn):
+    OPS[name] = (fn, kind, remove)
+    return fn
+  return register
+
+def derived(name):
+  ''' Register a computed attribute
+
+  :param str name: attribute name
+
+  The decorated function is called with the resource and returns
+  the attribute value.
+  '''
+  def register(fn):
+    DERIVED[name] = fn
+    return fn
+  return register
+
+class Ref(dict):
+  ''' Placeholder for a resource that will be created when a plan is applied
+
+  :param int step: plan step creating the resource
+  :param dict attrs: arguments of the action
+
+  Scalar arguments (e.g. ``name`` or ``cidr``) are available as is.
+  Any other attribute returns a reference token that is resolved
+  when the plan is applied.
+  '''
+  def __init__(self, step, attrs):
+    super().__init__()
+    self.step = step
+    for k in attrs:
+      if attrs[k] is None or isinstance(attrs[k], (str, int, float, bool)):
+        dict.__setitem__(self, k, attrs[k])
+    dict.__setitem__(self, K.sID, '@{}.{}'.format(step, K.sID))
+
+  def __getitem__(self, k):
+    if dict.__contains__(self, k): return dict.__getitem__(self, k)
+    return '@{}.{}'.format(self.step, k)
+
+  def __getattr__(self, k):
+    if k.startswith('_'): raise AttributeError(k)
+    return self[k]
+
+def is_ref(res):
+  ''' Check if a resource is a placeholder
+
+  :param mixed res: resource to check
+  :returns bool: True if ``res`` is a ``Ref``
+  '''
+  return isinstance(res, Ref)
+
+def freeze(v):
+  ''' Convert action arguments to plain data
+
+  :param mixed v: value to convert
+  :returns mixed: value that can be saved in a plan file
+  '''
+  if isinstance(v, Ref): return '@{}'.format(v.step)
+  if isinstance(v, dict):
+    if type(v) != dict and K.sID in v: return v[K.sID]
+    return { k: freeze(v[k]) for k in v }
+  if isinstance(v, (list, tuple)): return [ freeze(i) for i in v ]
+  return v
+
+def resolve(v, results):
+  ''' Replace reference tokens with values from created resources
+
+  :param mixed v: value to resolve
+  :param dict results: resources created so far, indexed by step
+  :returns mixed: resolved value
+  '''
+  if isinstance(v, str):
+    m = TOKEN_RE.match(v)
+    if not m: return v
+    res = results[int(m.group(1))]
+    if m.group(2) is None: return res
+    if m.group(2) in DERIVED: return DERIVED[m.group(2)](res)
+    return res[m.group(2)]
+  if isinstance(v, dict): return { k: resolve(v[k], results) for k in v }
+  if isinstance(v, list): return [ resolve(i, results) for i in v ]
+  return v
+
+class Plan:
+  ''' Recorded deployment actions
+
+  :param str sid: system ID
+  :param str fingerprint: fingerprint of the resources found during planning
+  :param kwargs meta: additional data to save with the plan
+  '''
+  def __init__(self, sid, fingerprint, **meta):
+    self.lock = threading.Lock()
+    self.ctx = threading.local()
+    self.steps = []
+    self.max_wave = 0
+    self.meta = dict(meta)
+    self.meta['version'] = PLAN_VERSION
+    self.meta['sid'] = sid
+    self.meta['fingerprint'] = fingerprint
+    self.meta['created'] = time.time()
+
+  def context(self, wave = None, group = None):
+    ''' Set the execution context of steps recorded by this thread
+
+    :param int wave: (optional) execution wave, defaults to after all previous waves
+    :param str group: (optional) steps in the same group are executed sequentially
+
+    Groups within a wave are applied concurrently.
+    '''
+    with self.lock:
+      if wave is None: wave = self.max_wave + 1
+      self.max_wave = max(self.max_wave, wave)
+    self.ctx.wave = wave
+    self.ctx.group = group
+
+  def add(self, name, args):
+    ''' Record an action
+
+    :param str name: action name
+    :param dict args: action arguments
+    :returns Ref: placeholder for the resulting resource
+    '''
+    with self.lock:
+      step = len(self.steps) + 1
+      self.steps.append({
+        'step': step,
+        'op': name,
+        'args': freeze(args),
+        'wave': getattr(self.ctx, 'wave', 0),
+        'group': getattr(self.ctx, 'group', None),
+      })
+    return Ref(step, args)
+
+  def report(self):
+    ''' Print the recorded actions '''
+    if len(self.steps) == 0:
+      print('No changes')
+      return
+    for s in self.steps:
+      print(describe(s))
+
+  def save(self, fname):
+    ''' Save plan to a file
+
+    :param str fname: file name
+
+    Plans hold rendered ``user_data``, including generated passwords,
+    so the file can only be read by its owner.
+    '''
+    data = dict(self.meta)
+    data['steps'] = self.steps
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if hasattr(os, 'fchmod'): os.fchmod(fd, 0o600) # Also for an existing file
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(yaml.safe_dump(data))
+
+def describe(step):
+  ''' Describe a plan step
+
+  :param dict step: plan step
+  :returns str: short description
+  '''
+  args = step['args']
+  for k in (K.NAME, K.sID):
+    if k in args:
+      target = args[k]
+      break
+  else:
+    target = ''
+  return '{step:4} {op:18} {target}'.format(step=step['step'], op=step['op'], target=target)
+
+def load(fname):
+  ''' Load a plan from a file
+
+  :param str fname: file name
+  :returns dict: plan data
+  '''
+  with open(fname, 'r') as fp:
+    plan = yaml.safe_load(fp)
+  if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+    raise ValueError('{}: not a valid plan file'.format(fname))
+  return plan
+
+def context(opts, wave = None, group = None):
+  ''' Set the plan context if planning
+
+  :param dict opts: session options
+  :param int wave: (optional) execution wave
+  :param str group: (optional) execution group
+
+  See ``Plan.context``.
+  '''
+  plan = opts.get(K.PLAN)
+  if not plan is None: plan.context(wave, group)
+
+def act(opts, action, **args):
+  ''' Perform or record an action
+
+  :param dict opts: session options
+  :param str action: action name
+  :param kwargs args: action arguments
+  :returns resource|Ref: the resulting resource, or a placeholder when planning
+
+  The session inventory is updated with the result.  If a journal
+  is in use, completed actions are recorded, and resources created
+  by a previous run are reused instead of being created again.
+  '''
+  fn, kind, remove = OPS[action]
+  inv = opts.get(K.INVENTORY)
+  if inv is None: kind = None
+  plan = opts.get(K.PLAN)
+  journal = opts.get(K.JOURNAL)
+  if plan is None:
+    if not journal is None and not kind is None and not K.sID in args:
+      done = journal.done(action, args)
+      if not done is None and not done['id'] is None:
+        res = inv.find(kind, done['id'])
+        if not res is None: return res
+    res = fn(opts[K.CONN], **args)
+    if not journal is None: journal.record(action, kind, args, res)
+  else:
+    res = plan.add(action, args)
+    if K.sID in args and not remove:
+      # Existing resource, keep it as found
+      return None if kind is None else inv.find(kind, args[K.sID])
+
+  if not kind is None:
+    if remove:
+      inv.remove(kind, { K.sID: args[K.sID] })
+    elif not res is None:
+      inv.add(kind, res)
+  return res
+
+def source_hash(defines = None):
+  ''' Hash the source of a YAML configuration
+
+  :param list defines: (optional) pre-processor definitions given on the command line
+  :returns str: hash of the files read by ``ypp.process`` and of ``defines``
+
+  Generated secrets, e.g. ``$PWGEN:`` passwords, are salted anew
+  every time a configuration is processed, so the source files are
+  hashed rather than the processed configuration.
+  '''
+  h = hashlib.sha256()
+  for fname in ypp.yaml_sources:
+    with open(fname, 'rb') as fp:
+      h.update(hashlib.sha256(fp.read()).digest())
+  h.update(json.dumps(sorted(defines or [])).encode('utf-8'))
+  return h.hexdigest()
+
+def fingerprint(inv, sid):
+  ''' Fingerprint the resources belonging to a SID
+
+  :param inventory.Inventory inv: project inventory
+  :param str sid: system ID
+  :returns str: hash that changes when resources are created, deleted or modified
+  '''
+  h = hashlib.sha256()
+  for kind in sorted(inventory.kinds()):
+    rows = []
+    for r in inv.items(kind):
+      name = r[K.NAME] if K.NAME in r else None
+      if not isinstance(name, str): continue
+      if not name.startswith(sid + '-') and not name.startswith(sid + '.'): continue
+      rows.append([ r[k] if k in r else None for k in (K.sID, K.NAME, K.status, K.updated_at, 'revision_number') ])
+    rows.sort(key = lambda row: str(row[0]))
+    h.update(json.dumps([kind, rows], default=str).encode('utf-8'))
+  return h.hexdigest()
+
+def run_steps(c, steps, results):
+  ''' Execute plan steps sequentially
+
+  :param openstack.connection c: OpenStack connection
+  :param list steps: steps to execute
+  :param dict results: resources created so far, indexed by step
+  '''
+  try:
+    for s in steps:
+      fn = OPS[s['op']][0]
+      results[s['step']] = fn(c, **resolve(s['args'], results))
+  finally:
+    myotc.msg_flush()
+
+def apply(c, plan, jobs = 4):
+  ''' Apply a plan
+
+  :param openstack.connection c: OpenStack connection
+  :param dict plan: plan data as returned by ``load``
+  :param int jobs: (optional) number of groups to execute concurrently
+  :returns bool: True on success
+
+  Waves are executed in order.  Steps without a group are executed
+  first, then all groups of the wave concurrently.  Execution stops
+  at the end of a wave if any of its steps failed.
+  '''
+  waves = {}
+  for s in plan['steps']:
+    waves.setdefault(s['wave'], []).append(s)
+
+  results = {}
+  with ThreadPoolExecutor(max_workers = max(1,jobs)) as pool:
+    for wave in sorted(waves):
+      groups = {}
+      for s in waves[wave]:
+        groups.setdefault(s['group'], []).append(s)
+      try:
+        if None in groups: run_steps(c, groups.pop(None), results)
+      except Exception as e:
+        myotc.msg('Plan step failed: {}\n'.format(str(e)))
+        return False
+      tasks = [ pool.submit(run_steps, c, groups[g], results) for g in groups ]
+      ok = True
+      for t in tasks:
+        try:
+          t.result()
+        except Exception as e:
+          myotc.msg('Plan step failed: {}\n'.format(str(e)))
+          ok = False
+      if not ok: return False
+  return True
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+'''
+API call profiling
+
+When enabled, every public method of the SDK service proxies
+(``c.compute``, ``c.network``, ...) and every HTTP request made by the
+connection session is timed.  HTTP requests are attributed to the
+proxy call that issued them.  A summary table is printed at exit and
+can also be saved as JSON.
+
+When profiling is not enabled, connections are left untouched.
+'''
+import atexit
+import json
+import sys
+import threading
+import time
+import types
+
+enabled = False
+''' True if API calls are being profiled '''
+json_file = None
+''' File where to save the profile data '''
+
+stats = {}
+''' Call statistics indexed by ``(service, method)`` '''
+stats_lock = threading.Lock()
+current = threading.local()
+''' Proxy call being executed by each thread '''
+
+class Stat:
+  ''' Statistics for an API call
+
+  :param str service: service type
+  :param str method: proxy method or HTTP verb
+  '''
+  def __init__(self, service, method):
+    self.service = service
+    self.method = method
+    self.resource = None
+    self.times = []
+    self.http = 0
+    self.bytes = 0
+    self.throttled = 0.0
+
+  def percentile(self, pct):
+    ''' Nearest-rank percentile of the call times
+
+    :param int pct: percentile
+    :returns float: call time in seconds
+    '''
+    if len(self.times) == 0: return 0.0
+    times = sorted(self.times)
+    return times[max(0, min(len(times), -(-len(times) * pct // 100)) - 1)]
+
+  def data(self):
+    ''' Summary of the statistics
+
+    :returns dict: summary
+    '''
+    return {
+      'service': self.service,
+      'method': self.method,
+      'resource': self.resource,
+      'calls': len(self.times),
+      'http': self.http,
+      'bytes': self.bytes,
+      'throttled': self.throttled,
+      'total': sum(self.times),
+      'p50': self.percentile(50),
+      'p95': self.percentile(95),
+      'max': max(self.times) if len(self.times) else 0.0,
+    }
+
+class Call:
+  ''' A proxy call in progress
+
+  :param str service: service type
+  :param str method: proxy method name
+  '''
+  def __init__(self, service, method):
+    self.service = service
+    self.method = method
+    self.resource = None
+    self.elapsed = 0.0
+    self.http = 0
+    self.bytes = 0
+    self.throttled = 0.0
+
+  def found(self, obj):
+    ''' Note the resource type handled by the call
+
+    :param mixed obj: argument or result of the call
+    '''
+    if self.resource is None and hasattr(obj, 'resource_key'):
+      self.resource = type(obj).__name__
+
+  def done(self):
+    ''' Add the call to the statistics '''
+    with stats_lock:
+      key = (self.service, self.method)
+      if not key in stats: stats[key] = Stat(self.service, self.method)
+      st = stats[key]
+      if st.resource is None: st.resource = self.resource
+      st.times.append(self.elapsed)
+      st.http += self.http
+      st.bytes += self.bytes
+      st.throttled += self.throttled
+
+def timed_iter(call, gen):
+  ''' Time the iteration of a generator returned by a proxy call
+
+  :param Call call: the proxy call
+  :param generator gen: generator to wrap
+  :returns generator: generator yielding the same items
+
+  Only the time spent fetching items is counted, not the time the
+  caller spends processing them.
+  '''
+  try:
+    while True:
+      current.call = call
+      start = time.perf_counter()
+      try:
+        item = next(gen)
+      except StopIteration:
+        return
+      finally:
+        call.elapsed += time.perf_counter() - start
+        current.call = None
+      call.found(item)
+      yield item
+  finally:
+    call.done()
+
+def timed_method(service, name, fn):
+  ''' Wrap a proxy method
+
+  :param str service: service type
+  :param str name: method name
+  :param callable fn: bound method
+  :returns callable: wrapped method
+  '''
+  def wrapper(*args, **kwargs):
+    if not getattr(current, 'call', None) is None:
+      # Nested proxy call, counted as part of the outer call
+      return fn(*args, **kwargs)
+    call = Call(service, name)
+    for a in args: call.found(a)
+    current.call = call
+    start = time.perf_counter()
+    try:
+      res = fn(*args, **kwargs)
+    finally:
+      call.elapsed += time.perf_counter() - start
+      current.call = None
+    if isinstance(res, types.GeneratorType):
+      return timed_iter(call, res)
+    call.found(res)
+    call.done()
+    return res
+  wrapper.__name__ = name
+  wrapper.__doc__ = fn.__doc__
+  return wrapper
+
+def wrap_proxy(service, proxy):
+  ''' Wrap the public methods of a service proxy
+
+  :param str service: service type
+  :param Proxy proxy: service proxy
+  :returns Proxy: ``proxy``
+  '''
+  for name in dir(type(proxy)):
+    if name.startswith('_'): continue
+    fn = getattr(type(proxy), name, None)
+    if not isinstance(fn, types.FunctionType): continue
+    setattr(proxy, name, timed_method(service, name, getattr(proxy, name)))
+  return proxy
+
+class Proxies(dict):
+  ''' Proxy cache of a connection that wraps proxies as they are created '''
+  def __setitem__(self, service, proxy):
+    super().__setitem__(service, wrap_proxy(service, proxy))
+
+def timed_request(request):
+  ''' Wrap the request method of a session
+
+  :param callable request: bound ``Session.request`` method
+  :returns callable: wrapped method
+  '''
+  def wrapper(url, method, *args, **kwargs):
+    call = getattr(current, 'call', None)
+    if call is None:
+      filt = kwargs.get('endpoint_filter') or {}
+      call = Call(filt.get('service_type', 'session'), method)
+      current.call = call
+      start = time.perf_counter()
+    else:
+      start = None
+    try:
+      resp = request(url, method, *args, **kwargs)
+    finally:
+      if not start is None:
+        call.elapsed = time.perf_counter() - start
+        current.call = None
+    call.http += 1
+    if 'Content-Length' in resp.headers:
+      call.bytes += int(resp.headers['Content-Length'])
+    elif not kwargs.get('stream'):
+      call.bytes += len(resp.content)
+    if not start is None: call.done()
+    return resp
+  return wrapper
+
+def throttled(delay):
+  ''' Account time a call spent throttled
+
+  :param float delay: time in seconds
+  '''
+  call = getattr(current, 'call', None)
+  if not call is None: call.throttled += delay
+
+def wrap(c):
+  ''' Profile the API calls of a connection
+
+  :param openstack.connection c: OpenStack connection
+  :returns openstack.connection: ``c``
+
+  Does nothing unless profiling is enabled.
+  '''
+  if not enabled: return c
+  for service in list(c._proxies):
+    wrap_proxy(service, c._proxies[service])
+  c._proxies = Proxies(c._proxies)
+  c.session.request = timed_request(c.session.request)
+  return c
+
+def enable(fname = None):
+  ''' Enable API call profiling
+
+  :param str fname: (optional) file where to save the profile data as JSON
+  '''
+  global enabled, json_file
+  enabled = True
+  json_file = fname
+  atexit.register(report)
+
+def report():
+  ''' Print the profile summary and save the JSON data if requested '''
+  with stats_lock:
+    rows = sorted([st.data() for st in stats.values()], key = lambda r: r['total'], reverse = True)
+
+  fmt = '{service:12} {method:32} {calls:>6} {http:>6} {bytes:>10} {total:>9} {p50:>8} {p95:>8} {max:>8} {throttled:>9}\n'
+  sys.stderr.write(fmt.format(service='service', method='method', calls='calls', http='http',
+                        bytes='bytes', total='total', p50='p50', p95='p95', max='max', throttled='throttled'))
+  for r in rows:
+    sys.stderr.write(fmt.format(**dict(r,
+                            throttled = '{:.3f}'.format(r['throttled']),
+                            total = '{:.3f}'.format(r['total']),
+                            p50 = '{:.3f}'.format(r['p50']),
+                            p95 = '{:.3f}'.format(r['p95']),
+                            max = '{:.3f}'.format(r['max']))))
+  sys.stderr.write(fmt.format(service='', method='TOTAL',
+                        calls = sum([r['calls'] for r in rows]),
+                        http = sum([r['http'] for r in rows]),
+                        bytes = sum([r['bytes'] for r in rows]),
+                        total = '{:.3f}'.format(sum([r['total'] for r in rows])),
+                        throttled = '{:.3f}'.format(sum([r['throttled'] for r in rows])),
+                        p50 = '', p95 = '', max = ''))
+
+  if not json_file is None:
+    with open(json_file, 'w') as fp:
+      json.dump(rows, fp, indent = 2)
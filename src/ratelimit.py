@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+'''
+Client-side API rate limiting
+
+Parallel deployments can easily exceed the request rates allowed by
+the cloud.  Requests made by a connection are throttled with a token
+bucket per service, and the number of requests in flight can be
+capped.  Responses with HTTP status 429 are retried after the delay
+given by the ``Retry-After`` header, or with exponential backoff.
+
+Limits are read from pre-processor variables, so they can be set
+with ``-D`` (also through ``MYOTC_OPTS``), the environment or
+``#define`` statements:
+
+- ``API_RATE``: default requests per second for each service
+- ``API_RATE_COMPUTE``, ``API_RATE_NETWORK``, ``API_RATE_DNS``,
+  ``API_RATE_BLOCK_STORE``, ``API_RATE_VPC``: per service rates
+- ``API_BURST``: number of requests that can be made at once
+- ``API_INFLIGHT``: maximum number of requests in flight
+- ``API_RETRIES``: number of times a throttled request is retried
+
+Rates of 0 (the default) mean no limit.
+'''
+import atexit
+import email.utils
+import random
+import sys
+import threading
+import time
+import keystoneauth1.exceptions
+import ypp
+import profiler
+
+BUDGETS = {
+  'compute': 'COMPUTE',
+  'network': 'NETWORK',
+  'dns': 'DNS',
+  'block-storage': 'BLOCK_STORE',
+  'block_storage': 'BLOCK_STORE',
+  'volume': 'BLOCK_STORE',
+  'volumev2': 'BLOCK_STORE',
+  'volumev3': 'BLOCK_STORE',
+  'vpc': 'VPC',
+}
+''' Rate budget used by each service type '''
+
+THROTTLED = 429
+''' HTTP status returned by throttled requests '''
+
+MAX_BACKOFF = 60
+''' Maximum delay between retries in seconds '''
+
+stats = { 'rate': 0.0, 'inflight': 0.0, 'retry': 0.0, 'retries': 0 }
+''' Time spent throttled, and number of retried requests '''
+stats_lock = threading.Lock()
+
+class TokenBucket:
+  ''' Token bucket rate limiter
+
+  :param float rate: tokens added per second
+  :param float burst: bucket capacity
+  '''
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = max(1.0, burst)
+    self.tokens = self.burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    ''' Take a token, waiting if none is available
+
+    :returns float: time waited in seconds
+
+    Tokens are reserved in order, so callers are served in the
+    order they arrive.
+    '''
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      self.tokens -= 1
+      delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+    if delay > 0: time.sleep(delay)
+    return delay
+
+def setting(name, default):
+  ''' Read a numeric setting
+
+  :param str name: pre-processor variable name
+  :param float default: value if not defined
+  :returns float: setting value
+  '''
+  value = ypp.vars(name)
+  if value is None or str(value).strip() == '': return default
+  try:
+    return float(value)
+  except ValueError:
+    sys.stderr.write('Ignoring invalid {name}: {value}\n'.format(name=name, value=value))
+    return default
+
+def throttled(kind, delay):
+  ''' Account time spent throttled
+
+  :param str kind: ``rate``, ``inflight`` or ``retry``
+  :param float delay: time in seconds
+  '''
+  if delay <= 0: return
+  with stats_lock:
+    stats[kind] += delay
+    if kind == 'retry': stats['retries'] += 1
+  profiler.throttled(delay)
+
+def retry_delay(resp, attempt):
+  ''' Delay before retrying a throttled request
+
+  :param requests.Response resp: throttled response
+  :param int attempt: number of attempts made so far
+  :returns float: delay in seconds
+  '''
+  value = resp.headers.get('Retry-After') if not resp is None else None
+  if value:
+    try:
+      return min(MAX_BACKOFF, max(0.0, float(value)))
+    except ValueError:
+      try:
+        when = email.utils.parsedate_to_datetime(value)
+        return min(MAX_BACKOFF, max(0.0, when.timestamp() - time.time()))
+      except (TypeError, ValueError):
+        pass
+  return min(MAX_BACKOFF, 2 ** attempt) + random.uniform(0, 1)
+
+def limited_request(request, buckets, inflight, retries):
+  ''' Wrap the request method of a session
+
+  :param callable request: bound ``Session.request`` method
+  :param dict buckets: token buckets indexed by budget
+  :param None|threading.Semaphore inflight: in-flight request cap
+  :param int retries: number of times to retry throttled requests
+  :returns callable: wrapped method
+
+  Requests made without an endpoint filter, i.e. to the identity
+  service to get a token, are not limited.
+  '''
+  held = threading.local()
+
+  def wrapper(url, method, *args, **kwargs):
+    filt = kwargs.get('endpoint_filter')
+    # Authentication requests are made by keystoneauth from within a
+    # limited request, taking the in-flight cap again would deadlock
+    if kwargs.get('authenticated') is False or not filt or getattr(held, 'inflight', False):
+      return request(url, method, *args, **kwargs)
+    bucket = buckets[BUDGETS.get(filt.get('service_type'))]
+    attempt = 0
+    while True:
+      if not bucket is None: throttled('rate', bucket.acquire())
+      if not inflight is None:
+        start = time.monotonic()
+        inflight.acquire()
+        held.inflight = True
+        throttled('inflight', time.monotonic() - start)
+      try:
+        try:
+          resp = request(url, method, *args, **kwargs)
+        except keystoneauth1.exceptions.HttpError as e:
+          if e.http_status != THROTTLED or attempt >= retries: raise
+          resp = e.response
+      finally:
+        if not inflight is None:
+          held.inflight = False
+          inflight.release()
+      if resp is None or resp.status_code != THROTTLED or attempt >= retries:
+        return resp
+      delay = retry_delay(resp, attempt)
+      throttled('retry', delay)
+      time.sleep(delay)
+      attempt += 1
+  return wrapper
+
+def wrap(c):
+  ''' Apply rate limits to a connection
+
+  :param openstack.connection c: OpenStack connection
+  :returns openstack.connection: ``c``
+  '''
+  default_rate = setting('API_RATE', 0)
+  burst = setting('API_BURST', 0)
+  buckets = {}
+  for budget in set(BUDGETS.values()) | set([None]):
+    rate = default_rate if budget is None else setting('API_RATE_' + budget, default_rate)
+    buckets[budget] = TokenBucket(rate, burst or rate) if rate > 0 else None
+  cap = int(setting('API_INFLIGHT', 0))
+  inflight = threading.BoundedSemaphore(cap) if cap > 0 else None
+  retries = int(setting('API_RETRIES', 5))
+
+  c.session.request = limited_request(c.session.request, buckets, inflight, retries)
+  return c
+
+def report():
+  ''' Print the time spent throttled, if any '''
+  with stats_lock:
+    if stats['rate'] + stats['inflight'] + stats['retry'] < 0.1 and stats['retries'] == 0: return
+    sys.stderr.write('API throttling: {rate:.1f}s rate limit, {inflight:.1f}s in-flight cap, {retry:.1f}s backoff ({retries} retries)\n'.format(**stats))
+
+atexit.register(report)
@@ -123,6 +123,10 @@ def vmlist_cmd(args):
         i = dict(c.image.get_image(vm.image.id))
         for k in xtab:
           t[k] = i[xtab[k]]
+      elif lookup_img:
+        # Servers booted from a volume have no image
+        for k in xtab:
+          t[k] = ''
 
       if K.addresses in t:
         t[K.ipv4] = []
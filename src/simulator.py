@@ -0,0 +1,1138 @@
+#!/usr/bin/env python3
+'''
+Local OpenStack API simulator
+
+A stand-in for the compute, image, block storage, network, DNS and
+OTC VPC services, used to try out deployments and to benchmark them
+without a cloud account.  It is selected with ``-DCLOUD=simulator``
+(or ``CLOUD=simulator`` in the environment).  Each simulated request
+goes through the connection session, so rate limiting and API call
+profiling work as they do against a real cloud.
+
+The simulator is configured with pre-processor variables:
+
+- ``SIM_LATENCY``: seconds added to every request
+- ``SIM_PAGE_SIZE``: items per page of list calls, each page is one
+  request (0, the default, means no pagination)
+- ``SIM_SETTLE``: seconds for resources to reach their final status,
+  e.g. servers go from ``BUILD`` to ``ACTIVE`` and deletions complete
+- ``SIM_LAG``: seconds before new resources show up in list calls
+- ``SIM_FAIL_RATE``: fraction of requests that fail
+- ``SIM_FAIL_STATUS``: HTTP status of failed requests, 500 by default.
+  Use 429 to exercise the rate limit retries.
+- ``SIM_SEED``: random seed, for repeatable runs
+- ``SIM_STATE``: file where the simulated cloud is saved on exit and
+  loaded from on start, so it lasts between invocations
+
+The public DNS zone named by ``PUBLIC_DNS_ZONE`` is created with the
+cloud, as it would be owned by the tenant.  Unknown images and flavors
+are made up on demand.
+'''
+import atexit
+import heapq
+import ipaddress
+import json
+import os
+import pprint
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import yaml
+import openstack.exceptions
+import consts as K
+import ypp
+
+IMAGES = [
+  'Standard_Ubuntu_22.04_latest',
+  'Standard_Ubuntu_20.04_latest',
+  'Standard_Debian_11_latest',
+  'Standard_CentOS_Stream_9_latest',
+  'Standard_openSUSE_15_latest',
+]
+''' Images available in a new cloud '''
+
+FLAVORS = [ 's3.medium.1', 's3.medium.2', 's3.large.2', 's3.large.4', 's3.xlarge.2', 's3.xlarge.4', 's3.2xlarge.4' ]
+''' Flavors available in a new cloud '''
+
+FLAVOR_SIZES = { 'medium': 1, 'large': 2, 'xlarge': 4, '2xlarge': 8, '4xlarge': 16, '8xlarge': 32 }
+''' Number of vCPUs of flavor sizes '''
+
+EXTERNAL_NET = 'admin_external_net'
+FIP_POOL = '80.158.0.0/16'
+
+def setting(name, default):
+  ''' Read a numeric setting
+
+  :param str name: pre-processor variable name
+  :param float default: value if not defined
+  :returns float: setting value
+  '''
+  value = ypp.vars(name)
+  if value is None or str(value).strip() == '': return default
+  try:
+    return float(value)
+  except ValueError:
+    sys.stderr.write('Ignoring invalid {name}: {value}\n'.format(name=name, value=value))
+    return default
+
+def timestamp(when):
+  ''' ISO 8601 timestamp as returned by the API
+
+  :param float when: time in seconds since the epoch
+  :returns str: timestamp
+  '''
+  return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))
+
+class Resource(dict):
+  ''' Simulated API resource, whose keys are also attributes '''
+  def __getattr__(self, k):
+    try:
+      return self[k]
+    except KeyError:
+      raise AttributeError(k)
+
+  def add_tag(self, session, tag):
+    ''' Add a tag to a server, like ``openstack.compute.v2.server.Server.add_tag``
+
+    :param Compute session: compute proxy
+    :param str tag: tag to add
+    '''
+    session._add_tag(self, tag)
+    self.setdefault('tags', []).append(tag)
+
+  def to_dict(self):
+    return _plain(self)
+
+def _resource(v):
+  ''' Convert nested dicts to resources '''
+  if isinstance(v, dict):
+    return Resource({ k: _resource(x) for k, x in v.items() if not k.startswith('_') })
+  if isinstance(v, list):
+    return [ _resource(x) for x in v ]
+  return v
+
+def _plain(v):
+  ''' Convert nested resources to plain dicts '''
+  if isinstance(v, dict):
+    return { k: _plain(x) for k, x in v.items() }
+  if isinstance(v, list):
+    return [ _plain(x) for x in v ]
+  return v
+
+yaml.add_representer(Resource, yaml.representer.SafeRepresenter.represent_dict)
+yaml.SafeDumper.add_representer(Resource, yaml.representer.SafeRepresenter.represent_dict)
+
+def _id(res):
+  ''' Id of a resource given as resource or id '''
+  return res if isinstance(res, str) else res['id']
+
+class Response:
+  ''' Minimal HTTP response of a simulated request
+
+  :param int status_code: HTTP status
+  :param dict headers: response headers
+  '''
+  request = None
+  def __init__(self, status_code, headers = None):
+    self.status_code = status_code
+    self.headers = headers or {}
+    self.content = b''
+
+ERRORS = {
+  400: openstack.exceptions.BadRequestException,
+  404: openstack.exceptions.ResourceNotFound,
+  409: openstack.exceptions.ConflictException,
+}
+''' Exception raised for each HTTP status '''
+
+def error(status, message):
+  ''' Exception for a failed request
+
+  :param int status: HTTP status
+  :param str message: error message
+  :returns openstack.exceptions.HttpException: the exception
+  '''
+  return ERRORS.get(status, openstack.exceptions.HttpException)(message = message, response = Response(status))
+
+class Cloud:
+  ''' State of a simulated project
+
+  :param str project: project name
+
+  Resources are kept in tables indexed by type and id.  Status
+  changes that take time are queued as events, which are applied by
+  the first request made after they are due.
+  '''
+  def __init__(self, project):
+    self.project = project
+    self.lock = threading.RLock()
+    self.tables = {}
+    self.events = []
+    self.counters = {}
+    self.calls = {}
+    ''' Number of requests indexed by ``(service, method)`` '''
+    self.latency = setting('SIM_LATENCY', 0)
+    self.page_size = int(setting('SIM_PAGE_SIZE', 0))
+    self.settle = setting('SIM_SETTLE', 0)
+    self.lag = setting('SIM_LAG', 0)
+    self.fail_rate = setting('SIM_FAIL_RATE', 0)
+    self.fail_status = int(setting('SIM_FAIL_STATUS', 500))
+    seed = ypp.vars('SIM_SEED')
+    self.rng = random.Random(seed)
+    self.ids = random.Random(seed)
+
+  def seed(self):
+    ''' Create the resources found in a new project '''
+    for name in IMAGES: self.image(name)
+    for name in FLAVORS: self.flavor(name)
+    self.insert('network', name = EXTERNAL_NET, subnet_ids = [], is_router_external = True, status = K.ACTIVE)
+    zone = ypp.vars('PUBLIC_DNS_ZONE')
+    if zone: self.new_zone(zone.rstrip('.') + '.', K.public)
+
+  #
+  # Requests
+  #
+  def request(self, service, method):
+    ''' Account a request, apply latency and failure injection
+
+    :param str service: service type
+    :param str method: proxy method
+    :returns Response: response
+    '''
+    with self.lock:
+      key = (service, method)
+      self.calls[key] = self.calls.get(key, 0) + 1
+      fail = self.fail_rate > 0 and self.rng.random() < self.fail_rate
+    if self.latency > 0: time.sleep(self.latency)
+    if fail: return Response(self.fail_status, { 'Retry-After': '1' })
+    return Response(200)
+
+  def total_calls(self):
+    ''' Number of requests made so far
+
+    :returns int: number of requests
+    '''
+    with self.lock:
+      return sum(self.calls.values())
+
+  def reset_calls(self):
+    ''' Reset request counters '''
+    with self.lock:
+      self.calls = {}
+
+  #
+  # Tables
+  #
+  def new_id(self):
+    with self.lock:
+      return str(uuid.UUID(int = self.ids.getrandbits(128), version = 4))
+
+  def table(self, kind):
+    return self.tables.setdefault(kind, {})
+
+  def insert(self, kind, when = None, **attrs):
+    ''' Add a resource
+
+    :param str kind: resource type
+    :param float when: (optional) creation time, defaults to now
+    :param kwargs attrs: resource attributes
+    :returns dict: stored resource
+    '''
+    with self.lock:
+      now = time.time() if when is None else when
+      res = dict(attrs)
+      res.setdefault('id', self.new_id())
+      res.setdefault(K.created_at, timestamp(now))
+      res.setdefault(K.updated_at, res[K.created_at])
+      res['_visible'] = now + self.lag
+      self.table(kind)[res['id']] = res
+      return res
+
+  def get(self, kind, res):
+    ''' Find a stored resource
+
+    :param str kind: resource type
+    :param str|dict res: resource or resource id
+    :returns dict: stored resource
+    :raises openstack.exceptions.ResourceNotFound: if missing
+    '''
+    found = self.table(kind).get(_id(res))
+    if found is None: raise error(404, 'No {} found for {}'.format(kind, _id(res)))
+    return found
+
+  def update(self, kind, res, **attrs):
+    with self.lock:
+      found = self.get(kind, res)
+      found.update(attrs)
+      found[K.updated_at] = timestamp(time.time())
+      return found
+
+  def listing(self, kind, query = {}, match = None):
+    ''' Resources visible in list calls
+
+    :param str kind: resource type
+    :param dict query: attribute values to match
+    :param callable match: (optional) extra filter
+    :returns list: matching resources, as copies
+    '''
+    now = time.time()
+    with self.lock:
+      res = []
+      for r in self.table(kind).values():
+        if r['_visible'] > now: continue
+        if any([r.get(k) != v for k, v in query.items()]): continue
+        if not match is None and not match(r): continue
+        res.append(_resource(r))
+      return res
+
+  def find(self, kind, name_or_id):
+    ''' Find a resource by id or by name '''
+    with self.lock:
+      if name_or_id in self.table(kind): return self.table(kind)[name_or_id]
+      for r in self.table(kind).values():
+        if r.get(K.NAME) == name_or_id: return r
+      return None
+
+  #
+  # Eventual consistency
+  #
+  def later(self, kind, res, action, value = None, delay = None):
+    ''' Queue a change
+
+    :param str kind: resource type
+    :param dict res: stored resource
+    :param str action: ``status`` to change the status to ``value``, or ``delete``
+    :param mixed value: new status
+    :param float delay: (optional) delay, defaults to ``SIM_SETTLE``
+    '''
+    when = time.time() + (self.settle if delay is None else delay)
+    with self.lock:
+      self.counters['event'] = self.counters.get('event', 0) + 1
+      heapq.heappush(self.events, (when, self.counters['event'], action, kind, res['id'], value))
+    if when <= time.time(): self.tick()
+
+  def tick(self):
+    ''' Apply the changes that are due '''
+    now = time.time()
+    with self.lock:
+      while len(self.events) and self.events[0][0] <= now:
+        when, n, action, kind, rid, value = heapq.heappop(self.events)
+        res = self.table(kind).get(rid)
+        if res is None: continue
+        if action == K.status:
+          res[K.status] = value
+          res[K.updated_at] = timestamp(when)
+        else:
+          self.remove(kind, res)
+
+  def remove(self, kind, res):
+    ''' Delete a resource and apply side effects '''
+    with self.lock:
+      self.table(kind).pop(res['id'], None)
+      if kind == K.server:
+        for port in [p for p in self.table('port').values() if p['device_id'] == res['id']]:
+          self.remove('port', port)
+        for vol in list(self.table(K.volume).values()):
+          atts = [a for a in vol[K.attachments] if a['server_id'] != res['id']]
+          if len(atts) == len(vol[K.attachments]): continue
+          vol[K.attachments] = atts
+          if vol.get('_delete_on_termination'):
+            vol[K.status] = 'deleting'
+            self.later(K.volume, vol, 'delete')
+          elif len(atts) == 0:
+            vol[K.status] = 'available'
+      elif kind == 'port':
+        for fip in self.table(K.fip).values():
+          if fip[K.port_id] != res['id']: continue
+          fip.update({ K.port_id: None, 'fixed_ip_address': None, K.status: 'DOWN' })
+        for srv in self.table(K.server).values():
+          if srv['id'] != res['device_id']: continue
+          self.server_addresses(srv)
+      elif kind == K.subnet:
+        net = self.table(K.network).get(res['network_id'])
+        if not net is None: net[K.subnet_ids] = [i for i in net[K.subnet_ids] if i != res['id']]
+      elif kind == K.router:
+        self.table(K.vpc).pop(res['id'], None)
+      elif kind == K.vpc:
+        self.table(K.router).pop(res['id'], None)
+      elif kind == 'zone':
+        for rs in [r for r in self.table('recordset').values() if r['zone_id'] == res['id']]:
+          self.table('recordset').pop(rs['id'])
+
+  #
+  # Helpers shared by proxies
+  #
+  def image(self, name_or_id):
+    ''' Find an image, making it up if needed '''
+    with self.lock:
+      img = self.find(K.image, name_or_id)
+      if img is None:
+        img = self.insert(K.image, when = 0, name = name_or_id, status = K.ACTIVE.lower(), min_disk = 4,
+                          min_ram = 0, size = 2147483648, visibility = 'public', disk_format = 'qcow2',
+                          os_type = 'Linux')
+      return img
+
+  def flavor(self, name_or_id):
+    ''' Find a flavor, making it up if needed '''
+    with self.lock:
+      fl = self.find('flavor', name_or_id)
+      if fl is None:
+        parts = name_or_id.split('.')
+        vcpus = FLAVOR_SIZES.get(parts[1], 1) if len(parts) == 3 else 1
+        ratio = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else 1
+        fl = self.insert('flavor', when = 0, id = name_or_id, name = name_or_id, vcpus = vcpus,
+                         ram = vcpus * ratio * 1024, disk = 0, is_public = True)
+      return fl
+
+  def new_zone(self, name, zone_type, **attrs):
+    ''' Create a DNS zone with its SOA and NS records '''
+    with self.lock:
+      zone = self.insert('zone', name = name, zone_type = zone_type, status = K.ACTIVE,
+                         email = 'hostmaster@' + name.rstrip('.'), ttl = 300, **attrs)
+      self.insert('recordset', zone_id = zone['id'], name = name, type = 'SOA', status = K.ACTIVE,
+                  records = ['ns1.{} {} 1 7200 900 1209600 300'.format(name, zone['email'])])
+      self.insert('recordset', zone_id = zone['id'], name = name, type = 'NS', status = K.ACTIVE,
+                  records = ['ns1.{}'.format(name), 'ns2.{}'.format(name)])
+      return zone
+
+  def allocate_ip(self, subnet):
+    ''' Next free address of a subnet '''
+    with self.lock:
+      key = 'ip-' + subnet['id']
+      self.counters[key] = self.counters.get(key, 9) + 1
+      return str(ipaddress.ip_network(subnet['cidr'], strict = False)[self.counters[key]])
+
+  def new_mac(self):
+    with self.lock:
+      return 'fa:16:3e:' + ':'.join(['{:02x}'.format(self.ids.getrandbits(8)) for i in range(3)])
+
+  def server_addresses(self, srv):
+    ''' Recompute the addresses of a server from its ports and floating IPs '''
+    with self.lock:
+      addrs = {}
+      for port in self.table('port').values():
+        if port['device_id'] != srv['id']: continue
+        net = self.table(K.network).get(port['network_id'], {})
+        ips = addrs.setdefault(net.get(K.NAME, port['network_id']), [])
+        for fixed in port['fixed_ips']:
+          ips.append({ K.addr: fixed['ip_address'], 'version': 4, K.OS_EXT_IPS_TYPE: 'fixed',
+                       K.OS_EXT_IPS_MAC_ADDR: port['mac_address'] })
+        for fip in self.table(K.fip).values():
+          if fip[K.port_id] != port['id']: continue
+          ips.append({ K.addr: fip['floating_ip_address'], 'version': 4, K.OS_EXT_IPS_TYPE: 'floating',
+                       K.OS_EXT_IPS_MAC_ADDR: port['mac_address'] })
+      srv['addresses'] = addrs
+
+  #
+  # Persistence
+  #
+  def save(self, fname):
+    ''' Save the cloud state to a file '''
+    with self.lock:
+      data = { 'tables': self.tables, 'events': self.events, 'counters': self.counters }
+      tmp = '{}.{}.tmp'.format(fname, os.getpid())
+      with open(tmp, 'w') as fp:
+        json.dump(data, fp)
+      os.replace(tmp, fname)
+
+  def load(self, fname):
+    ''' Load the cloud state from a file '''
+    with open(fname, 'r') as fp:
+      data = json.load(fp)
+    with self.lock:
+      self.tables = data['tables']
+      self.events = [tuple(e) for e in data['events']]
+      heapq.heapify(self.events)
+      self.counters = data['counters']
+
+class Session:
+  ''' Stand-in for a keystoneauth session
+
+  :param Cloud cloud: simulated cloud
+  '''
+  auth = None
+  def __init__(self, cloud):
+    self.cloud = cloud
+
+  def request(self, url, method, endpoint_filter = None, **kwargs):
+    service = (endpoint_filter or {}).get('service_type')
+    resp = self.cloud.request(service, url.rsplit('/', 1)[-1])
+    self.cloud.tick()
+    return resp
+
+class Proxy:
+  ''' Base class of service proxies
+
+  :param Connection conn: simulated connection
+  '''
+  service = None
+  def __init__(self, conn):
+    self.conn = conn
+    self.cloud = conn.cloud
+
+  def _request(self, method, verb = 'GET'):
+    ''' Make a request through the connection session '''
+    resp = self.conn.session.request('/{}/{}'.format(self.service, method), verb,
+                                     endpoint_filter = { 'service_type': self.service })
+    if resp.status_code >= 400:
+      raise error(resp.status_code, 'Simulated failure of {}.{}'.format(self.service, method))
+    return resp
+
+  def _list(self, method, kind, query = {}, match = None):
+    ''' List resources, one request per page '''
+    query = { k: v for k, v in query.items() if not k in ('details', 'all_projects', 'limit', 'marker') }
+    self._request(method)
+    items = self.cloud.listing(kind, query, match)
+    size = self.cloud.page_size
+    if size > 0:
+      for i in range(size, len(items) + 1, size):
+        self._request(method)
+    for r in items: yield r
+
+  def _get(self, method, kind, res):
+    self._request(method)
+    with self.cloud.lock:
+      return _resource(self.cloud.get(kind, res))
+
+  def _find(self, method, kind, name_or_id, ignore_missing = True):
+    self._request(method)
+    with self.cloud.lock:
+      found = self.cloud.find(kind, name_or_id)
+      if found is None:
+        if ignore_missing: return None
+        raise error(404, 'No {} found for {}'.format(kind, name_or_id))
+      return _resource(found)
+
+class Compute(Proxy):
+  service = 'compute'
+
+  def servers(self, details = True, **query):
+    name = query.pop(K.NAME, None)
+    match = None if name is None else lambda r: re.search(name, r[K.NAME])
+    return self._list('servers', K.server, query, match)
+
+  def get_server(self, server):
+    return self._get('get_server', K.server, server)
+
+  def find_server(self, name_or_id, ignore_missing = True):
+    return self._find('find_server', K.server, name_or_id, ignore_missing)
+
+  def create_server(self, **attrs):
+    self._request('create_server', 'POST')
+    cloud = self.cloud
+    with cloud.lock:
+      bdm = attrs.get('block_device_mapping', [])
+      for m in bdm:
+        if m['source_type'] == 'volume' and cloud.get(K.volume, m['uuid'])[K.status] != 'available':
+          raise error(400, 'Volume {} is not available'.format(m['uuid']))
+      flavor = cloud.flavor(attrs['flavor_id'])
+      boot = [m for m in bdm if m.get('boot_index') == 0]
+      image = cloud.image(boot[0]['uuid'] if len(boot) else attrs['image_id'])
+      sgs = [{ K.NAME: sg[K.NAME] } for sg in attrs.get('security_groups', [])] or [{ K.NAME: 'default' }]
+      for sg in sgs:
+        if sg[K.NAME] != 'default' and cloud.find(K.sg, sg[K.NAME]) is None:
+          raise error(400, 'Security group {} not found'.format(sg[K.NAME]))
+      subnets = []
+      for net in attrs.get('networks', []):
+        net = cloud.get(K.network, net['uuid'])
+        if len(net[K.subnet_ids]) == 0:
+          raise error(400, 'Network {} has no subnet'.format(net['id']))
+        subnets.append(cloud.get(K.subnet, net[K.subnet_ids][0]))
+
+      srv = cloud.insert(K.server, name = attrs[K.NAME], status = 'BUILD', key_name = attrs.get('key_name'),
+                         flavor = { 'original_name': flavor[K.NAME], K.NAME: flavor[K.NAME], 'vcpus': flavor['vcpus'],
+                                    'ram': flavor['ram'], 'disk': flavor['disk'], 'ephemeral': 0, 'swap': 0 },
+                         image = '' if len(boot) else { 'id': image['id'] },
+                         security_groups = sgs, root_device_name = '/dev/vda', attached_volumes = [],
+                         availability_zone = attrs.get('availability_zone', 'eu-de-01'),
+                         metadata = attrs.get('metadata', {}), tags = [], addresses = {})
+      sg_ids = [cloud.find(K.sg, sg[K.NAME])['id'] for sg in sgs if not cloud.find(K.sg, sg[K.NAME]) is None]
+      for sn in subnets:
+        cloud.insert('port', network_id = sn['network_id'], device_id = srv['id'], device_owner = 'compute:nova',
+                     mac_address = cloud.new_mac(), status = K.ACTIVE, security_group_ids = sg_ids,
+                     fixed_ips = [{ 'subnet_id': sn['id'], 'ip_address': cloud.allocate_ip(sn) }])
+      cloud.server_addresses(srv)
+
+      disks = []
+      if len(boot) == 0:
+        disks.append((cloud.insert(K.volume, name = '', size = max(image['min_disk'], flavor['disk']),
+                                   volume_type = 'SSD', is_bootable = True, status = 'in-use', attachments = [],
+                                   volume_image_metadata = { K.image_id: image['id'], K.image_name: image[K.NAME],
+                                                             'min_disk': str(image['min_disk']) },
+                                   _delete_on_termination = True), True))
+      for m in bdm:
+        if m['source_type'] == 'image':
+          disks.append((cloud.insert(K.volume, name = '', size = m.get('volume_size', image['min_disk']),
+                                     volume_type = 'SSD', is_bootable = True, status = 'in-use', attachments = [],
+                                     volume_image_metadata = { K.image_id: image['id'], K.image_name: image[K.NAME],
+                                                               'min_disk': str(image['min_disk']) },
+                                     _delete_on_termination = m.get('delete_on_termination', False)), True))
+        else:
+          vol = cloud.get(K.volume, m['uuid'])
+          vol[K.status] = 'in-use'
+          vol['_delete_on_termination'] = m.get('delete_on_termination', False)
+          disks.append((vol, False))
+      disks.sort(key = lambda d: not d[1])
+      for i, (vol, bootable) in enumerate(disks):
+        self._attach(srv, vol, '/dev/vd' + 'abcdefghijklmnopqrstuvwxyz'[i])
+      cloud.later(K.server, srv, K.status, K.ACTIVE)
+      return _resource(srv)
+
+  def _attach(self, srv, vol, device):
+    vol[K.attachments].append({ 'id': vol['id'], 'attachment_id': self.cloud.new_id(), 'server_id': srv['id'],
+                                'volume_id': vol['id'], 'device': device })
+    srv['attached_volumes'].append({ 'id': vol['id'] })
+
+  def _add_tag(self, server, tag):
+    self._request('add_tag', 'PUT')
+    with self.cloud.lock:
+      self.cloud.get(K.server, server).setdefault('tags', []).append(tag)
+
+  def delete_server(self, server, ignore_missing = True, force = False):
+    self._request('delete_server', 'DELETE')
+    with self.cloud.lock:
+      srv = self.cloud.table(K.server).get(_id(server))
+      if srv is None:
+        if ignore_missing: return None
+        raise error(404, 'No server found for {}'.format(_id(server)))
+      srv['OS-EXT-STS:task_state'] = 'deleting'
+      self.cloud.later(K.server, srv, 'delete')
+
+  def server_interfaces(self, server):
+    self._request('server_interfaces')
+    sid = _id(server)
+    with self.cloud.lock:
+      return [Resource({ K.port_id: p['id'], 'net_id': p['network_id'], 'mac_addr': p['mac_address'],
+                         'fixed_ips': _plain(p['fixed_ips']), 'port_state': p[K.status] })
+              for p in self.cloud.table('port').values() if p['device_id'] == sid]
+
+  def get_volume_attachment(self, server, volume):
+    self._request('get_volume_attachment')
+    with self.cloud.lock:
+      vol = self.cloud.get(K.volume, volume)
+      for att in vol[K.attachments]:
+        if att['server_id'] == _id(server): return _resource(att)
+      raise error(404, 'Volume {} is not attached to server {}'.format(_id(volume), _id(server)))
+
+  def create_volume_attachment(self, server, volume = None, **attrs):
+    self._request('create_volume_attachment', 'POST')
+    with self.cloud.lock:
+      srv = self.cloud.get(K.server, server)
+      vol = self.cloud.get(K.volume, attrs.get('volume_id', volume))
+      if not srv[K.status] in (K.ACTIVE, K.SHUTOFF):
+        raise error(409, 'Server {} is in status {}'.format(srv['id'], srv[K.status]))
+      if vol[K.status] != 'available':
+        raise error(400, 'Volume {} is in status {}'.format(vol['id'], vol[K.status]))
+      self._attach(srv, vol, '/dev/vd' + 'abcdefghijklmnopqrstuvwxyz'[len(srv['attached_volumes'])])
+      vol[K.status] = 'attaching'
+      self.cloud.later(K.volume, vol, K.status, 'in-use')
+      return _resource(vol[K.attachments][-1])
+
+  def delete_volume_attachment(self, server, volume, ignore_missing = True):
+    self._request('delete_volume_attachment', 'DELETE')
+    with self.cloud.lock:
+      srv = self.cloud.get(K.server, server)
+      vol = self.cloud.get(K.volume, volume)
+      vol[K.attachments] = [a for a in vol[K.attachments] if a['server_id'] != srv['id']]
+      srv['attached_volumes'] = [a for a in srv['attached_volumes'] if a['id'] != vol['id']]
+      vol[K.status] = 'detaching'
+      self.cloud.later(K.volume, vol, K.status, 'available' if len(vol[K.attachments]) == 0 else 'in-use')
+
+  def _transition(self, method, server, status, final):
+    self._request(method, 'POST')
+    with self.cloud.lock:
+      srv = self.cloud.get(K.server, server)
+      srv[K.status] = status
+      self.cloud.later(K.server, srv, K.status, final)
+
+  def start_server(self, server):
+    self._transition('start_server', server, K.SHUTOFF, K.ACTIVE)
+
+  def stop_server(self, server):
+    self._transition('stop_server', server, K.ACTIVE, K.SHUTOFF)
+
+  def reboot_server(self, server, reboot_type):
+    self._transition('reboot_server', server, K.HARD + '_' + K.REBOOT if reboot_type == K.HARD else K.REBOOT, K.ACTIVE)
+
+  def get_server_console_output(self, server, length = None):
+    srv = self._get('get_server_console_output', K.server, server)
+    lines = ['{} login:'.format(srv[K.NAME])]
+    return { 'output': '\n'.join(lines[-length:] if length else lines) + '\n' }
+
+  def flavors(self, details = True, **query):
+    return self._list('flavors', 'flavor', query)
+
+  def find_flavor(self, name_or_id, ignore_missing = True):
+    self._request('find_flavor')
+    return _resource(self.cloud.flavor(name_or_id))
+
+  def find_image(self, name_or_id, ignore_missing = True):
+    self._request('find_image')
+    return _resource(self.cloud.image(name_or_id))
+
+  def keypairs(self, **query):
+    return self._list('keypairs', 'keypair', query)
+
+class Image(Proxy):
+  service = 'image'
+
+  def images(self, **query):
+    return self._list('images', K.image, query)
+
+  def get_image(self, image):
+    return self._get('get_image', K.image, image)
+
+  def find_image(self, name_or_id, ignore_missing = True):
+    self._request('find_image')
+    return _resource(self.cloud.image(name_or_id))
+
+class BlockStore(Proxy):
+  service = 'block-storage'
+
+  def volumes(self, details = True, **query):
+    return self._list('volumes', K.volume, query)
+
+  def get_volume(self, volume):
+    return self._get('get_volume', K.volume, volume)
+
+  def find_volume(self, name_or_id, ignore_missing = True):
+    return self._find('find_volume', K.volume, name_or_id, ignore_missing)
+
+  def create_volume(self, **attrs):
+    self._request('create_volume', 'POST')
+    with self.cloud.lock:
+      attrs.setdefault('volume_type', 'SSD')
+      attrs.setdefault('is_bootable', False)
+      vol = self.cloud.insert(K.volume, status = 'creating', attachments = [], **attrs)
+      self.cloud.later(K.volume, vol, K.status, 'available')
+      return _resource(vol)
+
+  def delete_volume(self, volume, ignore_missing = True, force = False):
+    self._request('delete_volume', 'DELETE')
+    with self.cloud.lock:
+      vol = self.cloud.table(K.volume).get(_id(volume))
+      if vol is None:
+        if ignore_missing: return None
+        raise error(404, 'No volume found for {}'.format(_id(volume)))
+      if len(vol[K.attachments]) or vol[K.status] in ('in-use', 'attaching', 'detaching'):
+        raise error(400, 'Volume {} is in status {}'.format(vol['id'], vol[K.status]))
+      vol[K.status] = 'deleting'
+      self.cloud.later(K.volume, vol, 'delete')
+
+  def extend_volume(self, volume, size):
+    self._request('extend_volume', 'POST')
+    with self.cloud.lock:
+      vol = self.cloud.get(K.volume, volume)
+      if int(size) <= int(vol['size']):
+        raise error(400, 'New size {} must be larger than {}'.format(size, vol['size']))
+      self.cloud.update(K.volume, vol, size = int(size))
+
+class Network(Proxy):
+  service = 'network'
+
+  def networks(self, **query):
+    return self._list('networks', K.network, query)
+
+  def subnets(self, **query):
+    return self._list('subnets', K.subnet, query)
+
+  def routers(self, **query):
+    return self._list('routers', K.router, query)
+
+  def security_groups(self, **query):
+    return self._list('security_groups', K.sg, query)
+
+  def ips(self, **query):
+    return self._list('ips', K.fip, query)
+
+  def ports(self, **query):
+    return self._list('ports', 'port', query)
+
+  def get_security_group(self, sg):
+    return self._get('get_security_group', K.sg, sg)
+
+  def find_subnet(self, name_or_id, ignore_missing = True):
+    return self._find('find_subnet', K.subnet, name_or_id, ignore_missing)
+
+  def create_network(self, **attrs):
+    self._request('create_network', 'POST')
+    return _resource(self.cloud.insert(K.network, subnet_ids = [], status = K.ACTIVE, is_admin_state_up = True, **attrs))
+
+  def create_subnet(self, **attrs):
+    self._request('create_subnet', 'POST')
+    with self.cloud.lock:
+      net = self.cloud.get(K.network, attrs['network_id'])
+      cidr = ipaddress.ip_network(attrs['cidr'], strict = False)
+      attrs.setdefault('ip_version', 4)
+      attrs.setdefault('gateway_ip', str(cidr[1]))
+      attrs.setdefault('is_dhcp_enabled', True)
+      attrs.setdefault('dns_nameservers', [])
+      sn = self.cloud.insert(K.subnet, **attrs)
+      net[K.subnet_ids].append(sn['id'])
+      return _resource(sn)
+
+  def update_subnet(self, subnet, **attrs):
+    self._request('update_subnet', 'PUT')
+    return _resource(self.cloud.update(K.subnet, subnet, **attrs))
+
+  def delete_subnet(self, subnet, ignore_missing = True):
+    self._request('delete_subnet', 'DELETE')
+    with self.cloud.lock:
+      sn = self.cloud.table(K.subnet).get(_id(subnet))
+      if sn is None:
+        if ignore_missing: return None
+        raise error(404, 'No subnet found for {}'.format(_id(subnet)))
+      for port in self.cloud.table('port').values():
+        if any([f['subnet_id'] == sn['id'] for f in port['fixed_ips']]):
+          raise error(409, 'Subnet {} has ports in use'.format(sn['id']))
+      self.cloud.remove(K.subnet, sn)
+
+  def delete_network(self, network, ignore_missing = True):
+    self._request('delete_network', 'DELETE')
+    with self.cloud.lock:
+      net = self.cloud.table(K.network).get(_id(network))
+      if net is None:
+        if ignore_missing: return None
+        raise error(404, 'No network found for {}'.format(_id(network)))
+      if len(net[K.subnet_ids]):
+        raise error(409, 'Network {} has subnets'.format(net['id']))
+      self.cloud.remove(K.network, net)
+
+  def create_router(self, **attrs):
+    self._request('create_router', 'POST')
+    with self.cloud.lock:
+      ext = self.cloud.find(K.network, EXTERNAL_NET)
+      attrs.setdefault('external_gateway_info', { 'network_id': ext['id'], 'enable_snat': True })
+      return _resource(self.cloud.insert(K.router, status = K.ACTIVE, _interfaces = [], **attrs))
+
+  def update_router(self, router, **attrs):
+    self._request('update_router', 'PUT')
+    return _resource(self.cloud.update(K.router, router, **attrs))
+
+  def delete_router(self, router, ignore_missing = True):
+    self._request('delete_router', 'DELETE')
+    with self.cloud.lock:
+      rt = self.cloud.table(K.router).get(_id(router))
+      if rt is None:
+        if ignore_missing: return None
+        raise error(404, 'No router found for {}'.format(_id(router)))
+      if len(rt['_interfaces']):
+        raise error(409, 'Router {} still has interfaces'.format(rt['id']))
+      self.cloud.remove(K.router, rt)
+
+  def add_interface_to_router(self, router, subnet_id = None, port_id = None):
+    self._request('add_interface_to_router', 'PUT')
+    with self.cloud.lock:
+      rt = self.cloud.get(K.router, router)
+      sn = self.cloud.get(K.subnet, subnet_id)
+      if not sn['id'] in rt['_interfaces']:
+        rt['_interfaces'].append(sn['id'])
+        self.cloud.insert('port', network_id = sn['network_id'], device_id = rt['id'],
+                          device_owner = 'network:router_interface_distributed',
+                          mac_address = self.cloud.new_mac(), status = K.ACTIVE, security_group_ids = [],
+                          fixed_ips = [{ 'subnet_id': sn['id'], 'ip_address': sn['gateway_ip'] }])
+      return { 'id': rt['id'], 'subnet_id': sn['id'] }
+
+  def remove_interface_from_router(self, router, subnet_id = None, port_id = None):
+    self._request('remove_interface_from_router', 'PUT')
+    with self.cloud.lock:
+      rt = self.cloud.get(K.router, router)
+      if not subnet_id in rt['_interfaces']:
+        raise error(404, 'Router {} has no interface on subnet {}'.format(rt['id'], subnet_id))
+      rt['_interfaces'].remove(subnet_id)
+      for port in [p for p in self.cloud.table('port').values() if p['device_id'] == rt['id']]:
+        if any([f['subnet_id'] == subnet_id for f in port['fixed_ips']]): self.cloud.remove('port', port)
+      return { 'id': rt['id'], 'subnet_id': subnet_id }
+
+  def create_security_group(self, **attrs):
+    self._request('create_security_group', 'POST')
+    with self.cloud.lock:
+      sg = self.cloud.insert(K.sg, security_group_rules = [], description = '', **attrs)
+      for ethertype in ('IPv4', 'IPv6'):
+        sg['security_group_rules'].append({ 'id': self.cloud.new_id(), 'security_group_id': sg['id'],
+                                            'direction': 'egress', 'ethertype': ethertype, 'protocol': None,
+                                            'port_range_min': None, 'port_range_max': None,
+                                            'remote_ip_prefix': None, 'remote_group_id': None })
+      return _resource(sg)
+
+  RULE_FIELDS = ('direction', 'ethertype', 'protocol', 'port_range_min', 'port_range_max', 'remote_ip_prefix', 'remote_group_id')
+
+  def _add_rule(self, rule):
+    sg = self.cloud.get(K.sg, rule['security_group_id'])
+    new = { k: rule.get(k) for k in self.RULE_FIELDS }
+    new.setdefault('ethertype', 'IPv4')
+    for r in sg['security_group_rules']:
+      if all([r.get(k) == new[k] for k in self.RULE_FIELDS]):
+        raise error(409, 'Security group rule already exists: {}'.format(r['id']))
+    new.update({ 'id': self.cloud.new_id(), 'security_group_id': sg['id'] })
+    sg['security_group_rules'].append(new)
+    sg[K.updated_at] = timestamp(time.time())
+    return _resource(new)
+
+  def create_security_group_rule(self, **attrs):
+    self._request('create_security_group_rule', 'POST')
+    with self.cloud.lock:
+      return self._add_rule(attrs)
+
+  def create_security_group_rules(self, data):
+    self._request('create_security_group_rules', 'POST')
+    with self.cloud.lock:
+      return [self._add_rule(r) for r in data]
+
+  def delete_security_group_rule(self, rule, ignore_missing = True):
+    self._request('delete_security_group_rule', 'DELETE')
+    with self.cloud.lock:
+      for sg in self.cloud.table(K.sg).values():
+        rules = [r for r in sg['security_group_rules'] if r['id'] != _id(rule)]
+        if len(rules) != len(sg['security_group_rules']):
+          sg['security_group_rules'] = rules
+          return
+      if not ignore_missing: raise error(404, 'No rule found for {}'.format(_id(rule)))
+
+  def delete_security_group(self, sg, ignore_missing = True):
+    self._request('delete_security_group', 'DELETE')
+    with self.cloud.lock:
+      found = self.cloud.table(K.sg).get(_id(sg))
+      if found is None:
+        if ignore_missing: return None
+        raise error(404, 'No security group found for {}'.format(_id(sg)))
+      for srv in self.cloud.table(K.server).values():
+        if found[K.NAME] in [g[K.NAME] for g in srv['security_groups']]:
+          raise error(409, 'Security group {} is in use'.format(found['id']))
+      self.cloud.remove(K.sg, found)
+
+  def delete_ip(self, ip, ignore_missing = True):
+    self._request('delete_ip', 'DELETE')
+    with self.cloud.lock:
+      fip = self.cloud.table(K.fip).get(_id(ip))
+      if fip is None:
+        if ignore_missing: return None
+        raise error(404, 'No floating IP found for {}'.format(_id(ip)))
+      self.cloud.remove(K.fip, fip)
+      for srv in self.cloud.table(K.server).values(): self.cloud.server_addresses(srv)
+
+class Vpc(Proxy):
+  service = 'vpc'
+
+  def vpcs(self, **query):
+    return self._list('vpcs', K.vpc, query)
+
+  def get_vpc(self, vpc):
+    return self._get('get_vpc', K.vpc, vpc)
+
+  def create_vpc(self, **attrs):
+    self._request('create_vpc', 'POST')
+    cloud = self.cloud
+    with cloud.lock:
+      attrs.setdefault('enable_shared_snat', False)
+      vpc = cloud.insert(K.vpc, status = 'OK', **attrs)
+      # The matching Neutron router only shows up after a while
+      ext = cloud.find(K.network, EXTERNAL_NET)
+      rt = cloud.insert(K.router, id = vpc['id'], name = vpc[K.NAME], status = K.ACTIVE, _interfaces = [],
+                        external_gateway_info = { 'network_id': ext['id'], 'enable_snat': False })
+      rt['_visible'] = time.time() + max(cloud.lag, cloud.settle)
+      return _resource(vpc)
+
+  def update_vpc(self, vpc, **attrs):
+    self._request('update_vpc', 'PUT')
+    return _resource(self.cloud.update(K.vpc, vpc, **attrs))
+
+  def delete_vpc(self, vpc, ignore_missing = True):
+    self._request('delete_vpc', 'DELETE')
+    with self.cloud.lock:
+      found = self.cloud.table(K.vpc).get(_id(vpc))
+      if found is None:
+        if ignore_missing: return None
+        raise error(404, 'No VPC found for {}'.format(_id(vpc)))
+      self.cloud.remove(K.vpc, found)
+
+class Dns(Proxy):
+  service = 'dns'
+
+  def zones(self, zone_type = K.public, **query):
+    query['zone_type'] = zone_type
+    return self._list('zones', 'zone', query)
+
+  def find_zone(self, name_or_id, zone_type = K.public, ignore_missing = True):
+    self._request('find_zone')
+    with self.cloud.lock:
+      for z in self.cloud.table('zone').values():
+        if z['zone_type'] == zone_type and name_or_id in (z['id'], z[K.NAME]): return _resource(z)
+    if ignore_missing: return None
+    raise error(404, 'No zone found for {}'.format(name_or_id))
+
+  def create_zone(self, **attrs):
+    self._request('create_zone', 'POST')
+    with self.cloud.lock:
+      name = attrs.pop(K.NAME).rstrip('.') + '.'
+      zone_type = attrs.pop('zone_type', K.public)
+      for z in self.cloud.table('zone').values():
+        if z[K.NAME] == name and z['zone_type'] == zone_type:
+          raise error(409, 'Zone {} already exists'.format(name))
+      if 'router' in attrs: attrs['routers'] = [dict(attrs.pop('router'), status = K.ACTIVE)]
+      return _resource(self.cloud.new_zone(name, zone_type, **attrs))
+
+  def delete_zone(self, zone, ignore_missing = True):
+    self._request('delete_zone', 'DELETE')
+    with self.cloud.lock:
+      found = self.cloud.table('zone').get(_id(zone))
+      if found is None:
+        if ignore_missing: return None
+        raise error(404, 'No zone found for {}'.format(_id(zone)))
+      self.cloud.remove('zone', found)
+
+  def recordsets(self, zone = None, **query):
+    if not zone is None: query['zone_id'] = _id(zone)
+    return self._list('recordsets', 'recordset', query)
+
+  def create_recordset(self, zone, **attrs):
+    self._request('create_recordset', 'POST')
+    with self.cloud.lock:
+      zone = self.cloud.get('zone', zone)
+      name = attrs.pop(K.NAME)
+      if not name.endswith('.'): name = '{}.{}'.format(name, zone[K.NAME])
+      for rs in self.cloud.table('recordset').values():
+        if rs['zone_id'] == zone['id'] and rs[K.NAME] == name and rs[K.type] == attrs[K.type]:
+          raise error(409, 'Record set {} {} already exists'.format(name, attrs[K.type]))
+      attrs.setdefault('ttl', 300)
+      return _resource(self.cloud.insert('recordset', zone_id = zone['id'], zone_name = zone[K.NAME],
+                                         name = name, status = K.ACTIVE, **attrs))
+
+  def get_recordset(self, recordset, zone):
+    return self._get('get_recordset', 'recordset', recordset)
+
+  def update_recordset(self, recordset, **attrs):
+    self._request('update_recordset', 'PUT')
+    return _resource(self.cloud.update('recordset', recordset, **attrs))
+
+  def delete_recordset(self, recordset, zone = None, ignore_missing = True):
+    self._request('delete_recordset', 'DELETE')
+    with self.cloud.lock:
+      rs = self.cloud.table('recordset').get(_id(recordset))
+      if rs is None:
+        if ignore_missing: return None
+        raise error(404, 'No record set found for {}'.format(_id(recordset)))
+      self.cloud.remove('recordset', rs)
+
+class Connection:
+  ''' Stand-in for ``openstack.connection.Connection``
+
+  :param Cloud cloud: simulated cloud
+  '''
+  def __init__(self, cloud):
+    self.cloud = cloud
+    self.session = Session(cloud)
+    self.compute = Compute(self)
+    self.image = Image(self)
+    self.block_store = BlockStore(self)
+    self.network = Network(self)
+    self.vpc = Vpc(self)
+    self.dns = Dns(self)
+    self._proxies = {
+      'compute': self.compute,
+      'image': self.image,
+      'block-storage': self.block_store,
+      'network': self.network,
+      'vpc': self.vpc,
+      'dns': self.dns,
+    }
+
+  def create_floating_ip(self, server = None, **attrs):
+    self.network._request('create_floating_ip', 'POST')
+    cloud = self.cloud
+    with cloud.lock:
+      srv = cloud.get(K.server, server)
+      ports = [p for p in cloud.table('port').values() if p['device_id'] == srv['id']]
+      if len(ports) == 0: raise error(400, 'Server {} has no ports'.format(srv['id']))
+      cloud.counters['fip'] = cloud.counters.get('fip', 0) + 1
+      ext = cloud.find(K.network, EXTERNAL_NET)
+      fip = cloud.insert(K.fip, floating_ip_address = str(ipaddress.ip_network(FIP_POOL)[cloud.counters['fip']]),
+                         floating_network_id = ext['id'], port_id = ports[0]['id'], status = K.ACTIVE,
+                         fixed_ip_address = ports[0]['fixed_ips'][0]['ip_address'], router_id = None)
+      cloud.server_addresses(srv)
+      return _resource(fip)
+
+  def get_external_ipv4_networks(self):
+    return list(self.network.networks(name = EXTERNAL_NET))
+
+  def get_external_ipv6_networks(self):
+    return []
+
+  def pprint(self, data):
+    pprint.pprint(_plain(data))
+
+clouds = {}
+''' Simulated clouds indexed by project '''
+clouds_lock = threading.Lock()
+
+def get(project = None):
+  ''' Get a simulated cloud
+
+  :param str project: (optional) project name
+  :returns Cloud: the cloud, created on first use
+
+  If ``SIM_STATE`` is defined the cloud is loaded from that file if
+  it exists, and saved to it on exit.
+  '''
+  project = project or K.SIMULATOR
+  with clouds_lock:
+    if not project in clouds:
+      cloud = Cloud(project)
+      state = ypp.vars('SIM_STATE')
+      if state:
+        fname = '{}.{}'.format(state, project) if project != K.SIMULATOR else state
+        if os.path.isfile(fname):
+          cloud.load(fname)
+        else:
+          cloud.seed()
+        atexit.register(cloud.save, fname)
+      else:
+        cloud.seed()
+      clouds[project] = cloud
+    return clouds[project]
+
+def connect(project = None):
+  ''' Connect to a simulated cloud
+
+  :param str project: (optional) project name
+  :returns Connection: simulated connection
+  '''
+  return Connection(get(project))
+
+def populate(cloud, count, prefix = 'bg', vms = 2):
+  ''' Fill a cloud with unrelated deployments
+
+  :param Cloud cloud: simulated cloud
+  :param int count: number of deployments
+  :param str prefix: (optional) SID prefix of the deployments
+  :param int vms: (optional) number of VMs per deployment
+
+  Used to measure how deployments scale with the size of the project.
+  Each deployment has a VPC, a network with a subnet, a security group,
+  VMs with a data volume each and a floating IP.
+  '''
+  conn = Connection(cloud)
+  saved = cloud.latency, cloud.lag, cloud.settle, cloud.fail_rate
+  cloud.latency, cloud.lag, cloud.settle, cloud.fail_rate = 0, 0, 0, 0
+  try:
+    for i in range(count):
+      sid = '{}{}'.format(prefix, i)
+      vpc = conn.vpc.create_vpc(name = sid + '-vpc1', cidr = '10.0.0.0/8')
+      net = conn.network.create_network(name = sid + '-sn1')
+      sn = conn.network.create_subnet(name = sid + '-sn1', network_id = net['id'], cidr = '10.1.0.0/24')
+      conn.network.add_interface_to_router(vpc['id'], sn['id'])
+      sg = conn.network.create_security_group(name = sid + '-sg-default')
+      for j in range(vms):
+        vol = conn.block_store.create_volume(name = '{}-vol{}'.format(sid, j), size = 10)
+        srv = conn.compute.create_server(name = '{}-vm{}'.format(sid, j), image_id = IMAGES[0], flavor_id = FLAVORS[0],
+                                         networks = [{ 'uuid': net['id'] }], security_groups = [{ K.NAME: sg[K.NAME] }],
+                                         block_device_mapping = [{ 'uuid': vol['id'], 'source_type': 'volume',
+                                                                   'destination_type': 'volume', 'boot_index': -1 }])
+        srv.add_tag(conn.compute, 'SID=' + sid)
+        conn.create_floating_ip(server = srv)
+  finally:
+    cloud.latency, cloud.lag, cloud.settle, cloud.fail_rate = saved
+    cloud.reset_calls()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+Resource specification comparison
+
+Reconcilers compare the settings wanted for a resource with the ones
+reported by the API.  Both sides are first brought to a canonical
+form made of plain dicts, lists and scalars, so SDK resources, tuples
+and dicts with keys in a different order compare equal to the same
+data.  Differences are reported per field, so a deployment can say
+exactly what drifted.
+'''
+import hashlib
+import json
+
+def canonical(v):
+  ''' Canonical form of a value
+
+  :param mixed v: value to convert
+  :returns mixed: value made of plain dicts, lists and scalars
+  '''
+  if isinstance(v, dict):
+    return { str(k): canonical(x) for k, x in v.items() }
+  if isinstance(v, (list, tuple)):
+    return [ canonical(x) for x in v ]
+  if isinstance(v, (set, frozenset)):
+    return as_set(v)
+  return v
+
+def _key(v):
+  ''' Sort key for canonical values of any type '''
+  return json.dumps(v, sort_keys=True, default=str)
+
+def as_set(v):
+  ''' Canonical form of a collection whose order does not matter
+
+  :param list v: collection
+  :returns list: sorted list without duplicates
+  '''
+  items = {}
+  for x in v:
+    x = canonical(x)
+    items[_key(x)] = x
+  return [ items[k] for k in sorted(items) ]
+
+def spec_hash(v):
+  ''' Hash of a value in canonical form
+
+  :param mixed v: value to hash
+  :returns str: hex digest, equal for values that compare the same
+  '''
+  return hashlib.sha256(_key(canonical(v)).encode('utf-8')).hexdigest()
+
+def same(want, have, unordered = False):
+  ''' Compare two values
+
+  :param mixed want: desired value
+  :param mixed have: current value
+  :param bool unordered: (optional) compare lists as sets
+  :returns bool: True if both values are the same
+  '''
+  if unordered:
+    return as_set(want) == as_set(have)
+  return canonical(want) == canonical(have)
+
+def diff(want, have, unordered = ()):
+  ''' Field level difference between two specifications
+
+  :param dict want: desired settings
+  :param dict have: current settings
+  :param list unordered: (optional) fields holding lists whose order does not matter
+  :returns dict: ``(current, desired)`` tuples indexed by field name, for fields that differ
+
+  Nested dicts are compared field by field, their fields are
+  reported as ``parent.child``.  A field missing on one side is
+  reported with a value of None.
+  '''
+  changes = {}
+  _diff(canonical(want), canonical(have), set(unordered), '', changes)
+  return changes
+
+def _diff(want, have, unordered, path, changes):
+  for k in sorted(set(want) | set(have)):
+    field = path + k
+    new = want.get(k)
+    old = have.get(k)
+    if isinstance(new, dict) and isinstance(old, dict):
+      _diff(new, old, unordered, field + '.', changes)
+    elif field in unordered and isinstance(new, list) and isinstance(old, list):
+      if as_set(new) != as_set(old): changes[field] = (old, new)
+    elif new != old:
+      changes[field] = (old, new)
+
+def describe(changes):
+  ''' Describe the changes found by ``diff``
+
+  :param dict changes: result of ``diff``
+  :returns str: one ``field: old -> new`` entry per changed field
+  '''
+  return ', '.join([ '{}: {} -> {}'.format(k, _key(old), _key(new)) for k, (old, new) in sorted(changes.items()) ])
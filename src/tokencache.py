@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+'''
+Keystone token cache
+
+Every invocation authenticates against Keystone before making its
+first API call, which for short commands run from ``cron`` is most
+of the run time.  Tokens and the service catalog that comes with
+them are saved to a cache file, one per cloud, project and user, and
+re-used by later invocations until shortly before they expire.
+
+Cache files can only be read by their owner.  A cached token rejected
+with HTTP status 401 is removed from the cache and the request is
+retried with a new token.
+
+The cache directory is ``~/.cache/myotc``, or ``MYOTC_TOKEN_CACHE``
+if defined.  Setting ``MYOTC_TOKEN_CACHE`` to an empty string disables
+the cache.
+'''
+import datetime
+import hashlib
+import json
+import os
+import sys
+import keystoneauth1.access
+import consts as K
+
+MARGIN = 300
+''' Cached tokens expiring in less than this many seconds are not used '''
+
+def cache_dir():
+  ''' Directory holding the cache files
+
+  :returns None|str: directory, or None if the cache is disabled
+  '''
+  path = os.getenv(K.MYOTC_TOKEN_CACHE)
+  if path is None: return os.path.join(os.path.expanduser('~'), '.cache', 'myotc')
+  return path if path != '' else None
+
+def cache_file(cloud, project, user):
+  ''' Cache file for a set of credentials
+
+  :param str cloud: cloud name or authentication URL
+  :param str project: project name
+  :param str user: user name or id
+  :returns None|str: file name, or None if the cache is disabled
+  '''
+  path = cache_dir()
+  if path is None: return None
+  key = json.dumps([cloud, project, user])
+  return os.path.join(path, 'token-{}.json'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]))
+
+def expires_in(auth_ref):
+  ''' Time left before a token expires
+
+  :param keystoneauth1.access.AccessInfo auth_ref: token data
+  :returns float: seconds before expiry
+  '''
+  return (auth_ref.expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+def body(auth_ref):
+  ''' Token data as returned by Keystone
+
+  :param keystoneauth1.access.AccessInfo auth_ref: token data
+  :returns dict: body of the Keystone response, to be passed to ``keystoneauth1.access.create``
+  :raises TypeError: if ``keystoneauth1`` no longer keeps the body
+
+  ``AccessInfo`` has no public accessor for the body it was created
+  from, so this is the only place using its private ``_data``.
+  '''
+  data = getattr(auth_ref, '_data', None)
+  if not isinstance(data, dict):
+    raise TypeError('Unsupported keystoneauth1 version: {} does not keep the token body'.format(type(auth_ref).__name__))
+  return data
+
+def load(fname):
+  ''' Load a cached token
+
+  :param str fname: cache file
+  :returns None|keystoneauth1.access.AccessInfo: token data, or None if missing or about to expire
+  '''
+  try:
+    with open(fname, 'r') as fp:
+      data = json.load(fp)
+    auth_ref = keystoneauth1.access.create(body = data['body'], auth_token = data['token'])
+    if expires_in(auth_ref) > MARGIN: return auth_ref
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+  return None
+
+def save(fname, auth_ref):
+  ''' Save a token to the cache
+
+  :param str fname: cache file
+  :param keystoneauth1.access.AccessInfo auth_ref: token data
+
+  The file is written under a temporary name created with owner-only
+  permissions and then renamed, so it is never readable by others
+  nor seen half written.
+  '''
+  tmp = '{}.{}.tmp'.format(fname, os.getpid())
+  try:
+    data = { 'token': auth_ref.auth_token, 'body': body(auth_ref) }
+    os.makedirs(os.path.dirname(fname), mode = 0o700, exist_ok = True)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+      json.dump(data, fp)
+    os.replace(tmp, fname)
+  except (OSError, TypeError) as e:
+    sys.stderr.write('Unable to save token cache: {}\n'.format(e))
+    if os.path.exists(tmp): os.unlink(tmp)
+
+def forget(fname):
+  ''' Remove a token from the cache
+
+  :param str fname: cache file
+  '''
+  try:
+    os.unlink(fname)
+  except OSError:
+    pass
+
+def use(c, cloud, project):
+  ''' Make a connection use the token cache
+
+  :param openstack.connection c: OpenStack connection, not yet authenticated
+  :param str cloud: cloud name or authentication URL
+  :param str project: project name
+  :returns openstack.connection: ``c``
+
+  A valid cached token is installed in the authentication plugin.
+  Otherwise the token is saved once the plugin authenticates.  Keystone
+  sessions invalidate the plugin when a request gets HTTP status 401,
+  which also removes the token from the cache.
+  '''
+  plugin = c.session.auth
+  if plugin is None or not hasattr(plugin, 'get_auth_ref'): return c
+  auth = c.config.config.get('auth', {})
+  user = auth.get('username') or auth.get('user_id')
+  fname = cache_file(cloud, project or auth.get('project_name') or auth.get('project_id'), user)
+  if fname is None: return c
+
+  auth_ref = load(fname)
+  if not auth_ref is None: plugin.auth_ref = auth_ref
+
+  get_auth_ref = plugin.get_auth_ref
+  def cached_get_auth_ref(session, *args, **kwargs):
+    auth_ref = get_auth_ref(session, *args, **kwargs)
+    save(fname, auth_ref)
+    return auth_ref
+  plugin.get_auth_ref = cached_get_auth_ref
+
+  invalidate = plugin.invalidate
+  def cached_invalidate(*args, **kwargs):
+    forget(fname)
+    return invalidate(*args, **kwargs)
+  plugin.invalidate = cached_invalidate
+  return c
@@ -8,6 +8,7 @@ import consts as K
 import os
 import sys
 import openstack
+import tokencache
 import os
 from version import VERSION
 
@@ -95,13 +96,13 @@ def main(opts=None):
         # ~ if args.debug:
           # ~ sys.stderr.write('Using proxy: {proxy}\n'.format(proxy=proxy))
 
-    args.cfgopts[K.CONN] = openstack.connect(auth = {
+    args.cfgopts[K.CONN] = tokencache.use(openstack.connect(auth = {
       "username": cf['TOKEN_ID'],
       "password": cf['TOKEN_PSK'],
       "project_name": cf['PROJECT'],
       "user_domain_name": cf['DOMAIN'],
       "auth_url": cf['AUTH_URL']
-    })
+    }), cf['AUTH_URL'], cf['PROJECT'])
     args.cfgopts[K.NAME] = cf['RESOURCE_ID']
     args.func(args)
   else:
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+'''
+Wait for many resources at once
+
+The OpenStack SDK ``wait_for_*`` functions poll a single resource.
+Waiting for many resources that way means many independent polling
+loops.  A ``Waiter`` instead keeps track of every pending server and
+volume and polls them with one list call per service, backing off
+while nothing changes.  Each caller gets a ``Future`` that completes
+when its resource reaches the target state.
+'''
+import threading
+import time
+from concurrent.futures import Future
+import consts as K
+import myotc
+
+LISTERS = {
+  K.server: lambda c: c.compute.servers(),
+  K.volume: lambda c: c.block_store.volumes(),
+}
+''' List call used to poll each resource type '''
+
+DELETED = None
+''' Target status used to wait for a resource to go away '''
+
+MAX_ERRORS = 5
+''' Number of consecutive failed polls before giving up '''
+
+GRACE = 60
+''' Seconds ``wait_for_*`` give the polling thread beyond the wait time '''
+
+class Watch:
+  ''' A pending wait on a resource
+
+  :param str kind: resource type
+  :param str rid: resource id
+  :param str|None status: target status or ``DELETED``
+  :param list failures: status values that indicate a failure
+  :param float deadline: time when the wait times out
+  '''
+  def __init__(self, kind, rid, status, failures, deadline):
+    self.kind = kind
+    self.id = rid
+    self.status = status
+    self.failures = [f.lower() for f in failures]
+    self.deadline = deadline
+    self.future = Future()
+
+class Waiter:
+  ''' Multiplexed status waiter
+
+  :param openstack.connection c: OpenStack connection
+  :param float interval: (optional) initial polling interval in seconds
+  :param float max_interval: (optional) maximum polling interval in seconds
+  '''
+  def __init__(self, c, interval = 2, max_interval = 15):
+    self.conn = c
+    self.interval = interval
+    self.max_interval = max_interval
+    self.lock = threading.Condition()
+    self.pending = []
+    self.thread = None
+    self.delay = interval
+    self.next_poll = 0
+
+  def watch(self, kind, res, status, failures = None, wait = 120):
+    ''' Wait for a resource to reach a status
+
+    :param str kind: resource type, ``server`` or ``volume``
+    :param str|resource res: resource or resource id
+    :param str|None status: target status or ``DELETED``
+    :param list failures: (optional) status values that indicate a failure
+    :param int wait: (optional) maximum time to wait in seconds
+    :returns Future: completes with the updated resource
+
+    The next poll is brought forward to at most ``interval`` seconds
+    from now.  The polling thread is only woken up when that moves
+    the poll, so waits added together share the same listing.
+    '''
+    rid = res if isinstance(res,str) else res[K.sID]
+    now = time.time()
+    w = Watch(kind, rid, status, failures or [], now + wait)
+    with self.lock:
+      self.pending.append(w)
+      self.delay = self.interval
+      if self.thread is None:
+        self.next_poll = now + self.interval
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+      elif now + self.interval < self.next_poll:
+        self.next_poll = now + self.interval
+        self.lock.notify()
+    return w.future
+
+  def server(self, srv, status = K.ACTIVE, failures = ['ERROR'], wait = 120):
+    ''' Wait for a server to reach a status
+
+    :param str|openstack.server srv: server or server id
+    :param str status: (optional) target status
+    :param list failures: (optional) status values that indicate a failure
+    :param int wait: (optional) maximum time to wait in seconds
+    :returns Future: completes with the updated server
+    '''
+    return self.watch(K.server, srv, status, failures, wait)
+
+  def volume(self, vol, status = 'available', failures = ['error'], wait = 120):
+    ''' Wait for a volume to reach a status
+
+    :param str|openstack.volume vol: volume or volume id
+    :param str status: (optional) target status
+    :param list failures: (optional) status values that indicate a failure
+    :param int wait: (optional) maximum time to wait in seconds
+    :returns Future: completes with the updated volume
+    '''
+    return self.watch(K.volume, vol, status, failures, wait)
+
+  def deleted(self, kind, res, wait = 120):
+    ''' Wait for a resource to be deleted
+
+    :param str kind: resource type, ``server`` or ``volume``
+    :param str|resource res: resource or resource id
+    :param int wait: (optional) maximum time to wait in seconds
+    :returns Future: completes with None
+    '''
+    return self.watch(kind, res, DELETED, ['error'], wait)
+
+  def _run(self):
+    ''' Polling thread
+
+    Failed polls are retried, backing off, up to ``MAX_ERRORS`` times
+    in a row.  If the thread stops on an unexpected error, the pending
+    waits fail with it and the next ``watch`` starts a new thread.
+    '''
+    error = RuntimeError('Status polling thread stopped')
+    try:
+      self._poll()
+    except Exception as e:
+      error = e
+    finally:
+      with self.lock:
+        if self.thread is threading.current_thread():
+          self.thread = None
+          pending, self.pending = self.pending, []
+        else:
+          pending = []
+      for w in pending:
+        if not w.future.done(): w.future.set_exception(error)
+
+  def _poll(self):
+    ''' Poll until there is nothing left to wait for '''
+    errors = 0
+    while True:
+      with self.lock:
+        while len(self.pending) and time.time() < self.next_poll:
+          self.lock.wait(self.next_poll - time.time())
+        if len(self.pending) == 0:
+          self.thread = None
+          return
+        kinds = set([w.kind for w in self.pending])
+
+      try:
+        found = {}
+        for kind in kinds:
+          found[kind] = {}
+          for r in LISTERS[kind](self.conn):
+            found[kind][r[K.sID]] = r
+        errors = 0
+      except Exception as e:
+        errors += 1
+        if errors < MAX_ERRORS:
+          found = None
+        else:
+          with self.lock:
+            pending, self.pending = self.pending, []
+          for w in pending:
+            if not w.future.done(): w.future.set_exception(e)
+          continue
+
+      with self.lock:
+        done = self._check(found) if not found is None else 0
+        if done:
+          self.delay = self.interval
+        else:
+          self.delay = min(self.delay * 1.5, self.max_interval)
+        self.next_poll = time.time() + self.delay
+
+  def _check(self, found):
+    ''' Resolve pending waits from a poll
+
+    :param dict found: resources found indexed by type and id
+    :returns int: number of waits completed
+    '''
+    import openstack
+    now = time.time()
+    pending = []
+    done = 0
+    for w in self.pending:
+      if not w.kind in found:
+        pending.append(w)
+        continue
+      res = found[w.kind].get(w.id)
+      status = None if res is None else str(res[K.status]).lower()
+      if w.status is DELETED:
+        if res is None or status == 'deleted':
+          w.future.set_result(None)
+          done += 1
+          continue
+      elif not res is None and status == w.status.lower():
+        w.future.set_result(res)
+        done += 1
+        continue
+      if not status is None and status in w.failures:
+        w.future.set_exception(openstack.exceptions.ResourceFailure(
+            '{kind} {id} transitioned to failure state {status}'.format(kind=w.kind, id=w.id, status=status)))
+        done += 1
+        continue
+      if now > w.deadline:
+        w.future.set_exception(openstack.exceptions.ResourceTimeout(
+            'Timeout waiting for {kind} {id} to reach {status}'.format(kind=w.kind, id=w.id, status=w.status or 'deleted')))
+        done += 1
+        continue
+      pending.append(w)
+    self.pending = pending
+    return done
+
+waiters = {}
+''' Shared waiters indexed by connection '''
+waiters_lock = threading.Lock()
+
+def get(c):
+  ''' Get the shared waiter for a connection
+
+  :param openstack.connection c: OpenStack connection
+  :returns Waiter: shared waiter
+  '''
+  with waiters_lock:
+    if not id(c) in waiters: waiters[id(c)] = Waiter(c)
+    return waiters[id(c)]
+
+def wait_for_server(c, srv, status = K.ACTIVE, wait = 120):
+  ''' Wait for a server to reach a status
+
+  :param openstack.connection c: OpenStack connection
+  :param openstack.server srv: server to wait for
+  :param str status: (optional) target status
+  :param int wait: (optional) maximum time to wait in seconds
+  :returns openstack.server: updated server
+  '''
+  return get(c).server(srv, status, wait=wait).result(wait + GRACE)
+
+def wait_for_volume(c, vol, status = 'available', wait = 120):
+  ''' Wait for a volume to reach a status
+
+  :param openstack.connection c: OpenStack connection
+  :param openstack.volume vol: volume to wait for
+  :param str status: (optional) target status
+  :param int wait: (optional) maximum time to wait in seconds
+  :returns openstack.volume: updated volume
+  '''
+  return get(c).volume(vol, status, wait=wait).result(wait + GRACE)
+
+def wait_for_delete(c, kind, res, wait = 120):
+  ''' Wait for a resource to be deleted
+
+  :param openstack.connection c: OpenStack connection
+  :param str kind: resource type, ``server`` or ``volume``
+  :param resource res: resource to wait for
+  :param int wait: (optional) maximum time to wait in seconds
+  '''
+  get(c).deleted(kind, res, wait).result(wait + GRACE)
+
+routers = {}
+''' Router lookups indexed by connection and name '''
+routers_lock = threading.Lock()
+
+def wait_for_router(c, name, wait = 60, interval = 0.5, max_interval = 5):
+  ''' Wait for a router to become visible
+
+  :param openstack.connection c: OpenStack connection
+  :param str name: router name
+  :param int wait: (optional) maximum time to wait in seconds
+  :param float interval: (optional) initial polling interval in seconds
+  :param float max_interval: (optional) maximum polling interval in seconds
+  :returns router-instance: the router
+
+  A VPC created through the OTC extensions API takes a while to
+  show up as a Neutron router.  The router is looked up only once
+  per connection and name: concurrent callers share the same wait
+  and later callers get the cached router.
+  '''
+  import openstack
+  key = (id(c), name)
+  with routers_lock:
+    fut = routers.get(key)
+    owner = fut is None
+    if owner:
+      fut = Future()
+      routers[key] = fut
+  if not owner: return fut.result()
+
+  try:
+    deadline = time.time() + wait
+    delay = interval
+    while True:
+      for r in c.network.routers(name = name):
+        if r[K.NAME] == name:
+          fut.set_result(r)
+          return r
+      if time.time() > deadline:
+        raise openstack.exceptions.ResourceTimeout('Timeout waiting for router {}'.format(name))
+      myotc.msg('_')
+      time.sleep(delay)
+      delay = min(delay * 1.5, max_interval)
+  except Exception as e:
+    # Do not cache failures, a later caller may try again
+    with routers_lock:
+      del routers[key]
+    fut.set_exception(e)
+    raise
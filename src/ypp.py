@@ -39,6 +39,8 @@ except ImportError:
 ###################################################################
 yaml_include_path = []
 ''' List of folders where to find included files '''
+yaml_sources = []
+''' Files read by the last ``process`` call '''
 secrets_file = '_secrets_file_'
 ''' variable name for secrets file in the yaml_pp_vars dictionary '''
 key_store = '_ssh_key_store_'
@@ -188,6 +190,7 @@ def yaml_raw(fname, prefix = '', prev = None):
   txt = ''
   prefix2 = prefix.replace('-',' ')
   fname = yaml_findfile(fname, prev)
+  yaml_sources.append(fname)
 
   with open(fname,'r') as f:
     for line in f:
@@ -213,6 +216,7 @@ def yaml_bin(fname, prefix = '', prev = None):
   txt = ''
   prefix2 = prefix.replace('-',' ')
   fname = yaml_findfile(fname, prev)
+  yaml_sources.append(fname)
 
   with open(fname,'rb') as f:
     b64 = base64.b64encode(f.read()).decode('ascii')
@@ -402,6 +406,7 @@ def yaml_pp(fname, prefix = '', prev = None):
   cond_stack = []
 
   fname = yaml_findfile(fname, prev)
+  yaml_sources.append(fname)
 
   with open(fname,'r') as f:
     for line in f:
@@ -561,6 +566,7 @@ def process(yamlfile, includes, defines):
   '''
 
   yaml_init(includes, defines)
+  del yaml_sources[:]
   return yaml.safe_load(yaml_pp(yamlfile))
 
 def load(thing):